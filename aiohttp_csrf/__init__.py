@@ -1,26 +1,57 @@
 import asyncio
-from functools import wraps
-from typing import Awaitable, Callable, Optional
-
-from aiohttp import web
-
-from .policy import AbstractPolicy
-from .storage import AbstractStorage
+from functools import partial, wraps
+from typing import Any, Awaitable, Callable, Iterable, Optional
+
+from aiohttp import hdrs, web
+from aiohttp.helpers import ETAG_ANY
+from aiohttp.web_urldispatcher import StaticResource, _default_expect_handler
+from blake3 import blake3
+
+from .config import APP_CONFIG_KEY, CsrfConfig, get_config
+from .metrics import CHECK_FAILURES, AbstractMetrics, MetricsTracer
+from .policy import (
+    AbstractPolicy,
+    LazyOriginalToken,
+    PolicyResult,
+    as_reason,
+    check_policy,
+    check_policy_headers,
+)
+from .revocation import AbstractRevocation, RevocationCheckingVerifier
+from .rules import EXEMPT, Action, Rule, RuleTable
+from .storage import REQUEST_NEW_TOKEN_KEY, AbstractStorage
+from .token_generator import OriginalToken
+from .tracing import (
+    POLICY_CHECK,
+    STORAGE_GET,
+    STORAGE_SAVE_TOKEN,
+    AbstractTracer,
+    TracerGroup,
+    trace,
+)
 
 __version__ = "0.1.1"
 
 RENDTYPE = Optional[Callable[[web.Request], web.StreamResponse]]
 ERRTYPE = Optional[type[Exception]]
 
-APP_POLICY_KEY = web.AppKey("aiohttp_csrf_policy", AbstractPolicy)
-APP_STORAGE_KEY = web.AppKey("aiohttp_csrf_storage", AbstractStorage)
-APP_ERROR_EXCEPTION_KEY = web.AppKey("aiohttp_csrf_error_exception", type(Exception))
-APP_ERROR_RENDERER_KEY = web.AppKey("aiohttp_csrf_error_renderer", object)
-
 MIDDLEWARE_SKIP_PROPERTY = "csrf_middleware_skip"
+# (policy, exception, error_renderer, renderer_is_coroutine) of csrf_protect
+PROTECT_OPTIONS_PROPERTY = "csrf_protect_options"
+
+# the policy a request has already passed, e.g. in csrf_expect_handler
+REQUEST_CHECKED_KEY = "aiohttp_csrf_checked"
+# set while a request is inside the protection path, so that csrf_middleware
+# installed on both a parent and a sub-application handles it only once
+REQUEST_PROTECTED_KEY = "aiohttp_csrf_protected"
+# set on a protected request whose token is saved when its response is
+# prepared; True when its check read the token, which then has to be saved
+REQUEST_SAVE_PENDING_KEY = "aiohttp_csrf_save_pending"
 
 UNPROTECTED_HTTP_METHODS = ("GET", "HEAD", "OPTIONS", "TRACE")
 
+_UNPROTECTED_HTTP_METHODS = frozenset(UNPROTECTED_HTTP_METHODS)
+
 
 def setup(
     app: web.Application,
@@ -28,80 +59,112 @@ def setup(
     storage: AbstractStorage,
     exception: ERRTYPE = web.HTTPForbidden,
     error_renderer: RENDTYPE = None,
+    metrics: Optional[AbstractMetrics] = None,
+    tracer: Optional[AbstractTracer] = None,
+    rules: Iterable[Rule] = (),
+    revocation: Optional[AbstractRevocation] = None,
 ) -> None:
-    app[APP_POLICY_KEY] = policy
-    app[APP_STORAGE_KEY] = storage
+    tracers: list[AbstractTracer] = []
 
-    if exception is None or not issubclass(exception, Exception):
-        raise TypeError("Default exception must be instance of Exception.")
-    app[APP_ERROR_EXCEPTION_KEY] = exception  # type: ignore[misc]
+    if metrics is not None:
+        # latency histograms are recorded through the tracing hooks
+        tracers.append(MetricsTracer(metrics))
 
-    if error_renderer is not None:
-        if not callable(error_renderer):
-            raise TypeError("error_renderer must be callable.")
-        app[APP_ERROR_RENDERER_KEY] = error_renderer
+    if tracer is not None:
+        tracers.append(tracer)
 
+    if len(tracers) > 1:
+        tracer = TracerGroup(*tracers)
+    elif tracers:
+        tracer = tracers[0]
 
-def _get_policy(request: web.Request) -> AbstractPolicy:
-    try:
-        return request.app[APP_POLICY_KEY]
-    except KeyError:
-        raise RuntimeError(
-            "Policy not found. Install aiohttp_csrf in your "
-            "aiohttp.web.Application using aiohttp_csrf.setup()"
-        )
+    rules = tuple(rules)
 
+    # Everything is validated here and stored as one immutable value, looked
+    # up through config_dict so that sub-applications inherit it.
+    app[APP_CONFIG_KEY] = CsrfConfig(
+        policy=policy,
+        storage=storage,
+        exception=exception,  # type: ignore[arg-type]
+        error_renderer=error_renderer,
+        metrics=metrics,
+        tracer=tracer,
+        rules=RuleTable(rules) if rules else None,
+        revocation=revocation,
+    ).validate()
 
-def _get_storage(request: web.Request) -> AbstractStorage:
-    try:
-        return request.app[APP_STORAGE_KEY]
-    except KeyError:
-        raise RuntimeError(
-            "Storage not found. Install aiohttp_csrf in your "
-            "aiohttp.web.Application using aiohttp_csrf.setup()"
-        )
+    if _on_response_prepare not in app.on_response_prepare:
+        app.on_response_prepare.append(_on_response_prepare)
 
 
 async def _render_error(
-    request: web.Request, exception: ERRTYPE, renderer: RENDTYPE = None
+    request: web.Request,
+    exception: ERRTYPE,
+    renderer: RENDTYPE = None,
+    renderer_is_coroutine: Optional[bool] = None,
 ) -> web.StreamResponse:
-    if exception is None:
-        try:
-            exception = request.app[APP_ERROR_EXCEPTION_KEY]
-        except KeyError:
-            raise RuntimeError(
-                "Default error renderer not found. Install aiohttp_csrf in "
-                "your aiohttp.web.Application using aiohttp_csrf.setup()"
-            )
-        exception = web.HTTPForbidden
+    if exception is None and renderer is None:
+        # nothing set on the handler, so use what setup() configured
+        config = get_config(request)
+        exception = config.exception
+        renderer = config.error_renderer
+        renderer_is_coroutine = config.renderer_is_coroutine
 
     if renderer is None:
+        assert exception is not None
         raise exception()
 
-    if asyncio.iscoroutinefunction(renderer):
-        return await renderer(request)
+    if renderer_is_coroutine is None:
+        renderer_is_coroutine = asyncio.iscoroutinefunction(renderer)
+
+    if renderer_is_coroutine:
+        return await renderer(request)  # type: ignore[misc]
     else:
         return renderer(request)
 
 
-async def get_token(request: web.Request) -> str:
-    storage = _get_storage(request)
+async def get_token(request: web.Request) -> OriginalToken:
+    storage = get_config(request).storage
 
     return await storage.get(request)
 
 
 async def generate_token(request: web.Request) -> str:
-    storage = _get_storage(request)
+    storage = get_config(request).storage
 
     return await storage.generate_new_token(request)
 
 
-async def save_token(request: web.Request, response: web.Response) -> None:
-    storage = _get_storage(request)
+async def save_token(request: web.Request, response: web.StreamResponse) -> None:
+    storage = get_config(request).storage
 
     await storage.save_token(request, response)
 
 
+async def revoke_token(
+    request: web.Request, token: Optional[str] = None, ttl: Optional[float] = None
+) -> bool:
+    """Reject ``token`` in every worker from now on, e.g. on logout.
+
+    Without a ``token`` the request's stored token is revoked, which is not
+    possible with storages that keep none, such as SignedTokenStorage.
+    Returns whether a token was revoked.
+    """
+    revocation = get_config(request).revocation
+    if revocation is None:
+        raise RuntimeError("Pass revocation= to aiohttp_csrf.setup() to revoke tokens")
+
+    if token is None:
+        original_token = await get_token(request)
+        if not isinstance(original_token, str) or not original_token:
+            return False
+        token = original_token
+
+    revocation.revoke(token, ttl)
+
+    return True
+
+
 def csrf_exempt(
     handler: Callable[[web.Request], Awaitable[web.StreamResponse]],
 ) -> Callable[[web.Request], Awaitable[web.StreamResponse]]:
@@ -114,19 +177,182 @@ def csrf_exempt(
     return wrapped_handler
 
 
-async def _check(request: web.Request) -> bool:
+def _requires_token(policy: AbstractPolicy) -> bool:
+    # Policies such as OriginPolicy decide without a token, in which case the
+    # storage is neither read nor written unless a handler asks for a token.
+    return getattr(policy, "requires_token", True)
+
+
+def _unless_revoked(
+    config: CsrfConfig, original_token: OriginalToken
+) -> Optional[OriginalToken]:
+    # None when the stored token is revoked; a verifier is wrapped instead,
+    # since only the token it is asked about can be looked up
+    revocation = config.revocation
+
+    if revocation is None or not original_token:
+        return original_token
+
+    if isinstance(original_token, str):
+        return None if revocation.is_revoked(original_token) else original_token
+
+    return RevocationCheckingVerifier(original_token, revocation)
+
+
+async def _load_token(
+    request: web.Request, config: CsrfConfig
+) -> Optional[OriginalToken]:
+    tracer = config.tracer
+
+    if tracer is None:
+        stored = await config.storage.get(request)
+    else:
+        with trace(tracer, request, STORAGE_GET):
+            stored = await config.storage.get(request)
+
+    return _unless_revoked(config, stored)
+
+
+def _lazy_token(request: web.Request, config: CsrfConfig) -> LazyOriginalToken:
+    return LazyOriginalToken(partial(_load_token, request, config))
+
+
+async def _check(
+    request: web.Request, config: CsrfConfig, policy: AbstractPolicy
+) -> tuple[PolicyResult, bool]:
+    """Check the request, returning the result and whether storage was read."""
     if not isinstance(request, web.Request):
         raise RuntimeError("Can't get request from handler params")
 
-    original_token = await get_token(request)
+    tracer = config.tracer
+    token = _lazy_token(request, config)
+
+    if tracer is not None and _requires_token(policy):
+        if getattr(policy, "check_lazily", None) is None:
+            # read up front, so the storage and policy spans stay apart
+            await token.get()
+
+    result: PolicyResult
+    if tracer is None:
+        result = await check_policy(policy, request, token)
+    else:
+        with trace(tracer, request, POLICY_CHECK):
+            result = await check_policy(policy, request, token)
+
+    if not result and config.metrics is not None:
+        config.metrics.increment(CHECK_FAILURES, as_reason(result))
+
+    return result, token.loaded
+
+
+async def _save_token_if_needed(
+    request: web.Request,
+    response: web.StreamResponse,
+    config: CsrfConfig,
+    token_read: bool,
+) -> None:
+    # A token read from storage may have been rotated, and one issued by the
+    # handler must be stored; otherwise storage is left alone.
+    if token_read or REQUEST_NEW_TOKEN_KEY in request:
+        tracer = config.tracer
+
+        if tracer is None:
+            await config.storage.save_token(request, response)
+        else:
+            with trace(tracer, request, STORAGE_SAVE_TOKEN):
+                await config.storage.save_token(request, response)
+
+
+async def _call_protected(
+    request: web.Request,
+    handler: Callable[..., Awaitable[web.StreamResponse]],
+    args: tuple[Any, ...],
+    kwargs: dict[str, Any],
+    exception: ERRTYPE = None,
+    error_renderer: RENDTYPE = None,
+    renderer_is_coroutine: bool = False,
+    policy: Optional[AbstractPolicy] = None,
+) -> web.StreamResponse:
+    config = get_config(request)
+    if policy is None:
+        policy = config.policy
+
+    # An outer csrf_middleware or csrf_protect may already handle this
+    # request. Its check is only reused when it was made with this policy.
+    nested = REQUEST_PROTECTED_KEY in request
+    request[REQUEST_PROTECTED_KEY] = True
+
+    # unchecked requests, such as GETs, still get a token when the policy
+    # uses one
+    token_read = _requires_token(policy)
+
+    if request.method not in _UNPROTECTED_HTTP_METHODS and (
+        request.get(REQUEST_CHECKED_KEY) is not policy
+    ):
+        result, token_read = await _check(request, config, policy)
+        if not result:
+            return await _render_error(
+                request, exception, error_renderer, renderer_is_coroutine
+            )
+
+        request[REQUEST_CHECKED_KEY] = policy
+
+    if nested:
+        # the outer call saves the token, but it must if this check read it
+        if REQUEST_SAVE_PENDING_KEY in request and token_read:
+            request[REQUEST_SAVE_PENDING_KEY] = True
+
+        return await handler(*args, **kwargs)
+
+    request[REQUEST_SAVE_PENDING_KEY] = token_read
+
+    try:
+        response = await handler(*args, **kwargs)
+    except web.HTTPException as exc:
+        await _save_pending_token(request, exc)
+        raise
+
+    # A response the handler prepared itself, such as a stream, was saved by
+    # _on_response_prepare. Others are saved now rather than when they are
+    # sent, so session middlewares serialising after the handler see it.
+    if not response.prepared:
+        await _save_pending_token(request, response)
+
+    return response
+
+
+async def _save_pending_token(
+    request: web.Request, response: web.StreamResponse
+) -> None:
+    token_read = request.pop(REQUEST_SAVE_PENDING_KEY, None)
+
+    if token_read is not None:
+        await _save_token_if_needed(request, response, get_config(request), token_read)
+
+
+async def _on_response_prepare(
+    request: web.Request, response: web.StreamResponse
+) -> None:
+    if REQUEST_SAVE_PENDING_KEY not in request:
+        return
+
+    cookies = response.cookies
+    before = {name: morsel.OutputString() for name, morsel in cookies.items()}
 
-    policy = _get_policy(request)
+    await _save_pending_token(request, response)
 
-    return await policy.check(request, original_token)
+    # aiohttp may already have turned the cookies into headers at this point
+    for name, morsel in list(cookies.items()):
+        if before.get(name) != morsel.OutputString():
+            response.headers.add(hdrs.SET_COOKIE, morsel.OutputString())
+            del cookies[name]
 
 
 def csrf_protect(
-    handler=None, exception: ERRTYPE = None, error_renderer: RENDTYPE = None
+    handler=None,
+    exception: ERRTYPE = None,
+    error_renderer: RENDTYPE = None,
+    policy: Optional[AbstractPolicy] = None,
 ):
     if error_renderer is not None and not callable(error_renderer):
         raise TypeError("Renderer must be callable")
@@ -134,6 +360,9 @@ def csrf_protect(
     if exception is not None and not issubclass(exception, Exception):
         raise TypeError("exception must be BaseException class")
 
+    # resolved once here rather than on every protected request
+    renderer_is_coroutine = asyncio.iscoroutinefunction(error_renderer)
+
     def wrapper(handler):
         @wraps(handler)
         async def wrapped(*args, **kwargs):
@@ -142,28 +371,23 @@ def csrf_protect(
             if isinstance(request, web.View):
                 request = request.request
 
-            if request.method not in UNPROTECTED_HTTP_METHODS and not await _check(
-                request
-            ):
-                return await _render_error(request, exception, error_renderer)
-
-            raise_response = False
-
-            try:
-                response = await handler(*args, **kwargs)
-            except web.HTTPException as exc:
-                response = exc
-                raise_response = True
-
-            if isinstance(response, web.Response):
-                await save_token(request, response)
-
-            if raise_response:
-                raise response
-
-            return response
+            return await _call_protected(
+                request,
+                handler,
+                args,
+                kwargs,
+                exception,
+                error_renderer,
+                renderer_is_coroutine,
+                policy,
+            )
 
         setattr(wrapped, MIDDLEWARE_SKIP_PROPERTY, True)
+        setattr(
+            wrapped,
+            PROTECT_OPTIONS_PROPERTY,
+            (policy, exception, error_renderer, renderer_is_coroutine),
+        )
 
         return wrapped
 
@@ -173,9 +397,162 @@ def csrf_protect(
     return wrapper(handler)
 
 
+async def csrf_expect_handler(request: web.Request) -> Optional[web.StreamResponse]:
+    """Expect handler that runs the CSRF check before 100 Continue is sent.
+
+    Use it as ``expect_handler=`` when adding protected routes. If the policy
+    can decide from the headers alone, a failing request is rejected before
+    the client uploads its body, and a passing one is not checked again.
+    """
+    if request.method not in _UNPROTECTED_HTTP_METHODS:
+        config = get_config(request)
+        options = _route_protection(request, config)
+
+        if options is None:
+            # exempt, so there is nothing to check before the body is sent
+            await _default_expect_handler(request)
+            return None
+
+        policy, exception, error_renderer, renderer_is_coroutine = options
+        check_headers = getattr(policy, "check_headers", None)
+
+        if _requires_token(policy) and getattr(
+            config.storage, "needs_middlewares", True
+        ):
+            # no middleware has run yet, so csrf_middleware checks it later
+            check_headers = None
+
+        if check_headers is not None:
+            result = await check_policy_headers(
+                policy, request, _lazy_token(request, config)
+            )
+
+            if result is not None and not result:
+                if config.metrics is not None:
+                    config.metrics.increment(CHECK_FAILURES, as_reason(result))
+
+                return await _render_error(
+                    request, exception, error_renderer, renderer_is_coroutine
+                )
+
+            if result:
+                # _call_protected skips the check only for this same policy
+                request[REQUEST_CHECKED_KEY] = policy
+
+    await _default_expect_handler(request)
+
+    return None
+
+
+_ProtectOptions = tuple[AbstractPolicy, ERRTYPE, RENDTYPE, bool]
+
+
+def _route_protection(
+    request: web.Request, config: CsrfConfig
+) -> Optional[_ProtectOptions]:
+    """Resolve how the matched route is protected, as csrf_middleware does.
+
+    Returns None for exempt routes. A csrf_protect decorator on the handler
+    wins over path rules, which win over the application's policy.
+    """
+    handler = _resolve_view_method(request, request.match_info.handler)
+
+    if getattr(handler, MIDDLEWARE_SKIP_PROPERTY, False):
+        options = getattr(handler, PROTECT_OPTIONS_PROPERTY, None)
+        if options is None:
+            return None  # csrf_exempt
+
+        policy, exception, error_renderer, renderer_is_coroutine = options
+        return (
+            config.policy if policy is None else policy,
+            exception,
+            error_renderer,
+            renderer_is_coroutine,
+        )
+
+    policy = config.policy
+
+    if config.rules is not None:
+        action = config.rules.lookup(request.path)
+
+        if action is EXEMPT:
+            return None
+        if action is not None and not isinstance(action, Action):
+            policy = action
+
+    return policy, None, None, False
+
+
+def _token_etag(token: str) -> str:
+    # the token itself stays out of the header
+    return blake3(token.encode("utf-8")).hexdigest(length=16)
+
+
+async def csrf_token_handler(request: web.Request) -> web.StreamResponse:
+    """GET handler returning the current token as ``text/plain``.
+
+    Pages with forms can then be cached publicly and fetch their token with
+    a small request instead. The response is ``Cache-Control: private,
+    no-cache`` with an ETag, and a conditional GET whose ``If-None-Match``
+    still matches gets a bodiless 304. The token comes from the configured
+    storage, so whether it stays the same across requests is up to its
+    rotation policy.
+    """
+    token = await generate_token(request)
+    etag = _token_etag(token)
+
+    if_none_match = request.if_none_match or ()
+    if any(tag.value in (etag, ETAG_ANY) for tag in if_none_match):
+        response = web.Response(status=304)
+    else:
+        response = web.Response(text=token)
+
+    response.etag = etag
+    response.headers[hdrs.CACHE_CONTROL] = "private, no-cache"
+
+    await save_token(request, response)
+
+    return response
+
+
+_NO_KWARGS: dict[str, Any] = {}
+
+
+def _resolve_view_method(request: web.Request, handler: Any) -> Any:
+    # Decorators on a class-based view sit on its methods, not on the class
+    # the router calls, so look at the method the request dispatches to.
+    view = request.match_info.handler
+
+    if isinstance(view, type) and issubclass(view, web.View):
+        method = getattr(view, request.method.lower(), None)
+        if method is not None:
+            return method
+
+    return handler
+
+
 @web.middleware
 async def csrf_middleware(request: web.Request, handler):
-    if not getattr(handler, MIDDLEWARE_SKIP_PROPERTY, False):
-        handler = csrf_protect(handler=handler)
+    if getattr(_resolve_view_method(request, handler), MIDDLEWARE_SKIP_PROPERTY, False):
+        return await handler(request)
+
+    # static files never carry a form, so skip the storage and policy entirely
+    if isinstance(request.match_info.route.resource, StaticResource):
+        return await handler(request)
+
+    policy: Optional[AbstractPolicy] = None
+
+    rules = get_config(request).rules
+    if rules is not None:
+        action = rules.lookup(request.path)
+
+        if action is EXEMPT:
+            return await handler(request)
+        if action is not None and not isinstance(action, Action):
+            policy = action
 
-    return await handler(request)
+    # Call the shared protection path directly instead of building a fresh
+    # csrf_protect() closure for every request.
+    return await _call_protected(
+        request, handler, (request,), _NO_KWARGS, policy=policy
+    )
@@ -0,0 +1,97 @@
+import asyncio
+from typing import TYPE_CHECKING, Any, Callable, NamedTuple, Optional
+
+from aiohttp import web
+
+from .metrics import AbstractMetrics
+from .policy import AbstractPolicy
+from .revocation import AbstractRevocation
+from .rules import RuleTable
+from .tracing import AbstractTracer
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .storage import AbstractStorage
+
+REQUEST_CONFIG_KEY = "aiohttp_csrf_config"
+
+
+class CsrfConfig(NamedTuple):
+    """Everything aiohttp_csrf.setup() configures, frozen into one value."""
+
+    policy: AbstractPolicy
+    storage: "AbstractStorage"
+    exception: type[Exception] = web.HTTPForbidden
+    error_renderer: Optional[Callable[[web.Request], Any]] = None
+    renderer_is_coroutine: bool = False
+    metrics: Optional[AbstractMetrics] = None
+    tracer: Optional[AbstractTracer] = None
+    rules: Optional[RuleTable] = None
+    revocation: Optional[AbstractRevocation] = None
+
+    def validate(self) -> "CsrfConfig":
+        if not callable(getattr(self.policy, "check", None)):
+            raise TypeError("policy must implement check()")
+
+        for method in ("get", "generate_new_token", "save_token"):
+            if not callable(getattr(self.storage, method, None)):
+                raise TypeError(f"storage must implement {method}()")
+
+        if self.revocation is not None:
+            for method in ("is_revoked", "revoke"):
+                if not callable(getattr(self.revocation, method, None)):
+                    raise TypeError(f"revocation must implement {method}()")
+
+        if not isinstance(self.exception, type) or not issubclass(
+            self.exception, Exception
+        ):
+            raise TypeError("Default exception must be instance of Exception.")
+
+        if self.error_renderer is not None:
+            if not callable(self.error_renderer):
+                raise TypeError("error_renderer must be callable.")
+
+            is_coroutine = asyncio.iscoroutinefunction(self.error_renderer)
+            if is_coroutine != self.renderer_is_coroutine:
+                return self._replace(renderer_is_coroutine=is_coroutine)
+
+        return self
+
+
+APP_CONFIG_KEY = web.AppKey("aiohttp_csrf_config", CsrfConfig)
+
+
+def find_config(request: web.Request) -> Optional[CsrfConfig]:
+    # Resolved through config_dict, so sub-applications without their own
+    # setup() inherit their parent's, and only once per request.
+    try:
+        return request[REQUEST_CONFIG_KEY]
+    except KeyError:
+        pass
+
+    config = request[REQUEST_CONFIG_KEY] = request.config_dict.get(APP_CONFIG_KEY)
+
+    return config
+
+
+def get_config(request: web.Request) -> CsrfConfig:
+    config = find_config(request)
+
+    if config is None:
+        raise RuntimeError(
+            "aiohttp_csrf is not configured. Install aiohttp_csrf in your "
+            "aiohttp.web.Application using aiohttp_csrf.setup()"
+        )
+
+    return config
+
+
+def get_metrics(request: web.Request) -> Optional[AbstractMetrics]:
+    config = find_config(request)
+
+    return None if config is None else config.metrics
+
+
+def get_tracer(request: web.Request) -> Optional[AbstractTracer]:
+    config = find_config(request)
+
+    return None if config is None else config.tracer
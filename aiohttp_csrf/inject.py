@@ -0,0 +1,263 @@
+import functools
+import html
+import re
+from typing import Awaitable, Callable, Optional
+
+from aiohttp import hdrs, web
+from yarl import URL
+
+from . import REQUEST_SAVE_PENDING_KEY
+from .config import get_config
+from .policy import form_field_name
+
+_FORM_OPEN_RE = re.compile(rb"<form", re.IGNORECASE)
+# the attributes may contain quoted '>' characters
+_FORM_TAG_RE = re.compile(
+    rb"""<form(?=[\s/>])(?:[^>"']|"[^"]*"|'[^']*')*>""", re.IGNORECASE
+)
+_ATTRIBUTE_RE = re.compile(rb"""([^\s"'>/=]+)(?:\s*=\s*("[^"]*"|'[^']*'|[^\s"'>]+))?""")
+_FORM_OPEN = b"<form"
+
+# encodings in which the markup can be searched byte by byte
+_INCOMPATIBLE_CHARSETS = ("utf-16", "utf-32", "utf_16", "utf_32")
+
+
+def _attributes(tag: bytes) -> dict[bytes, bytes]:
+    attributes: dict[bytes, bytes] = {}
+
+    for match in _ATTRIBUTE_RE.finditer(tag, len(_FORM_OPEN), len(tag) - 1):
+        value = match.group(2) or b""
+        if value[:1] in (b'"', b"'"):
+            value = value[1:-1]
+
+        # as in browsers, the first of repeated attributes wins
+        attributes.setdefault(match.group(1).lower(), value)
+
+    return attributes
+
+
+def _submits_to(action: Optional[bytes], base_url: Optional[URL]) -> bool:
+    # whether a form with this action posts back to base_url's origin
+    if action is None:
+        return True
+
+    try:
+        url = URL(html.unescape(action.decode("latin-1")).strip())
+    except (TypeError, ValueError):
+        return False
+
+    if not url.scheme and url.host is None:
+        return True  # relative to the page
+
+    if base_url is None:
+        return False
+
+    url = base_url.join(url)
+
+    return (url.scheme, url.host, url.port) == (
+        base_url.scheme,
+        base_url.host,
+        base_url.port,
+    )
+
+
+class FormTokenInjector:
+    """Insert a hidden token field into POST forms that submit to this site.
+
+    A ``<form method="post">`` gets the field when its ``action`` is missing,
+    relative, or has the same origin as ``base_url``, the URL of the page.
+    Without ``base_url`` only forms with relative actions get it.
+
+    Feed the body chunk by chunk; the output of each :meth:`feed` can be
+    written straight away. Only an unfinished ``<form`` tag at the end of a
+    chunk is held back, up to ``max_tag_size`` bytes, after which it is
+    passed through untouched. ``token`` is awaited the first time such a
+    form is seen and never otherwise.
+    """
+
+    def __init__(
+        self,
+        field_name: str,
+        token: Callable[[], Awaitable[str]],
+        max_tag_size: int = 8192,
+        base_url: Optional[URL] = None,
+    ):
+        self.field_name = field_name
+        self.max_tag_size = max_tag_size
+        self.base_url = base_url
+        self._token = token
+        self._input: Optional[bytes] = None
+        self._carry = b""
+
+    @property
+    def token_issued(self) -> bool:
+        """Whether a form was found and the token was asked for."""
+        return self._input is not None
+
+    async def _hidden_input(self) -> bytes:
+        if self._input is None:
+            token = await self._token()
+            self._input = (
+                f'<input type="hidden" name="{html.escape(self.field_name)}" '
+                f'value="{html.escape(token)}">'
+            ).encode("ascii", "xmlcharrefreplace")
+
+        return self._input
+
+    async def feed(self, chunk: bytes) -> bytes:
+        data = self._carry + chunk if self._carry else chunk
+        self._carry = b""
+
+        out = []
+        # bytes before pos have been output, and forms are searched from scan
+        pos = scan = 0
+
+        while True:
+            found = _FORM_OPEN_RE.search(data, scan)
+            if found is None:
+                break
+
+            start = found.start()
+            tag = _FORM_TAG_RE.match(data, start)
+
+            if tag is None:
+                incomplete = (
+                    len(data) == start + len(_FORM_OPEN)
+                    or data[start + len(_FORM_OPEN)] in b" \t\n\r\f/>"
+                )
+                if incomplete and len(data) - start <= self.max_tag_size:
+                    # the tag continues in the next chunk
+                    out.append(data[pos:start])
+                    self._carry = data[start:]
+                    return b"".join(out)
+
+                scan = start + len(_FORM_OPEN)
+                continue
+
+            attributes = _attributes(tag.group())
+            if attributes.get(b"method", b"").strip().lower() == b"post" and (
+                _submits_to(attributes.get(b"action"), self.base_url)
+            ):
+                out.append(data[pos : tag.end()])
+                out.append(await self._hidden_input())
+                pos = tag.end()
+            scan = tag.end()
+
+        # keep a trailing "<", "<f", ... that may be the start of a form tag
+        tail = len(data)
+        for size in range(len(_FORM_OPEN) - 1, 0, -1):
+            if len(data) - size >= scan and data[-size:].lower() == _FORM_OPEN[:size]:
+                tail = len(data) - size
+                break
+
+        out.append(data[pos:tail])
+        self._carry = data[tail:]
+
+        return b"".join(out)
+
+    def flush(self) -> bytes:
+        """Return whatever is still held back, at the end of the body."""
+        carry, self._carry = self._carry, b""
+        return carry
+
+
+def _injectable(response: web.StreamResponse) -> bool:
+    if response.content_type != "text/html":
+        return False
+    if hdrs.CONTENT_ENCODING in response.headers:
+        return False
+
+    charset = (response.charset or "").lower()
+    return not charset.startswith(_INCOMPATIBLE_CHARSETS)
+
+
+async def _no_field_name() -> str:
+    raise RuntimeError(
+        "Injecting form tokens needs a policy with a form field_name, "
+        "such as FormPolicy or FormAndHeaderPolicy"
+    )
+
+
+def _make_injector(
+    request: web.Request, token: Optional[Callable[[], Awaitable[str]]] = None
+) -> FormTokenInjector:
+    config = get_config(request)
+
+    field_name = form_field_name(config.policy)
+    if field_name is None:
+        # the token is only asked for once a POST form is found, so pages
+        # without one are passed through and only a form fails
+        return FormTokenInjector("", _no_field_name, base_url=request.url)
+
+    if token is None:
+        token = functools.partial(config.storage.generate_new_token, request)
+
+    return FormTokenInjector(field_name, token, base_url=request.url)
+
+
+@web.middleware
+async def csrf_inject_middleware(request: web.Request, handler):
+    """Add the token to same-site POST forms in ``text/html`` responses.
+
+    Install it after ``csrf_middleware`` so that it runs inside it and the
+    token it issues is saved with the response. Where nothing else saves it,
+    on exempt routes or outside a ``csrf_protect`` handler, it saves the token
+    itself. A token is only issued for pages that contain such a form.
+    Streamed responses need :class:`InjectingStreamResponse`.
+    """
+    response = await handler(request)
+
+    if (
+        isinstance(response, web.Response)
+        and not response.prepared
+        and isinstance(response.body, bytes)
+        and _injectable(response)
+    ):
+        injector = _make_injector(request)
+        response.body = await injector.feed(response.body) + injector.flush()
+
+        if injector.token_issued and REQUEST_SAVE_PENDING_KEY not in request:
+            await get_config(request).storage.save_token(request, response)
+
+    return response
+
+
+class InjectingStreamResponse(web.StreamResponse):
+    """StreamResponse that adds the token to POST forms as it is written.
+
+    The headers are sent before any of the body is seen, so for ``text/html``
+    the token is issued and saved when the response is prepared.
+    """
+
+    _injector: Optional[FormTokenInjector] = None
+
+    async def prepare(self, request):
+        if not self.prepared and _injectable(self):
+            config = get_config(request)
+            issued = None
+
+            if form_field_name(config.policy) is not None:
+                token = await config.storage.generate_new_token(request)
+                await config.storage.save_token(request, self)
+
+                async def issued() -> str:
+                    return token
+
+            self._injector = _make_injector(request, issued)
+
+        return await super().prepare(request)
+
+    async def write(self, data) -> None:
+        if self._injector is not None:
+            data = await self._injector.feed(bytes(data))
+            if not data:
+                return
+
+        await super().write(data)
+
+    async def write_eof(self, data: bytes = b"") -> None:
+        if self._injector is not None:
+            injector, self._injector = self._injector, None
+            data = await injector.feed(data) + injector.flush()
+
+        await super().write_eof(data)
@@ -0,0 +1,232 @@
+"""Signing keys with ids, so keys can be rotated while old tokens verify.
+
+``MmapKeyRing`` shares one key file between pre-forked workers. The file is
+updated in place by ``write_keyring()`` and carries a generation counter,
+used as a seqlock: it is odd while a write is in progress and bumped again
+when the write is done. Readers compare it on each lookup, which is a single
+read from the mapping, and only re-parse the keys when it has changed.
+"""
+
+import contextlib
+import mmap
+import os
+import re
+import struct
+from typing import Iterator, Mapping, Optional, Protocol, Union
+
+_MAGIC = b"aiocsrfk"
+# magic, generation, number of keys, index of the current key
+_HEADER = struct.Struct("<8sQII")
+_GENERATION = struct.Struct("<Q")
+_GENERATION_OFFSET = 8
+# kid length, kid, key length, key
+_SLOT = struct.Struct("<B32sB64s")
+_MAX_KEY_SIZE = 64
+
+MAX_KEYS = 16
+_FILE_SIZE = _HEADER.size + _SLOT.size * MAX_KEYS
+
+# key ids are embedded in tokens, so they are kept cookie and header safe
+_KID_RE = re.compile(r"[A-Za-z0-9_-]{1,32}")
+
+KeyMaterial = Union[str, bytes]
+
+
+class KeyRing(Protocol):
+    def current(self) -> tuple[str, bytes]:
+        """Return the id and key new tokens are signed with."""
+        ...
+
+    def get(self, kid: str) -> Optional[bytes]:
+        """Return the key with id ``kid``, or None if it is not in the ring."""
+        ...
+
+
+def _validate(
+    keys: Mapping[str, KeyMaterial], current: Optional[str]
+) -> tuple[str, dict[str, bytes]]:
+    if not keys:
+        raise ValueError("a key ring needs at least one key")
+    if current is None:
+        current = list(keys)[-1]
+    elif current not in keys:
+        raise ValueError(f"current key {current!r} is not in the key ring")
+
+    validated = {}
+    for kid, key in keys.items():
+        if _KID_RE.fullmatch(kid) is None:
+            raise ValueError(f"key id must be 1 to 32 of [A-Za-z0-9_-], got {kid!r}")
+        if isinstance(key, str):
+            key = key.encode("utf-8")
+        if not key:
+            raise ValueError(f"key {kid!r} is empty")
+        validated[kid] = key
+
+    return current, validated
+
+
+class StaticKeyRing:
+    """Keys fixed at startup; ``current`` defaults to the last one given."""
+
+    def __init__(self, keys: Mapping[str, KeyMaterial], current: Optional[str] = None):
+        current, self._keys = _validate(keys, current)
+        self._current = (current, self._keys[current])
+
+    def current(self) -> tuple[str, bytes]:
+        return self._current
+
+    def get(self, kid: str) -> Optional[bytes]:
+        return self._keys.get(kid)
+
+
+@contextlib.contextmanager
+def _locked(path: str) -> Iterator[mmap.mmap]:
+    import fcntl
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        # serialises writers; readers never lock and rely on the generation
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+        if os.fstat(fd).st_size < _FILE_SIZE:
+            os.ftruncate(fd, _FILE_SIZE)
+
+        with mmap.mmap(fd, _FILE_SIZE) as buf:
+            yield buf
+            buf.flush()
+    finally:
+        os.close(fd)
+
+
+def _write(
+    buf: mmap.mmap, keys: Mapping[str, KeyMaterial], current: Optional[str]
+) -> None:
+    current, validated = _validate(keys, current)
+    if len(validated) > MAX_KEYS:
+        raise ValueError(f"a key ring holds at most {MAX_KEYS} keys")
+    for kid, key in validated.items():
+        if len(key) > _MAX_KEY_SIZE:
+            raise ValueError(f"key {kid!r} is longer than {_MAX_KEY_SIZE} bytes")
+
+    magic, generation, _, _ = _HEADER.unpack_from(buf, 0)
+    if magic != _MAGIC:
+        generation = 0
+
+    # odd while the slots are rewritten
+    generation += 1 + (generation & 1)
+    _HEADER.pack_into(buf, 0, _MAGIC, generation, 0, 0)
+
+    kids = list(validated)
+    for index, kid in enumerate(kids):
+        key = validated[kid]
+        _SLOT.pack_into(
+            buf,
+            _HEADER.size + index * _SLOT.size,
+            len(kid),
+            kid.encode("ascii"),
+            len(key),
+            key,
+        )
+
+    _HEADER.pack_into(buf, 0, _MAGIC, generation, len(kids), kids.index(current))
+    # published last, once everything it covers is in place
+    _GENERATION.pack_into(buf, _GENERATION_OFFSET, generation + 1)
+
+
+def _read_keys(buf: mmap.mmap) -> tuple[Optional[str], dict[str, bytes]]:
+    magic, _, count, current = _HEADER.unpack_from(buf, 0)
+    if magic != _MAGIC or count > MAX_KEYS:
+        return None, {}
+
+    keys = {}
+    for index in range(count):
+        kid_len, kid, key_len, key = _SLOT.unpack_from(
+            buf, _HEADER.size + index * _SLOT.size
+        )
+        keys[kid[:kid_len].decode("ascii")] = key[:key_len]
+
+    return (list(keys)[current] if current < count else None), keys
+
+
+def write_keyring(
+    path: str, keys: Mapping[str, KeyMaterial], current: Optional[str] = None
+) -> None:
+    """Create or update the key file read by MmapKeyRing, in place.
+
+    ``current`` defaults to the last key given. Writers hold an exclusive
+    ``flock`` on the file, so concurrent updates do not interleave.
+    """
+    with _locked(path) as buf:
+        _write(buf, keys, current)
+
+
+def rotate_keyring(path: str, kid: str, key: KeyMaterial, keep: int = 4) -> None:
+    """Make ``kid`` the current key, keeping the ``keep`` newest old ones.
+
+    Tokens signed with a key that has dropped out no longer verify, so keep
+    enough keys to cover the tokens' ``max_age``.
+    """
+    if not 0 <= keep < MAX_KEYS:
+        raise ValueError(f"keep must be between 0 and {MAX_KEYS - 1}")
+
+    with _locked(path) as buf:
+        keys: dict[str, KeyMaterial] = dict(_read_keys(buf)[1])
+        keys.pop(kid, None)
+
+        kept = list(keys.items())[-keep:] if keep else []
+        _write(buf, dict(kept + [(kid, key)]), kid)
+
+
+class MmapKeyRing:
+    """Key ring read from a file written by ``write_keyring()``.
+
+    The file is mapped read-only once; each worker sees rotations on its next
+    lookup without a restart. Keys are parsed into a dict, so lookups by id
+    are O(1). If a read races a write, the previous keys stay in use until
+    the next lookup.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+        with open(path, "rb") as f:
+            self._buf = mmap.mmap(f.fileno(), _FILE_SIZE, access=mmap.ACCESS_READ)
+
+        self._generation = -1
+        self._keys: dict[str, bytes] = {}
+        self._current: Optional[tuple[str, bytes]] = None
+
+        self._refresh()
+        if self._current is None:
+            raise ValueError(f"{path} has no current key")
+
+    @property
+    def generation(self) -> int:
+        return _GENERATION.unpack_from(self._buf, _GENERATION_OFFSET)[0]
+
+    def _refresh(self) -> None:
+        generation = self.generation
+        if generation == self._generation or generation & 1:
+            return
+
+        current, keys = _read_keys(self._buf)
+
+        if self.generation != generation or current is None:
+            return  # rewritten while it was being read
+
+        self._keys = keys
+        self._current = (current, keys[current])
+        self._generation = generation
+
+    def current(self) -> tuple[str, bytes]:
+        self._refresh()
+
+        return self._current  # type: ignore[return-value]
+
+    def get(self, kid: str) -> Optional[bytes]:
+        self._refresh()
+
+        return self._keys.get(kid)
+
+    def close(self) -> None:
+        self._buf.close()
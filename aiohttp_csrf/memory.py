@@ -0,0 +1,284 @@
+"""Bounded in-process token table used by MemoryStorage.
+
+Entries live in a fixed number of shards, each a dict guarded by its own
+lock and paired with a timing wheel, so expiry touches only the slots whose
+time has passed instead of scanning the table.
+"""
+
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterator, Optional
+
+from .token_generator import decode_bytes, encode_bytes
+
+# Hex and base64url tokens (the bundled generators) are kept as raw bytes,
+# half or three quarters the size of the str; anything else is kept as its
+# utf-8 encoding.
+_RAW = b"\x00"
+_TEXT = b"\x01"
+_RAW_BASE64URL = b"\x02"
+
+
+def encode_token(token: str) -> bytes:
+    for tag, token_format in ((_RAW, "hex"), (_RAW_BASE64URL, "base64url")):
+        try:
+            return tag + decode_bytes(token, token_format)
+        except ValueError:
+            pass
+
+    return _TEXT + token.encode("utf-8")
+
+
+def decode_token(value: bytes) -> str:
+    tag = value[:1]
+    if tag == _RAW:
+        return value[1:].hex()
+    if tag == _RAW_BASE64URL:
+        return encode_bytes(value[1:], "base64url")
+
+    return value[1:].decode("utf-8")
+
+
+class TimingWheel:
+    """Buckets keys by expiry tick; ``advance()`` yields the keys due.
+
+    ``span`` seconds are covered by ``slots`` buckets, so the expiry
+    granularity is ``span / slots``.
+    """
+
+    def __init__(self, span: float, slots: int = 256):
+        self.resolution = max(span / slots, 0.001)
+        self._slots: list[set[str]] = [set() for _ in range(slots + 2)]
+        self._tick = int(time.time() / self.resolution)
+
+    def schedule(self, key: str, expires_at: float) -> None:
+        # the first tick that starts after expires_at, so the key is due
+        tick = max(int(expires_at / self.resolution) + 1, self._tick + 1)
+        self._slots[tick % len(self._slots)].add(key)
+
+    def advance(self, now: float) -> Iterator[str]:
+        tick = int(now / self.resolution)
+        steps = min(tick - self._tick, len(self._slots))
+
+        for step in range(steps):
+            slot = self._slots[(tick - step) % len(self._slots)]
+            if slot:
+                keys = list(slot)
+                slot.clear()
+                yield from keys
+
+        self._tick = max(tick, self._tick)
+
+
+class _Shard:
+    __slots__ = ("entries", "wheel", "lock")
+
+    def __init__(self, ttl: float, slots: int):
+        self.entries: dict[str, tuple[bytes, float]] = {}
+        self.wheel = TimingWheel(ttl, slots)
+        self.lock = threading.Lock()
+
+
+# snapshot record: key length, value length, expiry, then the key and value
+_RECORD = struct.Struct("<HId")
+_MAX_KEY_SIZE = 0xFFFF
+_HEADER = struct.Struct("<8sI")
+_MAGIC = b"CSRFSNP2"
+
+
+class ShardedTTLTable:
+    def __init__(
+        self,
+        ttl: float,
+        shards: int = 16,
+        max_entries: int = 100_000,
+        wheel_slots: int = 256,
+    ):
+        self.ttl = ttl
+        self.max_entries_per_shard = max(1, max_entries // shards)
+        self._shards = [_Shard(ttl, wheel_slots) for _ in range(shards)]
+
+    def _shard(self, key: str) -> _Shard:
+        return self._shards[hash(key) % len(self._shards)]
+
+    @staticmethod
+    def _expire(shard: _Shard, now: float) -> None:
+        for key in shard.wheel.advance(now):
+            entry = shard.entries.get(key)
+            if entry is None:
+                continue
+            if entry[1] <= now:
+                del shard.entries[key]
+            else:
+                # written again since, or beyond the wheel span: reschedule
+                shard.wheel.schedule(key, entry[1])
+
+    def get(self, key: str) -> Optional[bytes]:
+        shard = self._shard(key)
+        now = time.time()
+
+        with shard.lock:
+            self._expire(shard, now)
+            entry = shard.entries.get(key)
+
+        if entry is None or entry[1] <= now:
+            return None
+
+        return entry[0]
+
+    def set(self, key: str, value: bytes, expires_at: Optional[float] = None) -> None:
+        shard = self._shard(key)
+        now = time.time()
+
+        if expires_at is None:
+            expires_at = now + self.ttl
+
+        with shard.lock:
+            self._expire(shard, now)
+
+            shard.entries.pop(key, None)
+            shard.entries[key] = (value, expires_at)
+            shard.wheel.schedule(key, expires_at)
+
+            if len(shard.entries) > self.max_entries_per_shard:
+                # evict the least recently written entry
+                del shard.entries[next(iter(shard.entries))]
+
+    def __len__(self) -> int:
+        return sum(len(shard.entries) for shard in self._shards)
+
+    def items(self) -> Iterator[tuple[str, bytes, float]]:
+        for shard in self._shards:
+            with shard.lock:
+                entries = list(shard.entries.items())
+            for key, (value, expires_at) in entries:
+                yield key, value, expires_at
+
+    def dump(self, path: str) -> None:
+        """Write live entries to ``path`` through a memory map, atomically.
+
+        Records are sized to their data. Only an entry with a key over 65535
+        bytes can not be written; it is skipped and logged.
+        """
+        now = time.time()
+        records = []
+        skipped = 0
+
+        for key, value, expires_at in self.items():
+            if expires_at <= now:
+                continue
+
+            encoded_key = key.encode("utf-8")
+            if len(encoded_key) > _MAX_KEY_SIZE:
+                skipped += 1
+                continue
+
+            records.append((encoded_key, value, expires_at))
+
+        if skipped:
+            logging.warning(
+                "%d CSRF token(s) left out of the snapshot, their keys are "
+                "longer than %d bytes",
+                skipped,
+                _MAX_KEY_SIZE,
+            )
+
+        size = _HEADER.size + sum(
+            _RECORD.size + len(raw_key) + len(raw_value)
+            for raw_key, raw_value, _ in records
+        )
+        tmp_path = f"{path}.tmp"
+
+        with open(tmp_path, "w+b") as f:
+            f.truncate(size)
+            with mmap.mmap(f.fileno(), size) as buf:
+                _HEADER.pack_into(buf, 0, _MAGIC, len(records))
+                offset = _HEADER.size
+                for raw_key, raw_value, expires_at in records:
+                    _RECORD.pack_into(
+                        buf, offset, len(raw_key), len(raw_value), expires_at
+                    )
+                    offset += _RECORD.size
+                    buf[offset : offset + len(raw_key)] = raw_key
+                    offset += len(raw_key)
+                    buf[offset : offset + len(raw_value)] = raw_value
+                    offset += len(raw_value)
+                buf.flush()
+
+        os.replace(tmp_path, path)
+
+    def load(self, path: str) -> None:
+        """Restore unexpired entries written by ``dump()``."""
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return
+
+        now = time.time()
+
+        with f:
+            if os.fstat(f.fileno()).st_size < _HEADER.size:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                magic, count = _HEADER.unpack_from(buf, 0)
+                if magic != _MAGIC:
+                    return
+
+                offset = _HEADER.size
+                for _ in range(count):
+                    if offset + _RECORD.size > len(buf):
+                        return  # truncated
+                    key_len, value_len, expires_at = _RECORD.unpack_from(buf, offset)
+                    offset += _RECORD.size
+
+                    end = offset + key_len + value_len
+                    if end > len(buf):
+                        return
+                    if expires_at > now:
+                        self.set(
+                            buf[offset : offset + key_len].decode("utf-8"),
+                            buf[offset + key_len : end],
+                            expires_at,
+                        )
+                    offset = end
+
+
+class LRUTokenCache:
+    """Bounded LRU cache of tokens with a time-to-live, counting hits."""
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[bytes, tuple[str, float]] = OrderedDict()
+
+    def get(self, key: bytes) -> Optional[str]:
+        entry = self._entries.get(key)
+
+        if entry is None or entry[1] <= time.monotonic():
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+
+        return entry[0]
+
+    def set(self, key: bytes, token: str) -> None:
+        self._entries[key] = (token, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: bytes) -> None:
+        self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,131 @@
+import bisect
+import time
+from typing import Any, Optional, Protocol
+
+from aiohttp import web
+
+from .policy import Reason
+
+# Latency histograms are named after the stages in aiohttp_csrf.tracing and
+# recorded in seconds. These are the counters:
+TOKENS_GENERATED = "tokens_generated"
+TOKEN_WRITES = "token_writes"
+CHECK_FAILURES = "check_failures"
+
+DEFAULT_BUCKETS = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    float("inf"),
+)
+
+
+class AbstractMetrics(Protocol):
+    def observe(self, name: str, seconds: float) -> None: ...
+
+    def increment(self, name: str, reason: Optional[Reason] = None) -> None: ...
+
+
+class NoopMetrics:
+    """Collector that drops everything; subclass it to handle only some calls."""
+
+    def observe(self, name: str, seconds: float) -> None:
+        pass
+
+    def increment(self, name: str, reason: Optional[Reason] = None) -> None:
+        pass
+
+
+class MetricsTracer:
+    """Feed stage latencies into a metrics collector's histograms."""
+
+    def __init__(self, metrics: AbstractMetrics):
+        self.metrics = metrics
+
+    def start(self, request: web.Request, stage: str) -> float:
+        return time.perf_counter()
+
+    def end(
+        self,
+        request: web.Request,
+        stage: str,
+        span: float,
+        exc: Optional[BaseException],
+    ) -> None:
+        self.metrics.observe(stage, time.perf_counter() - span)
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def snapshot(self) -> dict[str, Any]:
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            buckets[bound] = cumulative
+
+        return {"count": cumulative, "sum": self.sum, "buckets": buckets}
+
+
+class InMemoryMetrics:
+    """Collect histograms and counters in process memory.
+
+    ``snapshot()`` returns plain dicts, for a status endpoint or to feed
+    another metrics system. Histogram buckets are cumulative, keyed by their
+    upper bound in seconds, as in Prometheus.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        if list(buckets) != sorted(buckets) or buckets[-1] != float("inf"):
+            raise ValueError("buckets must be sorted and end with inf")
+
+        self.buckets = buckets
+        self._histograms: dict[str, _Histogram] = {}
+        self._counters: dict[str, int] = {}
+        self._failures: dict[Reason, int] = {}
+
+    def observe(self, name: str, seconds: float) -> None:
+        try:
+            histogram = self._histograms[name]
+        except KeyError:
+            histogram = self._histograms[name] = _Histogram(self.buckets)
+
+        histogram.observe(seconds)
+
+    def increment(self, name: str, reason: Optional[Reason] = None) -> None:
+        self._counters[name] = self._counters.get(name, 0) + 1
+
+        if reason is not None:
+            self._failures[reason] = self._failures.get(reason, 0) + 1
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "histograms": {
+                name: histogram.snapshot()
+                for name, histogram in self._histograms.items()
+            },
+            "counters": dict(self._counters),
+            "failures": {
+                reason.value: count for reason, count in self._failures.items()
+            },
+        }
@@ -1,60 +1,533 @@
+import enum
 import logging
-from secrets import compare_digest
-from typing import Protocol
+from typing import Awaitable, Callable, Iterable, Optional, Protocol, Union
 
-from aiohttp import web
+from aiohttp import BodyPartReader, MultipartReader, hdrs, web
+from multidict import MultiDict
+from yarl import URL
+
+from .token_generator import OriginalToken, match_token
+
+REQUEST_MULTIPART_KEY = "aiohttp_csrf_multipart"
+REQUEST_FORM_TOKEN_KEY = "aiohttp_csrf_form_token"
+REQUEST_FORM_PREFIX_KEY = "aiohttp_csrf_form_prefix"
+
+
+class Reason(enum.Enum):
+    """Outcome of a policy check. Only ``Reason.OK`` is truthy."""
+
+    OK = "ok"
+    MISSING_HEADER = "missing_header"
+    MISSING_FIELD = "missing_field"
+    MISSING_ORIGIN = "missing_origin"
+    UNTRUSTED_ORIGIN = "untrusted_origin"
+    NO_STORED_TOKEN = "no_stored_token"
+    MISMATCH = "mismatch"
+    # the token was revoked, checked before the policy runs
+    REVOKED = "revoked"
+    # a policy answered with a bare False
+    REJECTED = "rejected"
+
+    def __bool__(self) -> bool:
+        return self is Reason.OK
+
+
+PolicyResult = Union[bool, Reason]
+
+
+def as_reason(result: PolicyResult) -> Reason:
+    """Return the Reason for a check result, which may be a plain bool."""
+    if isinstance(result, Reason):
+        return result
+    return Reason.OK if result else Reason.REJECTED
+
+
+def form_field_name(policy: "AbstractPolicy") -> Optional[str]:
+    """Return the form field a policy reads the token from, if it has one.
+
+    The policies inside AnyOf and AllOf are searched in order.
+    """
+    field_name = getattr(policy, "field_name", None)
+    if field_name is not None:
+        return field_name
+
+    for member in getattr(policy, "policies", ()):
+        field_name = form_field_name(member)
+        if field_name is not None:
+            return field_name
+
+    return None
+
+
+def _match(token: str, original_value: OriginalToken) -> Reason:
+    if not original_value:
+        return Reason.NO_STORED_TOKEN
+    if match_token(token, original_value):
+        return Reason.OK
+    return Reason.MISMATCH
 
 
 class AbstractPolicy(Protocol):
-    async def check(self, request: web.Request, original_value: str) -> bool: ...
+    async def check(
+        self, request: web.Request, original_value: OriginalToken
+    ) -> PolicyResult: ...
+
+
+# check() returns a Reason; plain bools are accepted from custom policies.
+# Policies may also implement
+#
+#     async def check_headers(self, request, original_value)
+#         -> Optional[PolicyResult]
+#
+# deciding from the request line and headers alone, before any body is read.
+# It returns None when the body is needed to decide.
+#
+# A policy that sets ``requires_token = False`` is checked without reading the
+# token from storage, and receives an empty original_value.
+#
+# ``cost`` orders policies inside AnyOf / AllOf, cheapest first; policies
+# without it are assumed to read the body.
+#
+# AnyOf and AllOf also implement check_lazily() and check_headers_lazily(),
+# taking a LazyOriginalToken instead, so that storage is only read once a
+# member that requires the token is reached.
+
+COST_HEADERS = 0
+COST_TOKEN = 1
+COST_BODY = 2
+
+
+async def get_multipart_reader(request: web.Request) -> MultipartReader:
+    """Return the multipart reader for the request body.
+
+    When a streaming FormPolicy has already scanned the body for the token,
+    this is the same reader positioned after the token part, so a handler can
+    keep reading the remaining parts.
+    """
+    try:
+        return request[REQUEST_MULTIPART_KEY]
+    except KeyError:
+        return await request.multipart()
+
+
+def get_scanned_fields(request: web.Request) -> "MultiDict[bytes]":
+    """Return the multipart fields read before the token part, if any."""
+    return request.get(REQUEST_FORM_PREFIX_KEY, MultiDict())
+
+
+async def _read_part(part: BodyPartReader, limit: int) -> Optional[bytes]:
+    data = bytearray()
+
+    while True:
+        chunk = await part.read_chunk()
+        if not chunk:
+            return bytes(data)
+
+        data += chunk
+        if len(data) > limit:
+            return None
 
 
 class FormPolicy:
-    def __init__(self, field_name: str):
+    cost = COST_BODY
+
+    def __init__(
+        self,
+        field_name: str,
+        streaming: bool = False,
+        max_parts: int = 1,
+        max_scan_bytes: int = 64 * 1024,
+    ):
         self.field_name = field_name
+        self.streaming = streaming
+        self.max_parts = max_parts
+        self.max_scan_bytes = max_scan_bytes
 
-    async def check(self, request: web.Request, original_value: str) -> bool:
+    async def _scan_multipart(self, request: web.Request) -> Optional[str]:
+        # Read parts until the token field turns up, giving up after
+        # max_parts parts or max_scan_bytes bytes. Parts before the token are
+        # kept for the handler, and the reader is left where we stopped.
+        if REQUEST_MULTIPART_KEY in request:
+            return request.get(REQUEST_FORM_TOKEN_KEY)
+
+        reader = request[REQUEST_MULTIPART_KEY] = await request.multipart()
+        prefix: MultiDict[bytes] = MultiDict()
+        request[REQUEST_FORM_PREFIX_KEY] = prefix
+
+        remaining = self.max_scan_bytes
+
+        for _ in range(self.max_parts):
+            part = await reader.next()
+            if not isinstance(part, BodyPartReader):
+                return None
+
+            data = await _read_part(part, remaining)
+            if data is None:
+                return None
+            remaining -= len(data)
+
+            if part.name != self.field_name:
+                prefix.add(part.name or "", data)
+                continue
+
+            try:
+                token = data.decode(part.get_charset(default="utf-8"))
+            except (LookupError, UnicodeDecodeError):
+                return None
+
+            request[REQUEST_FORM_TOKEN_KEY] = token
+
+            return token
+
+        return None
+
+    async def check_headers(
+        self, request: web.Request, original_value: OriginalToken
+    ) -> Optional[PolicyResult]:
+        get = request.match_info.get(self.field_name, None)
+        if get is None:
+            return None
+        return _match(get, original_value)
+
+    async def check(
+        self, request: web.Request, original_value: OriginalToken
+    ) -> PolicyResult:
         get = request.match_info.get(self.field_name, None)
+
+        if (
+            get is None
+            and self.streaming
+            and request.content_type == "multipart/form-data"
+        ):
+            scanned = await self._scan_multipart(request)
+            if scanned is None:
+                logging.debug("CSRF failure: Missing token in scanned form parts")
+                return Reason.MISSING_FIELD
+            return _match(scanned, original_value)
+
         post_req = await request.post() if get is None else None
         post = post_req.get(self.field_name) if post_req is not None else None
         post = post if post is not None else ""
         token = get if get is not None else post
-        if not isinstance(token, str):
+        if not isinstance(token, str) or not token:
             logging.debug("CSRF failure: Missing token on request form")
-            return False
-        return compare_digest(token, original_value)
+            return Reason.MISSING_FIELD
+        return _match(token, original_value)
 
 
 class HeaderPolicy:
+    cost = COST_TOKEN
+
     def __init__(self, header_name: str):
         self.header_name = header_name
 
-    async def check(self, request: web.Request, original_value: str) -> bool:
+    async def check(
+        self, request: web.Request, original_value: OriginalToken
+    ) -> PolicyResult:
         token = request.headers.get(self.header_name)
         if not isinstance(token, str):
             logging.debug("CSRF failure: Missing token on request headers")
-            return False
-        return compare_digest(token, original_value)
+            return Reason.MISSING_HEADER
+        return _match(token, original_value)
 
+    async def check_headers(
+        self, request: web.Request, original_value: OriginalToken
+    ) -> Optional[PolicyResult]:
+        return await self.check(request, original_value)
 
-class FormAndHeaderPolicy(HeaderPolicy, FormPolicy):
-    def __init__(self, header_name: str, field_name: str):
-        self.header_name = header_name
-        self.field_name = field_name
 
-    async def check(self, request: web.Request, original_value: str) -> bool:
-        header_check = await HeaderPolicy.check(
-            self,
-            request,
-            original_value,
+def _origin(value: str) -> Optional[str]:
+    try:
+        url = URL(value)
+    except ValueError:
+        return None
+
+    if not url.absolute:
+        return None
+
+    return str(url.origin())
+
+
+class OriginPolicy:
+    """Check where a request comes from instead of comparing a token.
+
+    Requests are accepted when the browser reports ``Sec-Fetch-Site:
+    same-origin`` (or ``none``, for user-initiated navigation), or when the
+    ``Origin`` header, falling back to ``Referer``, names this site or one of
+    ``trusted_origins``. Requests carrying none of these headers are rejected.
+    The site's own origin is taken from ``X-Forwarded-Host`` / ``Forwarded``
+    only for requests arriving from one of ``trusted_proxies``.
+    """
+
+    requires_token = False
+    cost = COST_HEADERS
+
+    def __init__(
+        self,
+        trusted_origins: Iterable[str] = (),
+        trusted_proxies: Iterable[str] = (),
+    ):
+        origins = frozenset(_origin(origin) for origin in trusted_origins)
+        if None in origins:
+            raise ValueError("trusted_origins must be absolute URLs")
+
+        self.trusted_origins = origins
+        self.trusted_proxies = frozenset(trusted_proxies)
+
+    def _own_origin(self, request: web.Request) -> Optional[str]:
+        scheme, host = request.scheme, request.host
+
+        if request.remote in self.trusted_proxies:
+            forwarded = request.forwarded
+            if forwarded:
+                scheme = forwarded[0].get("proto", scheme)
+                host = forwarded[0].get("host", host)
+            else:
+                header = request.headers.get(hdrs.X_FORWARDED_PROTO)
+                if header:
+                    scheme = header.split(",", 1)[0].strip()
+                header = request.headers.get(hdrs.X_FORWARDED_HOST)
+                if header:
+                    host = header.split(",", 1)[0].strip()
+
+        return _origin(f"{scheme}://{host}")
+
+    async def check(
+        self, request: web.Request, original_value: OriginalToken
+    ) -> PolicyResult:
+        if request.headers.get("Sec-Fetch-Site") in ("same-origin", "none"):
+            return Reason.OK
+
+        source = request.headers.get(hdrs.ORIGIN)
+        if source is None or source == "null":
+            source = request.headers.get(hdrs.REFERER)
+
+        if not source:
+            logging.debug("CSRF failure: Missing Origin and Referer headers")
+            return Reason.MISSING_ORIGIN
+
+        origin = _origin(source)
+        if origin is None:
+            logging.debug("CSRF failure: Malformed Origin or Referer header")
+            return Reason.UNTRUSTED_ORIGIN
+
+        if origin in self.trusted_origins or origin == self._own_origin(request):
+            return Reason.OK
+
+        logging.debug("CSRF failure: Untrusted origin %s", origin)
+        return Reason.UNTRUSTED_ORIGIN
+
+    async def check_headers(
+        self, request: web.Request, original_value: OriginalToken
+    ) -> Optional[PolicyResult]:
+        return await self.check(request, original_value)
+
+
+def _cost(policy: AbstractPolicy) -> int:
+    return getattr(policy, "cost", COST_BODY)
+
+
+class LazyOriginalToken:
+    """The stored token, read through ``load`` the first time it is needed.
+
+    ``load`` returns None for a revoked token. The result is kept, so storage
+    is read at most once however many policies ask.
+    """
+
+    __slots__ = ("_load", "_value", "loaded")
+
+    def __init__(self, load: Callable[[], Awaitable[Optional[OriginalToken]]]):
+        self._load = load
+        self._value: Optional[OriginalToken] = None
+        self.loaded = False
+
+    @classmethod
+    def of(cls, original_value: OriginalToken) -> "LazyOriginalToken":
+        token = cls(_never_loaded)
+        token._value = original_value
+        token.loaded = True
+        return token
+
+    async def get(self) -> Optional[OriginalToken]:
+        if not self.loaded:
+            self._value = await self._load()
+            self.loaded = True
+
+        return self._value
+
+
+async def _never_loaded() -> Optional[OriginalToken]:  # pragma: no cover
+    raise AssertionError("the token was given up front")
+
+
+async def check_policy(
+    policy: AbstractPolicy, request: web.Request, token: LazyOriginalToken
+) -> PolicyResult:
+    """Run ``policy``, reading ``token`` only if the policy requires it."""
+    check_lazily = getattr(policy, "check_lazily", None)
+    if check_lazily is not None:
+        return await check_lazily(request, token)
+
+    if not getattr(policy, "requires_token", True):
+        return await policy.check(request, "")
+
+    original_value = await token.get()
+    if original_value is None:
+        return Reason.REVOKED
+
+    return await policy.check(request, original_value)
+
+
+async def check_policy_headers(
+    policy: AbstractPolicy, request: web.Request, token: LazyOriginalToken
+) -> Optional[PolicyResult]:
+    """Like check_policy(), with the policy's check_headers(), if any."""
+    check_headers_lazily = getattr(policy, "check_headers_lazily", None)
+    if check_headers_lazily is not None:
+        return await check_headers_lazily(request, token)
+
+    check_headers = getattr(policy, "check_headers", None)
+    if check_headers is None:
+        return None
+
+    if not getattr(policy, "requires_token", True):
+        return await check_headers(request, "")
+
+    original_value = await token.get()
+    if original_value is None:
+        return Reason.REVOKED
+
+    return await check_headers(request, original_value)
+
+
+def _worse(failure: Optional[PolicyResult], result: PolicyResult) -> PolicyResult:
+    # When every policy rejects, report a token that was presented and did not
+    # match, or was revoked, over one that was simply absent.
+    if failure is None or as_reason(result) in (Reason.MISMATCH, Reason.REVOKED):
+        return result
+    return failure
+
+
+class _CombinedPolicy:
+    def __init__(self, *policies: AbstractPolicy):
+        if not policies:
+            raise TypeError("at least one policy is required")
+
+        # sorted() is stable, so equal-cost policies keep their given order
+        self.policies = tuple(sorted(policies, key=_cost))
+        self.requires_token = any(
+            getattr(policy, "requires_token", True) for policy in self.policies
         )
+        self.cost = max(_cost(policy) for policy in self.policies)
+
+    async def check_lazily(
+        self, request: web.Request, token: LazyOriginalToken
+    ) -> PolicyResult:
+        raise NotImplementedError
+
+    async def check_headers_lazily(
+        self, request: web.Request, token: LazyOriginalToken
+    ) -> Optional[PolicyResult]:
+        raise NotImplementedError
+
+    async def check(
+        self, request: web.Request, original_value: OriginalToken
+    ) -> PolicyResult:
+        return await self.check_lazily(request, LazyOriginalToken.of(original_value))
+
+    async def check_headers(
+        self, request: web.Request, original_value: OriginalToken
+    ) -> Optional[PolicyResult]:
+        return await self.check_headers_lazily(
+            request, LazyOriginalToken.of(original_value)
+        )
+
+
+class AnyOf(_CombinedPolicy):
+    """Accept the request if any policy accepts it, trying the cheapest first.
+
+    The stored token is read when the first policy requiring it is reached,
+    at most once, and shared by the rest, so an origin match never pays for
+    a storage read and a header match never pays for parsing the body.
+    """
+
+    async def check_lazily(
+        self, request: web.Request, token: LazyOriginalToken
+    ) -> PolicyResult:
+        failure: Optional[PolicyResult] = None
+
+        for policy in self.policies:
+            result = await check_policy(policy, request, token)
+            if result:
+                return result
+            failure = _worse(failure, result)
 
-        if header_check:
-            return True
+        return Reason.REJECTED if failure is None else failure
 
-        form_check = await FormPolicy.check(self, request, original_value)
+    async def check_headers_lazily(
+        self, request: web.Request, token: LazyOriginalToken
+    ) -> Optional[PolicyResult]:
+        failure: Optional[PolicyResult] = None
+        undecided = False
 
-        if form_check:
-            return True
+        for policy in self.policies:
+            decided = await check_policy_headers(policy, request, token)
+            if decided:
+                return decided
+            if decided is None:
+                undecided = True
+            else:
+                failure = _worse(failure, decided)
 
-        return False
+        if undecided:
+            return None
+        return Reason.REJECTED if failure is None else failure
+
+
+class AllOf(_CombinedPolicy):
+    """Accept the request only if every policy accepts it.
+
+    Policies run cheapest first and evaluation stops at the first rejection.
+    """
+
+    async def check_lazily(
+        self, request: web.Request, token: LazyOriginalToken
+    ) -> PolicyResult:
+        for policy in self.policies:
+            result = await check_policy(policy, request, token)
+            if not result:
+                return result
+
+        return Reason.OK
+
+    async def check_headers_lazily(
+        self, request: web.Request, token: LazyOriginalToken
+    ) -> Optional[PolicyResult]:
+        result: Optional[PolicyResult] = Reason.OK
+
+        for policy in self.policies:
+            decided = await check_policy_headers(policy, request, token)
+            if decided is None:
+                result = None
+            elif not decided:
+                return decided
+
+        return result
+
+
+class FormAndHeaderPolicy(AnyOf):
+    def __init__(
+        self,
+        header_name: str,
+        field_name: str,
+        streaming: bool = False,
+        max_parts: int = 1,
+        max_scan_bytes: int = 64 * 1024,
+    ):
+        self.header_name = header_name
+        self.field_name = field_name
+
+        super().__init__(
+            HeaderPolicy(header_name),
+            FormPolicy(field_name, streaming, max_parts, max_scan_bytes),
+        )
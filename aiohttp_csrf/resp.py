@@ -0,0 +1,197 @@
+"""Minimal pooled, pipelining client for the Redis protocol (RESP2).
+
+Only what the token storage needs: commands are sent as soon as they are
+issued, replies are matched to callers in order, so concurrent requests
+share connections without waiting for each other's round trips.
+"""
+
+import asyncio
+from collections import deque
+from typing import Any, Optional, Union
+
+Arg = Union[str, bytes, int]
+
+
+class RedisError(Exception):
+    pass
+
+
+def _encode(args: tuple[Arg, ...]) -> bytes:
+    out = [b"*%d\r\n" % len(args)]
+
+    for arg in args:
+        if isinstance(arg, int):
+            arg = str(arg).encode()
+        elif isinstance(arg, str):
+            arg = arg.encode()
+        out.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+
+    return b"".join(out)
+
+
+async def _read_reply(reader: asyncio.StreamReader) -> Any:
+    line = await reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Connection closed by server")
+
+    kind, payload = line[:1], line[1:-2]
+
+    if kind == b"+":
+        return payload.decode()
+    if kind == b"-":
+        # returned rather than raised, so the connection stays usable
+        return RedisError(payload.decode())
+    if kind == b":":
+        return int(payload)
+    if kind == b"$":
+        size = int(payload)
+        if size < 0:
+            return None
+        return (await reader.readexactly(size + 2))[:-2]
+    if kind == b"*":
+        size = int(payload)
+        if size < 0:
+            return None
+        return [await _read_reply(reader) for _ in range(size)]
+
+    raise RedisError(f"Unexpected reply: {line!r}")
+
+
+class RedisConnection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+        self._pending: deque[asyncio.Future[Any]] = deque()
+        self._closed = False
+        self._reader_task = asyncio.ensure_future(self._read_replies())
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    async def execute(self, *args: Arg) -> Any:
+        if self._closed:
+            raise ConnectionError("Connection is closed")
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(future)
+        self._writer.write(_encode(args))
+
+        try:
+            # waits only while the transport is above its high-water mark,
+            # so a slow server can not make the write buffer grow unbounded
+            await self._writer.drain()
+        except BaseException:
+            # the reply, if one ever comes, is dropped by _read_replies
+            future.cancel()
+            raise
+
+        reply = await future
+        if isinstance(reply, RedisError):
+            raise reply
+
+        return reply
+
+    async def _read_replies(self) -> None:
+        try:
+            while True:
+                reply = await _read_reply(self._reader)
+                future = self._pending.popleft()
+                # the caller may have been cancelled while waiting
+                if not future.done():
+                    future.set_result(reply)
+        except (Exception, asyncio.CancelledError) as exc:
+            self._closed = True
+            while self._pending:
+                future = self._pending.popleft()
+                if not future.done():
+                    future.set_exception(ConnectionError(str(exc)))
+
+    async def close(self) -> None:
+        self._closed = True
+        self._writer.close()
+        self._reader_task.cancel()
+
+        try:
+            await self._writer.wait_closed()
+        except (ConnectionError, OSError):  # pragma: no cover
+            pass
+
+
+class RedisClient:
+    """Pool of pipelining connections to one Redis server.
+
+    Connections are opened lazily, up to ``max_connections``, and each
+    command goes to the connection with the fewest replies outstanding.
+    """
+
+    def __init__(
+        self,
+        host: str = "localhost",
+        port: int = 6379,
+        db: int = 0,
+        password: Optional[str] = None,
+        max_connections: int = 4,
+    ):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.max_connections = max_connections
+
+        self._connections: list[RedisConnection] = []
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def _open(self) -> RedisConnection:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        connection = RedisConnection(reader, writer)
+
+        try:
+            if self.password is not None:
+                await connection.execute("AUTH", self.password)
+            if self.db:
+                await connection.execute("SELECT", self.db)
+        except (Exception, asyncio.CancelledError):
+            # never handed out, so nothing else would close it
+            await connection.close()
+            raise
+
+        return connection
+
+    async def _connection(self) -> RedisConnection:
+        connections = self._connections = [
+            connection for connection in self._connections if not connection.closed
+        ]
+
+        idle = min(connections, key=lambda c: c.pending, default=None)
+        if idle is not None and (
+            idle.pending == 0 or len(connections) >= self.max_connections
+        ):
+            return idle
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            if len(self._connections) >= self.max_connections:
+                return min(self._connections, key=lambda c: c.pending)
+
+            connection = await self._open()
+            self._connections.append(connection)
+
+            return connection
+
+    async def execute(self, *args: Arg) -> Any:
+        connection = await self._connection()
+
+        return await connection.execute(*args)
+
+    async def close(self) -> None:
+        connections, self._connections = self._connections, []
+
+        for connection in connections:
+            await connection.close()
@@ -0,0 +1,214 @@
+"""Revoked tokens, rejected by every worker that maps the same file.
+
+``SharedRevocationFilter`` keeps a Bloom filter and an exact table of token
+digests in one memory-mapped file. A check hashes the token once, tests a
+few bits and, only when they are all set, probes a bounded run of table
+slots, so it costs O(1) and no backend query. Writers serialise on an
+exclusive ``flock``; readers never lock. An entry is written to the table
+before its bits are set, so a reader that sees the bits also finds the
+entry.
+"""
+
+import contextlib
+import math
+import mmap
+import os
+import struct
+import time
+from typing import Iterator, Optional, Protocol
+
+from blake3 import blake3
+
+from .token_generator import TokenVerifier
+
+_MAGIC = b"aiocsrfr"
+# magic, table slots, Bloom filter bits, hashes per token
+_HEADER = struct.Struct("<8sIII")
+# token fingerprint, expiry time; all zeros when the slot was never used
+_SLOT = struct.Struct("<16sd")
+
+
+class AbstractRevocation(Protocol):
+    def is_revoked(self, token: str) -> bool: ...
+
+    def revoke(self, token: str, ttl: Optional[float] = None) -> None: ...
+
+
+class RevocationTableFull(RuntimeError):
+    pass
+
+
+class RevocationCheckingVerifier:
+    """Wraps a storage's verifier so that revoked tokens fail verification."""
+
+    def __init__(self, verifier: TokenVerifier, revocation: AbstractRevocation):
+        self.verifier = verifier
+        self.revocation = revocation
+
+    def verify(self, token: str) -> bool:
+        return not self.revocation.is_revoked(token) and self.verifier.verify(token)
+
+
+def _hash(token: str) -> tuple[bytes, int]:
+    digest = blake3(token.encode("utf-8")).digest(length=24)
+
+    # the fingerprint kept in the table, and where its probe run starts
+    return digest[:16], int.from_bytes(digest[16:], "little")
+
+
+def _bloom_hashes(fingerprint: bytes) -> tuple[int, int]:
+    # taken from the fingerprint, so compact() can rebuild the filter from
+    # the table alone
+    return (
+        int.from_bytes(fingerprint[:8], "little"),
+        int.from_bytes(fingerprint[8:], "little") | 1,
+    )
+
+
+class SharedRevocationFilter:
+    """Revoked tokens shared between processes through the file at ``path``.
+
+    Room is made for ``capacity`` live revocations; the file is a little over
+    ``capacity * (48 + bits_per_token / 8)`` bytes. Revocations expire after
+    ``ttl`` seconds, which should be at least as long as tokens stay valid,
+    and their slots are then reused. Bits of expired entries stay set until
+    :meth:`compact` is called, so the false positive rate, but not the
+    result, drifts upwards in between.
+
+    Every process must be given the same sizes for the same file.
+    """
+
+    max_probes = 32
+
+    def __init__(
+        self,
+        path: str,
+        capacity: int = 65536,
+        ttl: float = 86400,
+        bits_per_token: int = 10,
+    ):
+        if capacity < 1 or bits_per_token < 1:
+            raise ValueError("capacity and bits_per_token must be positive")
+
+        self.path = path
+        self.ttl = ttl
+
+        # a table twice the capacity keeps probe runs short
+        self._table_size = 2 * capacity
+        self._bloom_bits = capacity * bits_per_token
+        self._hashes = max(1, round(bits_per_token * math.log(2)))
+
+        self._bloom_offset = _HEADER.size
+        self._table_offset = self._bloom_offset + -(-self._bloom_bits // 8)
+        size = self._table_offset + self._table_size * _SLOT.size
+
+        header = _HEADER.pack(_MAGIC, self._table_size, self._bloom_bits, self._hashes)
+
+        with self._locked() as fd:
+            existing = os.fstat(fd).st_size
+            if existing == 0:
+                os.ftruncate(fd, size)
+                os.pwrite(fd, header, 0)
+            elif existing != size or os.pread(fd, _HEADER.size, 0) != header:
+                raise ValueError(f"{path} was created with different sizes")
+
+            self._buf = mmap.mmap(fd, size)
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[int]:
+        import fcntl
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield fd
+        finally:
+            # explicitly, since a mapping made from fd keeps the lock alive
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _bits(self, fingerprint: bytes) -> Iterator[tuple[int, int]]:
+        h1, h2 = _bloom_hashes(fingerprint)
+        offset = self._bloom_offset
+        for i in range(self._hashes):
+            bit = (h1 + i * h2) % self._bloom_bits
+            yield offset + (bit >> 3), 1 << (bit & 7)
+
+    def _slots(self, position: int) -> Iterator[int]:
+        for probe in range(self.max_probes):
+            index = (position + probe) % self._table_size
+            yield self._table_offset + index * _SLOT.size
+
+    def is_revoked(self, token: str) -> bool:
+        fingerprint, position = _hash(token)
+
+        buf = self._buf
+        for byte, mask in self._bits(fingerprint):
+            if not buf[byte] & mask:
+                return False
+
+        now = time.time()
+        for offset in self._slots(position):
+            slot_fingerprint, expires_at = _SLOT.unpack_from(buf, offset)
+            if expires_at == 0:
+                return False  # never used, the run ends here
+            if slot_fingerprint == fingerprint:
+                return expires_at > now
+
+        return False
+
+    def revoke(self, token: str, ttl: Optional[float] = None) -> None:
+        fingerprint, position = _hash(token)
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+
+        buf = self._buf
+        with self._locked():
+            now = time.time()
+            free = None
+
+            for offset in self._slots(position):
+                slot_fingerprint, slot_expires_at = _SLOT.unpack_from(buf, offset)
+                if slot_fingerprint == fingerprint and slot_expires_at != 0:
+                    free = offset
+                    expires_at = max(expires_at, slot_expires_at)
+                    break
+                if free is None and slot_expires_at <= now:
+                    free = offset
+                if slot_expires_at == 0:
+                    break
+
+            if free is None:
+                raise RevocationTableFull(
+                    f"no free slot for a revocation in {self.path}, raise capacity"
+                )
+
+            _SLOT.pack_into(buf, free, fingerprint, expires_at)
+
+            for byte, mask in self._bits(fingerprint):
+                buf[byte] |= mask
+
+    def compact(self) -> None:
+        """Rebuild the Bloom filter from the revocations that have not expired.
+
+        Bits of live entries are set both before and after, and the filter is
+        replaced a byte at a time, so concurrent checks never miss one.
+        """
+        bloom = bytearray(self._table_offset - self._bloom_offset)
+
+        buf = self._buf
+        with self._locked():
+            now = time.time()
+
+            for index in range(self._table_size):
+                offset = self._table_offset + index * _SLOT.size
+                fingerprint, expires_at = _SLOT.unpack_from(buf, offset)
+                if expires_at <= now:
+                    continue
+
+                for byte, mask in self._bits(fingerprint):
+                    bloom[byte - self._bloom_offset] |= mask
+
+            buf[self._bloom_offset : self._table_offset] = bytes(bloom)
+
+    def close(self) -> None:
+        self._buf.close()
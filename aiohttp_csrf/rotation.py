@@ -0,0 +1,98 @@
+import time
+from collections import OrderedDict
+from typing import Optional, Protocol
+
+
+class RotationPolicy(Protocol):
+    def should_rotate(self, token: str) -> bool: ...
+
+    def token_issued(self, token: str) -> None: ...
+
+    def token_used(self, token: str) -> None: ...
+
+
+class PerRequestRotation:
+    """Issue a fresh token for every checked request (the default)."""
+
+    def should_rotate(self, token: str) -> bool:
+        return True
+
+    def token_issued(self, token: str) -> None:
+        pass
+
+    def token_used(self, token: str) -> None:
+        pass
+
+
+class PerSessionRotation:
+    """Keep the stored token for as long as the storage holds it."""
+
+    def should_rotate(self, token: str) -> bool:
+        return False
+
+    def token_issued(self, token: str) -> None:
+        pass
+
+    def token_used(self, token: str) -> None:
+        pass
+
+
+class _TrackingRotation:
+    # Token state lives in this process only, in an LRU table bounded to
+    # max_tokens entries. Only tokens this process issued are tracked, so
+    # cookie values sent by clients never take up room. A token it does not
+    # know (issued by another worker, before a restart, or evicted) is due
+    # for rotation, and its replacement is tracked from then on.
+
+    def __init__(self, max_tokens: int = 65536):
+        self.max_tokens = max_tokens
+        self._tokens: OrderedDict[str, list[float]] = OrderedDict()
+
+    def _state(self, token: str) -> Optional[list[float]]:
+        state = self._tokens.get(token)
+
+        if state is not None:
+            self._tokens.move_to_end(token)
+
+        return state
+
+    def token_issued(self, token: str) -> None:
+        self._tokens[token] = [time.monotonic(), 0]
+        self._tokens.move_to_end(token)
+
+        if len(self._tokens) > self.max_tokens:
+            self._tokens.popitem(last=False)
+
+    def token_used(self, token: str) -> None:
+        state = self._state(token)
+
+        if state is not None:
+            state[1] += 1
+
+
+class TimedRotation(_TrackingRotation):
+    """Rotate the token once it is older than ``max_age`` seconds."""
+
+    def __init__(self, max_age: float, max_tokens: int = 65536):
+        self.max_age = max_age
+
+        super().__init__(max_tokens)
+
+    def should_rotate(self, token: str) -> bool:
+        state = self._state(token)
+
+        return state is None or time.monotonic() - state[0] >= self.max_age
+
+
+class UsageRotation(_TrackingRotation):
+    """Rotate the token after it has been used for ``max_uses`` checks."""
+
+    def __init__(self, max_uses: int, max_tokens: int = 65536):
+        self.max_uses = max_uses
+
+        super().__init__(max_tokens)
+
+    def should_rotate(self, token: str) -> bool:
+        state = self._state(token)
+
+        return state is None or state[1] >= self.max_uses
@@ -0,0 +1,89 @@
+import enum
+import re
+from typing import Iterable, NamedTuple, Optional, Union
+
+from .policy import AbstractPolicy
+
+
+class Action(enum.Enum):
+    EXEMPT = "exempt"
+    PROTECT = "protect"
+
+
+EXEMPT = Action.EXEMPT
+PROTECT = Action.PROTECT
+
+
+class Rule(NamedTuple):
+    """Decide how requests to matching paths are handled by csrf_middleware.
+
+    ``path`` is a prefix matched on whole segments (``/api`` matches ``/api``
+    and ``/api/users`` but not ``/apis``), or with ``regex=True`` a regular
+    expression the whole path must match. ``action`` is ``EXEMPT``,
+    ``PROTECT``, or a policy to check matching requests with instead of the
+    application's.
+    """
+
+    path: str
+    action: Union[Action, AbstractPolicy] = PROTECT
+    regex: bool = False
+
+
+# a numbered backreference or conditional, i.e. \1 after an even number of
+# backslashes, or (?(1)...)
+_NUMBERED_REFERENCE_RE = re.compile(r"(?<!\\)(?:\\\\)*\\[1-9]|\(\?\(\d")
+
+
+class RuleTable:
+    """Rules compiled into one regular expression; the first match wins.
+
+    Regex rules become groups of the combined pattern, so they must not use
+    global inline flags such as ``(?i)`` (use scoped ones, ``(?i:...)``) or
+    refer to groups by number (use named groups).
+    """
+
+    def __init__(self, rules: Iterable[Rule]):
+        self.rules = tuple(rules)
+
+        alternatives = []
+        for index, rule in enumerate(self.rules):
+            if rule.regex:
+                try:
+                    re.compile(rule.path)
+                except re.error as exc:
+                    raise ValueError(f"invalid rule pattern {rule.path!r}: {exc}")
+                if _NUMBERED_REFERENCE_RE.search(rule.path):
+                    raise ValueError(
+                        f"rule pattern {rule.path!r} refers to a group by "
+                        "number, use a named group instead"
+                    )
+                body = rf"(?:{rule.path})\Z"
+            elif not rule.path.startswith("/"):
+                raise ValueError(f"rule prefix must start with '/': {rule.path!r}")
+            elif rule.path.endswith("/"):
+                body = re.escape(rule.path)
+            else:
+                body = rf"{re.escape(rule.path)}(?:/|\Z)"
+
+            # the group name tells which rule matched, since alternatives are
+            # tried in order and the outermost group closes last
+            alternatives.append(f"(?P<_csrf_rule_{index}>{body})")
+
+        try:
+            self._pattern = re.compile("|".join(alternatives)) if alternatives else None
+        except re.error as exc:
+            # e.g. a global flag, which is only allowed at the very start
+            raise ValueError(f"rule patterns can not be combined: {exc}")
+        self._actions = {
+            f"_csrf_rule_{index}": rule.action for index, rule in enumerate(self.rules)
+        }
+
+    def lookup(self, path: str) -> Optional[Union[Action, AbstractPolicy]]:
+        if self._pattern is None:
+            return None
+
+        match = self._pattern.match(path)
+        if match is None:
+            return None
+
+        return self._actions[match.lastgroup]  # type: ignore[index]
@@ -1,34 +1,68 @@
 import abc
-from typing import Optional, Protocol
-
-from aiohttp import web
-
-from .token_generator import HashedTokenGenerator, TokenGenerator
+import asyncio
+import logging
+import re
+import secrets
+from typing import Callable, Optional, Protocol, Union
+
+from aiohttp import hdrs, web
+from blake3 import blake3
+
+from .config import get_metrics, get_tracer
+from .keyring import KeyRing
+from .memory import LRUTokenCache, ShardedTTLTable, decode_token, encode_token
+from .metrics import TOKEN_WRITES, TOKENS_GENERATED
+from .resp import RedisClient
+from .rotation import PerRequestRotation, PerSessionRotation, RotationPolicy
+from .token_generator import (
+    HashedTokenGenerator,
+    OriginalToken,
+    SignedTokenGenerator,
+    SignedTokenVerifier,
+    TokenGenerator,
+    decode_bytes,
+    encode_bytes,
+)
+from .tracing import TOKEN_GENERATE, trace
 
 try:
-    from aiohttp_session import get_session
+    from aiohttp_session import STORAGE_KEY, get_session
 except ImportError:  # pragma: no cover
     pass
 
 
 REQUEST_NEW_TOKEN_KEY = "aiohttp_csrf_new_token"
+REQUEST_STORED_TOKEN_KEY = "aiohttp_csrf_stored_token"
+
+# characters a cookie value may hold without quoting, as in http.cookies
+_CLIENT_ID_RE = re.compile(r"[A-Za-z0-9_-]{16,64}")
+_COOKIE_VALUE_RE = re.compile(r"[\w!#$%&'*+\-.^`|~:]*", re.ASCII)
 
 
 class AbstractStorage(Protocol):
     async def generate_new_token(self, request: web.Request) -> str: ...
 
-    async def get(self, request: web.Request) -> str: ...
+    async def get(self, request: web.Request) -> OriginalToken: ...
 
     async def save_token(
-        self, request: web.Request, response: web.Response
+        self, request: web.Request, response: web.StreamResponse
     ) -> None: ...
 
 
+# Storages may also set ``needs_middlewares``: whether reading the token
+# depends on state set up by middlewares, such as a session. If so, or when
+# a storage does not say, csrf_expect_handler leaves the check to
+# csrf_middleware, since expect handlers run before any middleware.
+
+
 class BaseStorage:
+    needs_middlewares = False
+
     def __init__(
         self,
         token_generator: Optional[TokenGenerator] = None,
         secret_phrase: Optional[str] = None,
+        rotation: Optional[RotationPolicy] = None,
     ):
         if token_generator is None:
             if secret_phrase is None:
@@ -38,6 +72,7 @@ class BaseStorage:
             token_generator = HashedTokenGenerator(secret_phrase)
 
         self.token_generator = token_generator
+        self.rotation = rotation if rotation is not None else PerRequestRotation()
 
     def _generate_token(self) -> str:
         return self.token_generator.generate()
@@ -47,17 +82,69 @@ class BaseStorage:
             # perhaps request will support web.AppKey later?
             return str(request[REQUEST_NEW_TOKEN_KEY])
 
-        token = self._generate_token()
+        # the default policy never reuses a token, so skip reading it
+        if not isinstance(self.rotation, PerRequestRotation):
+            current = await self._get_stored(request)
+
+            if current and not self.rotation.should_rotate(current):
+                return current
+
+        return self._issue_token(request)
+
+    def generate_new_token_nowait(self, request: web.Request) -> str:
+        """Like generate_new_token(), for callers that cannot await.
+
+        A token that may be kept is only reused if storage was already read
+        during this request; otherwise a fresh token is issued.
+        """
+        if REQUEST_NEW_TOKEN_KEY in request:
+            return str(request[REQUEST_NEW_TOKEN_KEY])
+
+        if not isinstance(self.rotation, PerRequestRotation):
+            current = request.get(REQUEST_STORED_TOKEN_KEY)
+
+            if current and not self.rotation.should_rotate(current):
+                return current
+
+        return self._issue_token(request)
+
+    def _issue_token(self, request: web.Request) -> str:
+        tracer = get_tracer(request)
+        if tracer is None:
+            token = self._generate_token()
+        else:
+            with trace(tracer, request, TOKEN_GENERATE):
+                token = self._generate_token()
 
         request[REQUEST_NEW_TOKEN_KEY] = token
+        self.rotation.token_issued(token)
+
+        metrics = get_metrics(request)
+        if metrics is not None:
+            metrics.increment(TOKENS_GENERATED)
 
         return token
 
     @abc.abstractmethod
     async def _get(self, request: web.Request) -> str: ...
 
+    async def _get_stored(self, request: web.Request) -> str:
+        # Memoise the backend read for the lifetime of the request, so that
+        # get(), generate_new_token() and save_token() read storage once.
+        try:
+            return request[REQUEST_STORED_TOKEN_KEY]
+        except KeyError:
+            pass
+
+        token = request[REQUEST_STORED_TOKEN_KEY] = await self._get(request)
+
+        return token
+
     async def get(self, request: web.Request) -> str:
-        token = await self._get(request)
+        token = await self._get_stored(request)
+
+        if token:
+            self.rotation.token_used(token)
 
         await self.generate_new_token(request)
 
@@ -71,7 +158,11 @@ class BaseStorage:
     async def save_token(
         self, request: web.Request, response: web.StreamResponse
     ) -> None:
-        old_token = await self._get(request)
+        if response.status == 304:
+            # a 304 must not change the stored state it lets the client keep
+            return
+
+        old_token = await self._get_stored(request)
 
         if REQUEST_NEW_TOKEN_KEY in request:
             token = request[REQUEST_NEW_TOKEN_KEY]
@@ -80,44 +171,379 @@ class BaseStorage:
         else:
             token = None
 
-        if token is not None:
+        # skip the write when the client already holds this token
+        if token is not None and token != old_token:
             await self._save_token(request, response, token)
 
+            request[REQUEST_STORED_TOKEN_KEY] = token
+
+            metrics = get_metrics(request)
+            if metrics is not None:
+                metrics.increment(TOKEN_WRITES)
+
 
 class CookieStorage(BaseStorage):
     def __init__(self, cookie_name: str, cookie_kwargs=None, *args, **kwargs):
         self.cookie_name = cookie_name
         self.cookie_kwargs = cookie_kwargs or {}
+        self._cookie_attributes = self._compile_cookie_attributes()
 
         super().__init__(*args, **kwargs)
 
+    def _compile_cookie_attributes(self) -> str:
+        # Render the attributes once through aiohttp itself so they match
+        # what response.set_cookie() would produce for the same kwargs.
+        response = web.StreamResponse()
+        response.set_cookie(self.cookie_name, "x", **self.cookie_kwargs)
+        morsel = response.cookies[self.cookie_name]
+
+        return morsel.OutputString()[len(self.cookie_name) + 2 :]
+
     async def _get(self, request: web.Request) -> str:
         return request.cookies.get(self.cookie_name, "")
 
     async def _save_token(
         self, request: web.Request, response: web.StreamResponse, token: str
     ) -> None:
-        response.set_cookie(
-            self.cookie_name,
-            token,
-            **self.cookie_kwargs,
+        if _COOKIE_VALUE_RE.fullmatch(token) is None:
+            response.set_cookie(self.cookie_name, token, **self.cookie_kwargs)
+            return
+
+        response.headers.add(
+            hdrs.SET_COOKIE,
+            f"{self.cookie_name}={token}{self._cookie_attributes}",
         )
 
 
 class SessionStorage(BaseStorage):
+    """Keep the token in the aiohttp_session session.
+
+    With ``cache``, tokens are looked up by the raw session cookie before the
+    session is loaded, so repeated requests skip decrypting or fetching it.
+    The cache belongs to one process: a token written by another worker is
+    not seen until the entry expires. It therefore needs a rotation that
+    keeps the token for the whole session, ``PerSessionRotation``.
+
+    With ``store_raw``, hex and base64url tokens are put in the session as
+    the bytes they encode, for session encoders that can serialize bytes
+    (the default JSON encoder can not).
+    """
+
+    # the session is loaded by aiohttp_session's middleware
+    needs_middlewares = True
+
     def __init__(self, session_name: str, *args, **kwargs):
         self.session_name = session_name
+        self.cache: Optional[LRUTokenCache] = kwargs.pop("cache", None)
+        self.store_raw: bool = kwargs.pop("store_raw", False)
 
         super().__init__(*args, **kwargs)
 
+        if self.cache is not None and not isinstance(self.rotation, PerSessionRotation):
+            raise TypeError(
+                "cache requires rotation=PerSessionRotation(), since other "
+                "workers would keep serving a rotated token from their cache"
+            )
+
+        self._token_format = getattr(self.token_generator, "token_format", "hex")
+
+    def _cache_key(self, request: web.Request) -> Optional[bytes]:
+        session_storage = request.get(STORAGE_KEY)
+        if session_storage is None:
+            return None
+
+        cookie = session_storage.load_cookie(request)
+        if not cookie:
+            return None
+
+        return blake3(cookie.encode("utf-8")).digest(length=16)
+
     async def _get(self, request: web.Request) -> str:
+        cache = self.cache
+        key = self._cache_key(request) if cache is not None else None
+
+        if cache is not None and key is not None:
+            token = cache.get(key)
+            if token is not None:
+                return token
+
         session = await get_session(request)
+        token = session.get(self.session_name, None)
 
-        return session.get(self.session_name, None)
+        if isinstance(token, bytes):
+            token = encode_bytes(token, self._token_format)
+
+        if cache is not None and key is not None and token is not None:
+            cache.set(key, token)
+
+        return token
 
     async def _save_token(
         self, request: web.Request, response: web.StreamResponse, token: str
     ) -> None:
+        if self.cache is not None:
+            key = self._cache_key(request)
+            if key is not None:
+                self.cache.invalidate(key)
+
+        if not isinstance(response, web.Response):
+            logging.warning(
+                "CSRF token issued for a %s is lost: aiohttp_session only "
+                "saves the session with a web.Response",
+                type(response).__name__,
+            )
+
         session = await get_session(request)
 
-        session[self.session_name] = token
+        value: Union[str, bytes] = token
+        if self.store_raw:
+            try:
+                value = decode_bytes(token, self._token_format)
+            except ValueError:
+                pass  # not produced by a bundled generator, keep the str
+
+        session[self.session_name] = value
+
+
+class KeyValueStorage(BaseStorage):
+    """Base for server-side storages keyed by a random client id cookie.
+
+    Only the client id travels in the cookie; the token itself is kept by the
+    subclass through ``_load()`` and ``_store()``.
+    """
+
+    def __init__(self, cookie_name: str, cookie_kwargs=None, *args, **kwargs):
+        self.cookie_name = cookie_name
+        self.cookie_kwargs = cookie_kwargs or {}
+
+        super().__init__(*args, **kwargs)
+
+    def _client_id(self, request: web.Request) -> Optional[str]:
+        client_id = request.cookies.get(self.cookie_name)
+
+        if client_id is None or _CLIENT_ID_RE.fullmatch(client_id) is None:
+            return None
+
+        return client_id
+
+    @abc.abstractmethod
+    async def _load(self, client_id: str) -> Optional[str]: ...
+
+    @abc.abstractmethod
+    async def _store(self, client_id: str, token: str) -> None: ...
+
+    async def _get(self, request: web.Request) -> str:
+        client_id = self._client_id(request)
+
+        if client_id is None:
+            return ""
+
+        return await self._load(client_id) or ""
+
+    async def _save_token(
+        self, request: web.Request, response: web.StreamResponse, token: str
+    ) -> None:
+        client_id = self._client_id(request)
+
+        if client_id is None:
+            client_id = secrets.token_urlsafe(24)
+            response.set_cookie(self.cookie_name, client_id, **self.cookie_kwargs)
+
+        await self._store(client_id, token)
+
+
+class RedisStorage(KeyValueStorage):
+    """Keep tokens in a Redis-protocol server, keyed by a client id cookie.
+
+    Reads and writes from concurrent requests are pipelined over the pooled
+    connections of ``client``. With ``write_behind`` the response does not
+    wait for the write, at the cost of a following request possibly reading
+    the previous token; call :meth:`flush` before closing the client.
+    """
+
+    def __init__(
+        self,
+        cookie_name: str,
+        client: RedisClient,
+        key_prefix: str = "aiohttp_csrf:",
+        ttl: Optional[int] = 24 * 60 * 60,
+        write_behind: bool = False,
+        *args,
+        **kwargs,
+    ):
+        self.client = client
+        self.key_prefix = key_prefix
+        self.ttl = ttl
+        self.write_behind = write_behind
+        self._writes: set[asyncio.Future[None]] = set()
+
+        super().__init__(cookie_name, *args, **kwargs)
+
+    async def _load(self, client_id: str) -> Optional[str]:
+        value = await self.client.execute("GET", self.key_prefix + client_id)
+
+        return value.decode() if value is not None else None
+
+    async def _write(self, client_id: str, token: str) -> None:
+        if self.ttl:
+            await self.client.execute(
+                "SET", self.key_prefix + client_id, token, "EX", self.ttl
+            )
+        else:
+            await self.client.execute("SET", self.key_prefix + client_id, token)
+
+    def _write_done(self, future: "asyncio.Future[None]") -> None:
+        self._writes.discard(future)
+
+        if not future.cancelled() and future.exception() is not None:
+            logging.error("CSRF token write failed", exc_info=future.exception())
+
+    async def _store(self, client_id: str, token: str) -> None:
+        if not self.write_behind:
+            await self._write(client_id, token)
+            return
+
+        future = asyncio.ensure_future(self._write(client_id, token))
+        self._writes.add(future)
+        future.add_done_callback(self._write_done)
+
+    async def flush(self) -> None:
+        """Wait for the writes ``write_behind`` has not finished yet.
+
+        Failed writes are logged, not raised.
+        """
+        while self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+
+
+class MemoryStorage(KeyValueStorage):
+    """Keep tokens in this process, keyed by a client id cookie.
+
+    Memory is bounded by ``max_entries``; tokens expire ``ttl`` seconds after
+    they were last written. With ``snapshot_path``, tokens saved by
+    ``snapshot()`` (e.g. from ``app.on_shutdown``) are restored on startup.
+    """
+
+    def __init__(
+        self,
+        cookie_name: str,
+        ttl: float = 24 * 60 * 60,
+        max_entries: int = 100_000,
+        shards: int = 16,
+        snapshot_path: Optional[str] = None,
+        *args,
+        **kwargs,
+    ):
+        self.table = ShardedTTLTable(ttl, shards=shards, max_entries=max_entries)
+        self.snapshot_path = snapshot_path
+
+        if snapshot_path is not None:
+            self.table.load(snapshot_path)
+
+        super().__init__(cookie_name, *args, **kwargs)
+
+    def snapshot(self) -> None:
+        if self.snapshot_path is None:
+            raise RuntimeError("MemoryStorage was created without snapshot_path")
+
+        self.table.dump(self.snapshot_path)
+
+    async def _load(self, client_id: str) -> Optional[str]:
+        value = self.table.get(client_id)
+
+        return decode_token(value) if value is not None else None
+
+    async def _store(self, client_id: str, token: str) -> None:
+        self.table.set(client_id, encode_token(token))
+
+
+def cookie_identity(cookie_name: str) -> Callable[[web.Request], str]:
+    """Use the raw value of a cookie as identity.
+
+    The value must stay the same for the whole session, such as the session
+    id cookie of a server-side session store. Cookie-based sessions, e.g.
+    EncryptedCookieStorage, rewrite their cookie whenever the session
+    changes, which would invalidate every token issued before.
+    """
+
+    def identity(request: web.Request) -> str:
+        return request.cookies.get(cookie_name, "")
+
+    setattr(identity, "needs_middlewares", False)
+
+    return identity
+
+
+class SignedTokenStorage:
+    """Stateless storage for self-validating tokens.
+
+    Tokens are signed over the client identity returned by ``identity`` and
+    verified without reading or writing any backend, so nothing is ever
+    saved on the response. Tokens stay valid until ``max_age`` expires.
+
+    A client without an identity is given an empty token: one signed over
+    no identity would be valid for every other client without one.
+    """
+
+    def __init__(
+        self,
+        identity: Callable[[web.Request], str],
+        secret_phrase: Optional[str] = None,
+        max_age: Optional[int] = 3600,
+        token_generator: Optional[SignedTokenGenerator] = None,
+        keyring: Optional[KeyRing] = None,
+    ):
+        if token_generator is None:
+            if secret_phrase is None and keyring is None:
+                raise TypeError(
+                    "secret_phrase or keyring is required for signed tokens"
+                )
+            token_generator = SignedTokenGenerator(
+                secret_phrase, max_age, keyring=keyring
+            )
+
+        self.identity = identity
+        self.token_generator = token_generator
+        # an identity set by e.g. an authentication middleware is not there
+        # yet in csrf_expect_handler; mark the callable to say otherwise
+        self.needs_middlewares: bool = getattr(identity, "needs_middlewares", True)
+
+    async def generate_new_token(self, request: web.Request) -> str:
+        return self.generate_new_token_nowait(request)
+
+    def generate_new_token_nowait(self, request: web.Request) -> str:
+        if REQUEST_NEW_TOKEN_KEY in request:
+            return str(request[REQUEST_NEW_TOKEN_KEY])
+
+        identity = self.identity(request)
+        if not identity:
+            return ""
+
+        tracer = get_tracer(request)
+        if tracer is None:
+            token = self.token_generator.generate(identity)
+        else:
+            with trace(tracer, request, TOKEN_GENERATE):
+                token = self.token_generator.generate(identity)
+
+        request[REQUEST_NEW_TOKEN_KEY] = token
+
+        metrics = get_metrics(request)
+        if metrics is not None:
+            metrics.increment(TOKENS_GENERATED)
+
+        return token
+
+    async def get(self, request: web.Request) -> OriginalToken:
+        identity = self.identity(request)
+
+        if not identity:
+            # a token bound to no identity would be valid for every client
+            return ""
+
+        return SignedTokenVerifier(self.token_generator, identity)
+
+    async def save_token(
+        self, request: web.Request, response: web.StreamResponse
+    ) -> None:
+        pass
@@ -0,0 +1,94 @@
+import html
+from typing import Any, Optional
+
+from aiohttp import web
+
+from .config import get_config
+from .policy import form_field_name
+from .rotation import PerRequestRotation
+from .storage import BaseStorage
+
+
+class LazyToken:
+    """A token that is only issued when a template renders it.
+
+    Rendering it generates the token and, since a new token is then set on
+    the request, makes csrf_middleware save it with the response. Templates
+    that never read it cost nothing.
+    """
+
+    __slots__ = ("_request", "_value")
+
+    def __init__(self, request: web.Request):
+        self._request = request
+        self._value: Optional[str] = None
+
+    @property
+    def value(self) -> str:
+        if self._value is None:
+            storage = get_config(self._request).storage
+
+            generate = getattr(storage, "generate_new_token_nowait", None)
+            if generate is None:
+                raise RuntimeError(
+                    f"{type(storage).__name__} can not issue tokens lazily, "
+                    "it has no generate_new_token_nowait()"
+                )
+
+            self._value = generate(self._request)
+
+        return self._value
+
+    def __str__(self) -> str:
+        return self.value
+
+    def __html__(self) -> str:
+        return html.escape(self.value)
+
+    def __repr__(self) -> str:
+        state = "issued" if self._value is not None else "pending"
+        return f"<{type(self).__name__} {state}>"
+
+
+class LazyHiddenInput:
+    """A hidden form field holding a LazyToken, for the policy's field_name."""
+
+    __slots__ = ("field_name", "token")
+
+    def __init__(self, field_name: str, token: LazyToken):
+        self.field_name = field_name
+        self.token = token
+
+    def __html__(self) -> str:
+        return (
+            f'<input type="hidden" name="{html.escape(self.field_name)}" '
+            f'value="{self.token.__html__()}">'
+        )
+
+    __str__ = __html__
+
+
+async def csrf_processor(request: web.Request) -> dict[str, Any]:
+    """aiohttp_jinja2 context processor adding ``csrf_token`` and ``csrf_input``.
+
+    ``csrf_input`` is only added when the policy has a form ``field_name``.
+    With a rotation that keeps tokens, the stored token is read here, since
+    rendering can not wait for storage, so that the page reuses it instead
+    of replacing the token other open pages were given.
+    """
+    config = get_config(request)
+
+    storage = config.storage
+    if isinstance(storage, BaseStorage) and not isinstance(
+        storage.rotation, PerRequestRotation
+    ):
+        await storage._get_stored(request)
+
+    token = LazyToken(request)
+    context: dict[str, Any] = {"csrf_token": token}
+
+    field_name = form_field_name(config.policy)
+    if field_name is not None:
+        context["csrf_input"] = LazyHiddenInput(field_name, token)
+
+    return context
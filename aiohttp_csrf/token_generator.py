@@ -1,23 +1,107 @@
+import base64
+import binascii
+import os
+import time
 import uuid
-from typing import Protocol
+import weakref
+from secrets import compare_digest
+from typing import Optional, Protocol, Union
 
 from blake3 import blake3
 
+from .keyring import KeyRing
+
 
 class TokenGenerator(Protocol):
     def generate(self) -> str: ...
 
 
+class TokenVerifier(Protocol):
+    def verify(self, token: str) -> bool: ...
+
+
+# What a storage hands to the policies: either the stored token itself, or a
+# verifier for storages whose tokens validate themselves.
+OriginalToken = Union[str, TokenVerifier]
+
+
+def match_token(token: str, original_value: Optional[OriginalToken]) -> bool:
+    if not original_value:
+        # no token was ever issued, so nothing can match it
+        return False
+
+    if isinstance(original_value, str):
+        return compare_digest(token, original_value)
+
+    return original_value.verify(token)
+
+
+# "base64url" is unpadded: 22 characters for 16 bytes where hex needs 32.
+TOKEN_FORMATS = ("hex", "base64url")
+
+
+def _check_format(token_format: str) -> str:
+    if token_format not in TOKEN_FORMATS:
+        raise ValueError(
+            f"token_format must be one of {TOKEN_FORMATS}, got {token_format!r}"
+        )
+
+    return token_format
+
+
+def encode_bytes(raw: Union[bytes, memoryview], token_format: str = "hex") -> str:
+    if token_format == "hex":
+        return raw.hex()
+
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def decode_bytes(token: str, token_format: str = "hex") -> bytes:
+    """Reverse encode_bytes(); ValueError unless ``token`` round trips."""
+    if token_format == "hex":
+        raw = bytes.fromhex(token)
+    else:
+        try:
+            raw = base64.b64decode(
+                token + "=" * (-len(token) % 4), altchars=b"-_", validate=True
+            )
+        except (binascii.Error, UnicodeEncodeError) as exc:
+            raise ValueError(str(exc)) from None
+
+    # e.g. upper case hex, or stray bits in the last base64 character
+    if encode_bytes(raw, token_format) != token:
+        raise ValueError(f"{token!r} is not a canonical {token_format} token")
+
+    return raw
+
+
 class SimpleTokenGenerator:
+    """Random tokens; a uuid4 unless ``token_size`` bytes are asked for."""
+
+    def __init__(self, token_size: Optional[int] = None, token_format: str = "hex"):
+        self.token_size = token_size
+        self.token_format = _check_format(token_format)
+
     def generate(self) -> str:
-        return uuid.uuid4().hex
+        if self.token_size is None:
+            raw = uuid.uuid4().bytes
+        else:
+            raw = os.urandom(self.token_size)
+
+        return encode_bytes(raw, self.token_format)
 
 
 class HashedTokenGenerator:
+    """blake3 of a uuid4 and the secret, truncated to ``token_size`` bytes."""
+
     encoding = "utf-8"
 
-    def __init__(self, secret_phrase: str):
+    def __init__(
+        self, secret_phrase: str, token_size: int = 32, token_format: str = "hex"
+    ):
         self.secret_phrase = secret_phrase
+        self.token_size = token_size
+        self.token_format = _check_format(token_format)
 
     def generate(self) -> str:
         token = uuid.uuid4().hex
@@ -26,4 +110,191 @@ class HashedTokenGenerator:
 
         hasher = blake3(token.encode(self.encoding))
 
-        return hasher.hexdigest()
+        return encode_bytes(hasher.digest(length=self.token_size), self.token_format)
+
+
+class PooledTokenGenerator:
+    """Slices tokens out of a pool of random bytes refilled in large batches.
+
+    This amortises the ``os.urandom`` syscall over ``pool_size`` tokens. With
+    a ``secret_phrase`` each slice is hashed with a keyed blake3 hasher that
+    is built once and copied per token. The pool is discarded in forked
+    children so workers never hand out the same tokens. Not thread-safe; use
+    one generator per event loop.
+    """
+
+    key_context = "aiohttp_csrf pooled token v1"
+    encoding = "utf-8"
+
+    def __init__(
+        self,
+        secret_phrase: Optional[str] = None,
+        token_size: int = 16,
+        pool_size: int = 256,
+        token_format: str = "hex",
+    ):
+        self.token_size = token_size
+        self.pool_size = pool_size
+        self.token_format = _check_format(token_format)
+
+        self._hasher = None
+        if secret_phrase is not None:
+            key = blake3(
+                secret_phrase.encode(self.encoding),
+                derive_key_context=self.key_context,
+            ).digest()
+            self._hasher = blake3(key=key)
+
+        self._pool = memoryview(b"")
+        self._offset = 0
+
+        _pooled_generators.add(self)
+
+    def _reset(self) -> None:
+        self._pool = memoryview(b"")
+        self._offset = 0
+
+    def _refill(self) -> None:
+        self._pool = memoryview(os.urandom(self.token_size * self.pool_size))
+        self._offset = 0
+
+    def generate(self) -> str:
+        if self._offset >= len(self._pool):
+            self._refill()
+
+        start = self._offset
+        self._offset = start + self.token_size
+        chunk = self._pool[start : self._offset]
+
+        if self._hasher is None:
+            return encode_bytes(chunk, self.token_format)
+
+        hasher = self._hasher.copy()
+        hasher.update(chunk)
+
+        return encode_bytes(hasher.digest(length=self.token_size), self.token_format)
+
+
+# One at-fork hook for all generators, since hooks can not be unregistered.
+_pooled_generators: "weakref.WeakSet[PooledTokenGenerator]" = weakref.WeakSet()
+
+
+def _reset_after_fork() -> None:
+    for generator in list(_pooled_generators):
+        generator._reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class SignedTokenGenerator:
+    """Issues self-validating tokens bound to a client identity.
+
+    A token is ``<issued>.<nonce>.<mac>``, where the mac is a keyed blake3
+    hash over the identity, issue time and nonce. Verification needs only the
+    identity and the key, so no stored copy of the token is required.
+
+    With a ``keyring`` instead of a ``secret_phrase``, tokens are signed with
+    its current key and start with that key's id, ``<kid>.<issued>...``, so
+    the key to verify them with is found with a single lookup and keys can be
+    rotated while tokens signed with older ones still verify.
+    """
+
+    encoding = "utf-8"
+    key_context = "aiohttp_csrf signed token v1"
+    nonce_size = 16
+    mac_size = 16
+
+    def __init__(
+        self,
+        secret_phrase: Optional[str] = None,
+        max_age: Optional[int] = 3600,
+        token_format: str = "hex",
+        keyring: Optional[KeyRing] = None,
+    ):
+        if (secret_phrase is None) == (keyring is None):
+            raise TypeError("either secret_phrase or keyring is required")
+
+        self.max_age = max_age
+        self.token_format = _check_format(token_format)
+        self.keyring = keyring
+
+        self._hasher = None
+        if secret_phrase is not None:
+            self._hasher = self._keyed(secret_phrase.encode(self.encoding))
+
+        # hashers for the key ring's keys, rebuilt if a key id is reused
+        self._ring_hashers: dict[str, tuple[bytes, blake3]] = {}
+
+    def _keyed(self, secret: bytes) -> blake3:
+        key = blake3(secret, derive_key_context=self.key_context).digest()
+
+        return blake3(key=key)
+
+    def _ring_hasher(self, kid: str, secret: bytes) -> blake3:
+        cached = self._ring_hashers.get(kid)
+
+        if cached is None or cached[0] != secret:
+            if len(self._ring_hashers) >= 64:
+                self._ring_hashers.clear()  # ids of long retired keys
+            cached = self._ring_hashers[kid] = (secret, self._keyed(secret))
+
+        return cached[1]
+
+    def _mac(self, hasher: blake3, identity: str, issued: str, nonce: str) -> str:
+        hasher = hasher.copy()
+        hasher.update(f"{identity}\0{issued}\0{nonce}".encode(self.encoding))
+
+        return encode_bytes(hasher.digest(length=self.mac_size), self.token_format)
+
+    def generate(self, identity: str = "") -> str:
+        issued = format(int(time.time()), "x")
+        nonce = encode_bytes(os.urandom(self.nonce_size), self.token_format)
+
+        if self.keyring is None:
+            assert self._hasher is not None
+            mac = self._mac(self._hasher, identity, issued, nonce)
+            return f"{issued}.{nonce}.{mac}"
+
+        kid, secret = self.keyring.current()
+        mac = self._mac(self._ring_hasher(kid, secret), identity, issued, nonce)
+
+        return f"{kid}.{issued}.{nonce}.{mac}"
+
+    def verify(self, token: str, identity: str = "") -> bool:
+        parts = token.split(".")
+
+        if self.keyring is None:
+            if len(parts) != 3:
+                return False
+            issued, nonce, mac = parts
+            hasher = self._hasher
+            assert hasher is not None
+        else:
+            if len(parts) != 4:
+                return False
+            kid, issued, nonce, mac = parts
+            secret = self.keyring.get(kid)
+            if secret is None:
+                return False
+            hasher = self._ring_hasher(kid, secret)
+
+        try:
+            issued_at = int(issued, 16)
+        except ValueError:
+            return False
+
+        if self.max_age is not None and time.time() - issued_at > self.max_age:
+            return False
+
+        return compare_digest(mac, self._mac(hasher, identity, issued, nonce))
+
+
+class SignedTokenVerifier:
+    def __init__(self, token_generator: SignedTokenGenerator, identity: str):
+        self.token_generator = token_generator
+        self.identity = identity
+
+    def verify(self, token: str) -> bool:
+        return self.token_generator.verify(token, self.identity)
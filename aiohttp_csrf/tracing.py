@@ -0,0 +1,65 @@
+from typing import Any, Optional, Protocol
+
+from aiohttp import web
+
+STORAGE_GET = "storage.get"
+POLICY_CHECK = "policy.check"
+TOKEN_GENERATE = "token.generate"
+STORAGE_SAVE_TOKEN = "storage.save_token"
+
+
+class AbstractTracer(Protocol):
+    """Called around each CSRF stage of a request.
+
+    ``start`` returns any value, typically a span, which is handed back to
+    ``end`` together with the exception that ended the stage, if any. Stages
+    are ``storage.get``, ``policy.check``, ``token.generate`` and
+    ``storage.save_token``.
+    """
+
+    def start(self, request: web.Request, stage: str) -> Any: ...
+
+    def end(
+        self,
+        request: web.Request,
+        stage: str,
+        span: Any,
+        exc: Optional[BaseException],
+    ) -> None: ...
+
+
+class trace:
+    """Context manager reporting one stage to ``tracer``."""
+
+    __slots__ = ("tracer", "request", "stage", "span")
+
+    def __init__(self, tracer: AbstractTracer, request: web.Request, stage: str):
+        self.tracer = tracer
+        self.request = request
+        self.stage = stage
+
+    def __enter__(self) -> None:
+        self.span = self.tracer.start(self.request, self.stage)
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.tracer.end(self.request, self.stage, self.span, exc)
+
+
+class TracerGroup:
+    """Report every stage to several tracers."""
+
+    def __init__(self, *tracers: AbstractTracer):
+        self.tracers = tracers
+
+    def start(self, request: web.Request, stage: str) -> list[Any]:
+        return [tracer.start(request, stage) for tracer in self.tracers]
+
+    def end(
+        self,
+        request: web.Request,
+        stage: str,
+        span: list[Any],
+        exc: Optional[BaseException],
+    ) -> None:
+        for tracer, tracer_span in zip(self.tracers, span):
+            tracer.end(request, stage, tracer_span, exc)
@@ -0,0 +1,127 @@
+"""Run every benchmark and compare it against a stored baseline.
+
+Record a baseline before an upgrade and compare against it afterwards::
+
+    python -m benchmarks --save
+    python -m benchmarks --compare
+
+``--compare`` exits with status 1 when any benchmark is slower than its
+baseline by more than ``--threshold`` (25% by default). Baselines are only
+meaningful on the machine they were recorded on, so the default file is not
+checked in.
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import Callable
+
+from . import bench_middleware, bench_storage_writes, bench_token_generator
+
+BASELINE = Path(__file__).with_name("baseline.json")
+
+SUITES: dict[str, Callable[[], dict[str, float]]] = {
+    "middleware": bench_middleware.collect,
+    "storage_writes": bench_storage_writes.collect,
+    "token_generator": bench_token_generator.collect,
+}
+
+
+def _format(seconds: float) -> str:
+    if seconds < 1e-6:
+        return f"{seconds * 1e9:8.0f} ns"
+    return f"{seconds * 1e6:8.1f} us"
+
+
+def compare(
+    baseline: dict[str, float], results: dict[str, float], threshold: float
+) -> list[str]:
+    """Print results next to the baseline and return the names that regressed."""
+    regressed = []
+
+    for name, seconds in results.items():
+        before = baseline.get(name)
+        if before is None:
+            print(f"{name:<68} {_format(seconds)}      (new)")
+            continue
+
+        change = seconds / before - 1
+        mark = ""
+        if change > threshold:
+            mark = "  REGRESSION"
+            regressed.append(name)
+
+        print(f"{name:<68} {_format(seconds)} {change:+7.1%}{mark}")
+
+    for name in baseline.keys() - results.keys():
+        print(f"{name:<68} missing")
+
+    return regressed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument(
+        "suites", nargs="*", help=f"suites to run, from {', '.join(SUITES)}"
+    )
+    parser.add_argument(
+        "--save",
+        nargs="?",
+        const=BASELINE,
+        type=Path,
+        metavar="PATH",
+        help=f"store the results as the baseline (default: {BASELINE.name})",
+    )
+    parser.add_argument(
+        "--compare",
+        nargs="?",
+        const=BASELINE,
+        type=Path,
+        metavar="PATH",
+        help="compare the results against a stored baseline",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="allowed slowdown before --compare fails (default: 0.25)",
+    )
+    args = parser.parse_args()
+
+    unknown = set(args.suites) - SUITES.keys()
+    if unknown:
+        parser.error(f"unknown suite: {', '.join(sorted(unknown))}")
+
+    baseline: dict[str, float] = {}
+    if args.compare is not None:
+        baseline = json.loads(args.compare.read_text())
+
+    results: dict[str, float] = {}
+    for suite in args.suites or SUITES:
+        for name, seconds in SUITES[suite]().items():
+            results[f"{suite}/{name}"] = seconds
+
+    if args.compare is None:
+        for name, seconds in results.items():
+            print(f"{name:<68} {_format(seconds)}")
+        regressed = []
+    else:
+        # compare only what was run when a subset of suites was selected
+        if args.suites:
+            prefixes = tuple(f"{suite}/" for suite in args.suites)
+            baseline = {k: v for k, v in baseline.items() if k.startswith(prefixes)}
+        regressed = compare(baseline, results, args.threshold)
+
+    if args.save is not None:
+        args.save.write_text(json.dumps(results, indent=2, sort_keys=True) + "\n")
+
+    if regressed:
+        sys.exit(
+            f"{len(regressed)} benchmark(s) slower than the baseline by more "
+            f"than {args.threshold:.0%}: {', '.join(regressed)}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""Time a protected request through csrf_middleware and csrf_protect.
+
+Every policy is combined with every storage. A GET issues a token through
+``generate_token``; a POST presents it back, in a form field for FormPolicy
+and FormAndHeaderPolicy (so the combined policy falls through the header
+check to the body) and in a header for HeaderPolicy. The ``bare`` entries
+run the same handler without CSRF protection, so the overhead of each
+combination is its time minus the bare time.
+
+Run with ``python -m benchmarks.bench_middleware``.
+"""
+
+import asyncio
+import time
+from typing import Any, Awaitable, Callable
+from unittest import mock
+
+from aiohttp import web
+from aiohttp.streams import StreamReader
+from aiohttp.test_utils import make_mocked_request
+from aiohttp_session import SimpleCookieStorage, session_middleware
+
+import aiohttp_csrf
+from aiohttp_csrf import AbstractPolicy, AbstractStorage
+from aiohttp_csrf.policy import FormAndHeaderPolicy, FormPolicy, HeaderPolicy
+from aiohttp_csrf.storage import CookieStorage, SessionStorage
+
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+COOKIE_NAME = "csrf_token"
+FIELD_NAME = HEADER_NAME = "X-CSRF-Token"
+REQUESTS = 500
+REPEAT = 3
+
+POLICIES: dict[str, Callable[[], AbstractPolicy]] = {
+    "FormPolicy": lambda: FormPolicy(FIELD_NAME),
+    "HeaderPolicy": lambda: HeaderPolicy(HEADER_NAME),
+    "FormAndHeaderPolicy": lambda: FormAndHeaderPolicy(HEADER_NAME, FIELD_NAME),
+}
+
+STORAGES: dict[str, Callable[[], AbstractStorage]] = {
+    "CookieStorage": lambda: CookieStorage(COOKIE_NAME, secret_phrase="secret"),
+    "SessionStorage": lambda: SessionStorage(COOKIE_NAME, secret_phrase="secret"),
+}
+
+
+class Target:
+    def __init__(self, policy: str, storage: str, mode: str):
+        self.tokens: list[str] = []
+        self.form = policy != "HeaderPolicy"
+
+        self.app = web.Application()
+        aiohttp_csrf.setup(
+            self.app, policy=POLICIES[policy](), storage=STORAGES[storage]()
+        )
+
+        handler: Handler = self.handler
+        if mode == "protect":
+            handler = aiohttp_csrf.csrf_protect(handler)
+        elif mode == "middleware":
+            handler = self._wrap(aiohttp_csrf.csrf_middleware, handler)
+
+        if storage == "SessionStorage":
+            handler = self._wrap(session_middleware(SimpleCookieStorage()), handler)
+
+        self.chain = handler
+
+        # make_mocked_request() builds these mocks per call unless given, and
+        # they cost far more than the request itself
+        self.mocks: dict[str, Any] = {
+            "protocol": mock.Mock(),
+            "transport": mock.Mock(),
+            "writer": mock.Mock(),
+            "match_info": {},
+        }
+
+    @staticmethod
+    def _wrap(middleware, handler: Handler) -> Handler:
+        async def call(request: web.Request) -> web.StreamResponse:
+            return await middleware(request, handler)
+
+        return call
+
+    async def handler(self, request: web.Request) -> web.StreamResponse:
+        if request.method == "GET":
+            self.tokens.append(await aiohttp_csrf.generate_token(request))
+        return web.Response(text="OK")
+
+    @staticmethod
+    def _prepared(request: web.Request) -> web.Request:
+        # make_mocked_request() gives every request a fresh mock route, whose
+        # attributes are built on first access; do that before timing
+        request.match_info.route.resource
+        return request
+
+    def get_request(self) -> web.Request:
+        return self._prepared(
+            make_mocked_request("GET", "/", app=self.app, **self.mocks)
+        )
+
+    def post_request(self, cookies: str, token: str) -> web.Request:
+        headers = {"Cookie": cookies}
+        body = b""
+
+        if self.form:
+            body = f"{FIELD_NAME}={token}".encode()
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+            headers["Content-Length"] = str(len(body))
+        else:
+            headers[HEADER_NAME] = token
+
+        loop = asyncio.get_running_loop()
+        payload = StreamReader(self.mocks["protocol"], 2**16, loop=loop)
+        payload.feed_data(body)
+        payload.feed_eof()
+
+        return self._prepared(
+            make_mocked_request(
+                "POST", "/", headers, app=self.app, payload=payload, **self.mocks
+            )
+        )
+
+    async def login(self) -> tuple[str, str]:
+        response = await self.chain(self.get_request())
+        # CookieStorage writes its Set-Cookie header directly, aiohttp_session
+        # goes through response.cookies
+        cookies = [
+            value.split(";", 1)[0]
+            for value in response.headers.getall("Set-Cookie", ())
+        ]
+        cookies += [
+            f"{name}={morsel.value}" for name, morsel in response.cookies.items()
+        ]
+        return "; ".join(cookies), self.tokens[-1]
+
+
+async def _time(
+    chain: Handler, make_request: Callable[[], web.Request], status: int
+) -> float:
+    best = float("inf")
+
+    for _ in range(REPEAT):
+        elapsed = 0.0
+
+        for _ in range(REQUESTS):
+            request = make_request()
+
+            start = time.perf_counter()
+            response = await chain(request)
+            elapsed += time.perf_counter() - start
+
+            if response.status != status:
+                raise RuntimeError(f"unexpected status {response.status}")
+
+        best = min(best, elapsed / REQUESTS)
+
+    return best
+
+
+async def _collect() -> dict[str, float]:
+    results = {}
+
+    for policy in POLICIES:
+        for storage in STORAGES:
+            for mode in ("bare", "middleware", "protect"):
+                if mode != "bare":
+                    name = f"{mode}/{policy}/{storage}"
+                elif policy == "FormPolicy":
+                    # the bare handler ignores the policy, time it only once
+                    name = f"bare/{storage}"
+                else:
+                    continue
+
+                target = Target(policy, storage, mode)
+                cookies, token = await target.login()
+
+                results[f"{name}/GET"] = await _time(
+                    target.chain, target.get_request, 200
+                )
+                results[f"{name}/POST"] = await _time(
+                    target.chain, lambda: target.post_request(cookies, token), 200
+                )
+
+    return results
+
+
+def collect() -> dict[str, float]:
+    """Return the best seconds per request for every combination."""
+    return asyncio.run(_collect())
+
+
+def main() -> None:
+    for name, seconds in collect().items():
+        print(f"{name:<52} {seconds * 1e6:8.1f} us/req")
+
+
+if __name__ == "__main__":
+    main()
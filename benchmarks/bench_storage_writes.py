@@ -0,0 +1,62 @@
+"""Count storage writes and time get/save_token per request.
+
+Run with ``python -m benchmarks.bench_storage_writes``.
+"""
+
+import asyncio
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+from aiohttp_csrf.rotation import PerRequestRotation, PerSessionRotation
+from aiohttp_csrf.storage import CookieStorage
+
+COOKIE_NAME = "csrf_token"
+REQUESTS = 20_000
+
+
+async def run(storage: CookieStorage) -> tuple[float, float]:
+    token = ""
+    writes = 0
+    elapsed = 0.0
+
+    for _ in range(REQUESTS):
+        headers = {"Cookie": f"{COOKIE_NAME}={token}"} if token else {}
+        request = make_mocked_request("POST", "/", headers=headers)
+        response = web.Response()
+
+        start = time.perf_counter()
+        await storage.get(request)
+        await storage.save_token(request, response)
+        elapsed += time.perf_counter() - start
+
+        for value in response.headers.getall("Set-Cookie", ()):
+            writes += 1
+            token = value.split(";", 1)[0].split("=", 1)[1]
+
+    return writes / REQUESTS, elapsed / REQUESTS
+
+
+def _run_all() -> dict[str, tuple[float, float]]:
+    results = {}
+
+    for rotation in (PerRequestRotation(), PerSessionRotation()):
+        storage = CookieStorage(COOKIE_NAME, secret_phrase="secret", rotation=rotation)
+        results[type(rotation).__name__] = asyncio.run(run(storage))
+
+    return results
+
+
+def collect() -> dict[str, float]:
+    """Return the seconds per get/save_token round for every rotation."""
+    return {name: elapsed for name, (_, elapsed) in _run_all().items()}
+
+
+def main() -> None:
+    for name, (writes, elapsed) in _run_all().items():
+        print(f"{name:<24} {writes:6.3f} writes/req {elapsed * 1e6:8.1f} us/req")
+
+
+if __name__ == "__main__":
+    main()
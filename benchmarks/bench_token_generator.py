@@ -0,0 +1,39 @@
+"""Compare the cost of the token generators.
+
+Run with ``python -m benchmarks.bench_token_generator``.
+"""
+
+import timeit
+
+from aiohttp_csrf.token_generator import (
+    HashedTokenGenerator,
+    PooledTokenGenerator,
+    SimpleTokenGenerator,
+    TokenGenerator,
+)
+
+NUMBER = 100_000
+
+
+def collect() -> dict[str, float]:
+    """Return the best seconds per token for every generator."""
+    generators: dict[str, TokenGenerator] = {
+        "SimpleTokenGenerator": SimpleTokenGenerator(),
+        "HashedTokenGenerator": HashedTokenGenerator("secret"),
+        "PooledTokenGenerator": PooledTokenGenerator(),
+        "PooledTokenGenerator(secret)": PooledTokenGenerator("secret"),
+    }
+
+    return {
+        name: min(timeit.repeat(generator.generate, number=NUMBER, repeat=5)) / NUMBER
+        for name, generator in generators.items()
+    }
+
+
+def main() -> None:
+    for name, seconds in collect().items():
+        print(f"{name:<32} {seconds * 1e9:8.0f} ns/token")
+
+
+if __name__ == "__main__":
+    main()
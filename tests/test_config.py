@@ -0,0 +1,106 @@
+import pytest
+from aiohttp import web
+
+import aiohttp_csrf
+from aiohttp_csrf.config import CsrfConfig
+
+from .conftest import COOKIE_NAME, HEADER_NAME
+
+
+class CountingPolicy(aiohttp_csrf.policy.HeaderPolicy):
+    def __init__(self, header_name):
+        super().__init__(header_name)
+        self.calls = 0
+
+    async def check(self, request, original_value):
+        self.calls += 1
+        return await super().check(request, original_value)
+
+
+def make_storage():
+    return aiohttp_csrf.storage.CookieStorage(COOKIE_NAME, secret_phrase="test")
+
+
+def test_config_validation() -> None:
+    policy = aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME)
+
+    with pytest.raises(TypeError):
+        CsrfConfig(policy, object()).validate()  # type: ignore[arg-type]
+
+    with pytest.raises(TypeError):
+        CsrfConfig(policy, make_storage(), exception=int).validate()  # type: ignore[arg-type]
+
+    with pytest.raises(TypeError):
+        CsrfConfig(policy, make_storage(), error_renderer=1).validate()  # type: ignore[arg-type]
+
+    async def renderer(request):
+        return web.Response()
+
+    config = CsrfConfig(policy, make_storage(), error_renderer=renderer).validate()
+    assert config.renderer_is_coroutine
+
+    with pytest.raises(AttributeError):
+        config.policy = policy  # type: ignore[misc]
+
+
+async def test_sub_app_inherits_and_checks_once(test_client) -> None:
+    policy = CountingPolicy(HEADER_NAME)
+
+    def create_app(loop):
+        async def handler(request):
+            if request.method == "GET":
+                await aiohttp_csrf.generate_token(request)
+            return web.Response(body=b"OK")
+
+        app = web.Application(middlewares=[aiohttp_csrf.csrf_middleware])
+        aiohttp_csrf.setup(app, policy=policy, storage=make_storage())
+
+        sub_app = web.Application(middlewares=[aiohttp_csrf.csrf_middleware])
+        sub_app.router.add_get("/", handler)
+        sub_app.router.add_post("/", handler)
+        app.add_subapp("/sub", sub_app)
+
+        return app
+
+    client = await test_client(create_app)
+
+    resp = await client.get("/sub/")
+    assert resp.status == 200
+    token = resp.cookies[COOKIE_NAME].value
+
+    resp = await client.post("/sub/", headers={HEADER_NAME: token})
+    assert resp.status == 200
+    assert policy.calls == 1
+
+    resp = await client.post("/sub/")
+    assert resp.status == 403
+    assert policy.calls == 2
+
+
+async def test_app_error_renderer(test_client) -> None:
+    def create_app(loop, **kwargs):
+        async def handler(request):
+            return web.Response(body=b"OK")
+
+        app = web.Application(middlewares=[aiohttp_csrf.csrf_middleware])
+        aiohttp_csrf.setup(
+            app,
+            policy=aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME),
+            storage=make_storage(),
+            **kwargs,
+        )
+        app.router.add_post("/", handler)
+
+        return app
+
+    async def renderer(request):
+        return web.Response(status=418, body=b"CSRF error")
+
+    client = await test_client(create_app, error_renderer=renderer)
+    resp = await client.post("/")
+    assert resp.status == 418
+    assert await resp.read() == b"CSRF error"
+
+    client = await test_client(create_app, exception=web.HTTPBadRequest)
+    resp = await client.post("/")
+    assert resp.status == 400
@@ -0,0 +1,189 @@
+import pytest
+from aiohttp import web
+from aiohttp_session import SimpleCookieStorage
+from aiohttp_session import setup as setup_session
+
+import aiohttp_csrf
+from aiohttp_csrf.rules import Rule
+
+from .conftest import COOKIE_NAME, HEADER_NAME, SESSION_NAME
+
+
+def create_app(loop, policy):
+    async def handler_get(request):
+        await aiohttp_csrf.generate_token(request)
+
+        return web.Response(body=b"OK")
+
+    async def handler_post(request):
+        await request.read()
+
+        return web.Response(body=b"OK")
+
+    app = web.Application()
+
+    aiohttp_csrf.setup(
+        app,
+        policy=policy,
+        storage=aiohttp_csrf.storage.CookieStorage(COOKIE_NAME, secret_phrase="test"),
+    )
+
+    app.middlewares.append(aiohttp_csrf.csrf_middleware)
+
+    app.router.add_get("/", handler_get)
+    app.router.add_post(
+        "/", handler_post, expect_handler=aiohttp_csrf.csrf_expect_handler
+    )
+
+    return app
+
+
+async def test_expect_rejects_before_body(test_client) -> None:
+    client = await test_client(
+        create_app, policy=aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME)
+    )
+
+    await client.get("/")
+
+    resp = await client.post("/", data=b"x" * 100_000, expect100=True)
+
+    assert resp.status == 403
+
+
+async def test_expect_accepts_header_token(test_client) -> None:
+    client = await test_client(
+        create_app, policy=aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME)
+    )
+
+    resp = await client.get("/")
+
+    headers = {HEADER_NAME: resp.cookies[COOKIE_NAME].value}
+
+    resp = await client.post("/", data=b"x", headers=headers, expect100=True)
+
+    assert resp.status == 200
+    assert COOKIE_NAME in resp.cookies
+
+
+async def test_expect_defers_to_form(test_client) -> None:
+    client = await test_client(
+        create_app,
+        policy=aiohttp_csrf.policy.FormAndHeaderPolicy(HEADER_NAME, "token"),
+    )
+
+    resp = await client.get("/")
+
+    data = {"token": resp.cookies[COOKIE_NAME].value}
+
+    resp = await client.post("/", data=data, expect100=True)
+
+    assert resp.status == 200
+
+
+def create_rules_app(loop):
+    async def handler_get(request):
+        await aiohttp_csrf.generate_token(request)
+
+        return web.Response(body=b"OK")
+
+    async def handler_post(request):
+        await request.read()
+
+        return web.Response(body=b"OK")
+
+    strict = aiohttp_csrf.policy.AllOf(
+        aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME),
+        aiohttp_csrf.policy.OriginPolicy(),
+    )
+
+    app = web.Application(middlewares=[aiohttp_csrf.csrf_middleware])
+
+    aiohttp_csrf.setup(
+        app,
+        policy=aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME),
+        storage=aiohttp_csrf.storage.CookieStorage(COOKIE_NAME, secret_phrase="test"),
+        rules=[Rule("/up", strict)],
+    )
+
+    app.router.add_get("/", handler_get)
+    app.router.add_post(
+        "/up", handler_post, expect_handler=aiohttp_csrf.csrf_expect_handler
+    )
+    app.router.add_post(
+        "/protected",
+        aiohttp_csrf.csrf_protect(handler_post, policy=strict),
+        expect_handler=aiohttp_csrf.csrf_expect_handler,
+    )
+
+    return app
+
+
+@pytest.mark.parametrize("path", ["/up", "/protected"])
+@pytest.mark.parametrize("expect100", [True, False])
+async def test_expect_uses_route_policy(test_client, path, expect100) -> None:
+    client = await test_client(create_rules_app)
+
+    resp = await client.get("/")
+    token = resp.cookies[COOKIE_NAME].value
+
+    resp = await client.post(
+        path,
+        data=b"x",
+        headers={HEADER_NAME: token, "Origin": "https://evil.example"},
+        expect100=expect100,
+    )
+    assert resp.status == 403
+
+    resp = await client.post(
+        path,
+        data=b"x",
+        headers={HEADER_NAME: token, "Origin": str(client.make_url("/").origin())},
+        expect100=expect100,
+    )
+    assert resp.status == 200
+
+
+def create_session_app(loop):
+    async def handler_get(request):
+        token = await aiohttp_csrf.generate_token(request)
+
+        return web.Response(text=token)
+
+    async def handler_post(request):
+        await request.read()
+
+        return web.Response(body=b"OK")
+
+    app = web.Application()
+    setup_session(app, SimpleCookieStorage())
+
+    aiohttp_csrf.setup(
+        app,
+        policy=aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME),
+        storage=aiohttp_csrf.storage.SessionStorage(SESSION_NAME, secret_phrase="test"),
+    )
+
+    app.middlewares.append(aiohttp_csrf.csrf_middleware)
+
+    app.router.add_get("/", handler_get)
+    app.router.add_post(
+        "/", handler_post, expect_handler=aiohttp_csrf.csrf_expect_handler
+    )
+
+    return app
+
+
+async def test_expect_defers_session_storage(test_client) -> None:
+    client = await test_client(create_session_app)
+
+    resp = await client.get("/")
+    token = await resp.text()
+
+    # the session is only loaded by the middleware, after the expect handler
+    resp = await client.post("/", data=b"x", expect100=True)
+    assert resp.status == 403
+
+    resp = await client.post(
+        "/", data=b"x", headers={HEADER_NAME: token}, expect100=True
+    )
+    assert resp.status == 200
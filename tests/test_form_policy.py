@@ -155,3 +155,20 @@ async def test_form_policy_reuse_token(
     resp = await client.post("/", data=data)
 
     assert resp.status == 403
+
+
+async def test_form_policy_no_token_issued(
+    test_client,
+    create_app,
+    csrf_form_policy,
+    csrf_storage,
+) -> None:
+    client = await test_client(
+        create_app,
+        policy=csrf_form_policy,
+        storage=csrf_storage,
+    )
+
+    resp = await client.post("/", data={"name": "value"})
+
+    assert resp.status == 403
@@ -0,0 +1,233 @@
+import re
+
+import pytest
+from aiohttp import web
+from yarl import URL
+
+import aiohttp_csrf
+from aiohttp_csrf.inject import (
+    FormTokenInjector,
+    InjectingStreamResponse,
+    csrf_inject_middleware,
+)
+from aiohttp_csrf.rules import EXEMPT, Rule
+
+from .conftest import COOKIE_NAME, FORM_FIELD_NAME, HEADER_NAME
+
+PAGE = (
+    b"<html><body>"
+    b'<form action="/search" method="get"><input name="q"></form>'
+    b'<FORM data-x=\'a>b\' METHOD=Post action="/"><input name="name"></FORM>'
+    b"<p>a < b</p>"
+    b'<form\n  method="post"\n><button>Go</button></form>'
+    b"<formula></formula>"
+    b"</body></html>"
+)
+
+HIDDEN = f'<input type="hidden" name="{FORM_FIELD_NAME}" value="token">'.encode()
+
+EXPECTED = (
+    b"<html><body>"
+    b'<form action="/search" method="get"><input name="q"></form>'
+    b"<FORM data-x='a>b' METHOD=Post action=\"/\">"
+    + HIDDEN
+    + b'<input name="name"></FORM>'
+    b"<p>a < b</p>"
+    b'<form\n  method="post"\n>' + HIDDEN + b"<button>Go</button></form>"
+    b"<formula></formula>"
+    b"</body></html>"
+)
+
+
+def make_injector(calls):
+    async def token():
+        calls.append(1)
+        return "token"
+
+    return FormTokenInjector(FORM_FIELD_NAME, token)
+
+
+async def test_injector_whole_body() -> None:
+    calls: list[int] = []
+    injector = make_injector(calls)
+
+    assert await injector.feed(PAGE) + injector.flush() == EXPECTED
+    assert calls == [1]
+
+
+async def test_injector_split_everywhere() -> None:
+    # every split point, including inside tags and inside "<form" itself
+    for split in range(len(PAGE) + 1):
+        injector = make_injector([])
+
+        out = await injector.feed(PAGE[:split])
+        out += await injector.feed(PAGE[split:])
+        out += injector.flush()
+
+        assert out == EXPECTED, split
+
+
+async def test_injector_byte_by_byte() -> None:
+    injector = make_injector([])
+
+    out = b"".join([await injector.feed(PAGE[i : i + 1]) for i in range(len(PAGE))])
+
+    assert out + injector.flush() == EXPECTED
+
+
+async def test_injector_lazy_token() -> None:
+    calls: list[int] = []
+    injector = make_injector(calls)
+
+    page = b'<form method="get"></form><p>no post forms</p>'
+    assert await injector.feed(page) + injector.flush() == page
+    assert calls == []
+
+
+@pytest.mark.parametrize(
+    "action, injected",
+    [
+        ("", True),
+        ("/submit", True),
+        ("?page=2", True),
+        ("https://example.com/submit", True),
+        ("https://example.com:8443/submit", False),
+        ("http://example.com/submit", False),
+        ("https://evil.example/x", False),
+        ("//evil.example/x", False),
+        ("https:&#x2F;&#x2F;evil.example/x", False),
+        ("javascript:void(0)", False),
+    ],
+)
+async def test_injector_only_same_origin_actions(action, injected) -> None:
+    injector = FormTokenInjector(
+        FORM_FIELD_NAME,
+        make_injector([])._token,
+        base_url=URL("https://example.com/page"),
+    )
+
+    page = f'<form method="post" action="{action}"></form>'.encode()
+    out = await injector.feed(page) + injector.flush()
+
+    assert (HIDDEN in out) is injected
+
+
+async def test_injector_without_base_url() -> None:
+    injector = make_injector([])
+
+    page = b'<form method="post" action="https://example.com/x"></form>'
+    assert await injector.feed(page) + injector.flush() == page
+
+
+async def test_injector_gives_up_on_long_tag() -> None:
+    injector = make_injector([])
+    injector.max_tag_size = 16
+
+    chunk = b'<form title="' + b"x" * 32
+    assert await injector.feed(chunk) == chunk
+
+
+@pytest.fixture
+def create_app():
+    def go(loop, policy=None) -> web.Application:
+        async def handler_form(request):
+            return web.Response(
+                text='<form method="post"><input name="name"></form>',
+                content_type="text/html",
+            )
+
+        async def handler_plain(request):
+            return web.Response(text="<p>no forms</p>", content_type="text/html")
+
+        async def handler_stream(request):
+            response = InjectingStreamResponse(headers={"Content-Type": "text/html"})
+            await response.prepare(request)
+            await response.write(b'<form method="po')
+            await response.write(b'st"><input name="name"></form>')
+            await response.write_eof()
+            return response
+
+        async def handler_post(request):
+            return web.Response(text="OK")
+
+        app = web.Application(
+            middlewares=[aiohttp_csrf.csrf_middleware, csrf_inject_middleware]
+        )
+        aiohttp_csrf.setup(
+            app,
+            policy=policy or aiohttp_csrf.policy.FormPolicy(FORM_FIELD_NAME),
+            storage=aiohttp_csrf.storage.CookieStorage(
+                COOKIE_NAME, secret_phrase="test"
+            ),
+            rules=[Rule("/public", EXEMPT)],
+        )
+
+        app.router.add_get("/form", handler_form)
+        app.router.add_get("/exempt", aiohttp_csrf.csrf_exempt(handler_form))
+        app.router.add_get("/public/form", handler_form)
+        app.router.add_get("/plain", handler_plain)
+        app.router.add_get("/stream", handler_stream)
+        app.router.add_post("/", handler_post)
+
+        return app
+
+    yield go
+
+
+def hidden_token(body: str) -> str:
+    match = re.search(rf'name="{FORM_FIELD_NAME}" value="([^"]+)"', body)
+    assert match is not None
+    return match.group(1)
+
+
+@pytest.mark.parametrize("path", ["/form", "/stream", "/exempt", "/public/form"])
+async def test_inject_middleware(test_client, create_app, path) -> None:
+    client = await test_client(create_app)
+
+    resp = await client.get(path)
+    assert resp.status == 200
+
+    token = hidden_token(await resp.text())
+    assert resp.cookies[COOKIE_NAME].value == token
+
+    resp = await client.post("/", data={FORM_FIELD_NAME: token})
+    assert resp.status == 200
+
+
+async def test_inject_middleware_no_form(test_client, create_app) -> None:
+    client = await test_client(create_app)
+
+    resp = await client.get("/plain")
+    assert resp.status == 200
+    assert await resp.text() == "<p>no forms</p>"
+    assert COOKIE_NAME not in resp.cookies
+
+
+@pytest.mark.parametrize("path", ["/form", "/stream"])
+async def test_inject_middleware_combined_policy(test_client, create_app, path) -> None:
+    policy = aiohttp_csrf.policy.AnyOf(
+        aiohttp_csrf.policy.OriginPolicy(),
+        aiohttp_csrf.policy.AllOf(
+            aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME),
+            aiohttp_csrf.policy.FormPolicy(FORM_FIELD_NAME),
+        ),
+    )
+    client = await test_client(create_app, policy=policy)
+
+    resp = await client.get(path)
+    assert resp.status == 200
+
+    token = hidden_token(await resp.text())
+    assert resp.cookies[COOKIE_NAME].value == token
+
+
+async def test_inject_middleware_without_field_name(test_client, create_app) -> None:
+    policy = aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME)
+    client = await test_client(create_app, policy=policy)
+
+    resp = await client.get("/plain")
+    assert resp.status == 200
+    assert await resp.text() == "<p>no forms</p>"
+
+    resp = await client.get("/form")
+    assert resp.status == 500
@@ -0,0 +1,108 @@
+import struct
+
+import pytest
+
+import aiohttp_csrf
+from aiohttp_csrf.keyring import (
+    MmapKeyRing,
+    StaticKeyRing,
+    rotate_keyring,
+    write_keyring,
+)
+from aiohttp_csrf.token_generator import SignedTokenGenerator
+
+
+def test_static_keyring() -> None:
+    keyring = StaticKeyRing({"k1": "old secret", "k2": b"new secret"})
+
+    assert keyring.current() == ("k2", b"new secret")
+    assert keyring.get("k1") == b"old secret"
+    assert keyring.get("k3") is None
+
+    assert StaticKeyRing({"k1": "a", "k2": "b"}, current="k1").current()[0] == "k1"
+
+    for keys, current in [
+        ({}, None),
+        ({"k1": "a"}, "k2"),
+        ({"k.1": "a"}, None),
+        ({"k1": ""}, None),
+    ]:
+        with pytest.raises(ValueError):
+            StaticKeyRing(keys, current)
+
+
+def test_mmap_keyring_rotation(tmp_path) -> None:
+    path = str(tmp_path / "keys")
+    write_keyring(path, {"k1": "first"})
+
+    # two workers, each with its own mapping of the file
+    worker, other_worker = MmapKeyRing(path), MmapKeyRing(path)
+    assert worker.current() == ("k1", b"first")
+
+    generation = worker.generation
+    rotate_keyring(path, "k2", "second", keep=1)
+
+    assert worker.generation == generation + 2
+    for keyring in (worker, other_worker):
+        assert keyring.current() == ("k2", b"second")
+        assert keyring.get("k1") == b"first"
+
+    rotate_keyring(path, "k3", "third", keep=1)
+    assert worker.get("k1") is None
+    assert worker.get("k2") == b"second"
+
+
+def test_mmap_keyring_write_in_progress(tmp_path) -> None:
+    path = str(tmp_path / "keys")
+    write_keyring(path, {"k1": "first"})
+    keyring = MmapKeyRing(path)
+
+    write_keyring(path, {"k2": "second"})
+    # as a writer would leave it midway through an update
+    with open(path, "r+b") as f:
+        f.seek(8)
+        f.write(struct.pack("<Q", keyring.generation + 1))
+
+    assert keyring.current() == ("k1", b"first")
+
+
+def test_mmap_keyring_invalid(tmp_path) -> None:
+    path = tmp_path / "keys"
+    path.write_bytes(bytes(1024))
+
+    with pytest.raises(ValueError):
+        MmapKeyRing(str(path))
+
+    with pytest.raises(ValueError):
+        write_keyring(str(path), {"k1": b"x" * 65})
+
+
+def test_signed_token_generator_keyring(tmp_path) -> None:
+    path = str(tmp_path / "keys")
+    write_keyring(path, {"k1": "first"})
+
+    token_generator = SignedTokenGenerator(keyring=MmapKeyRing(path))
+    token = token_generator.generate("identity")
+
+    assert token.startswith("k1.")
+    assert token_generator.verify(token, "identity")
+    assert not token_generator.verify(token, "other")
+    assert not token_generator.verify("k9" + token[2:], "identity")
+
+    rotate_keyring(path, "k2", "second", keep=1)
+
+    assert token_generator.generate("identity").startswith("k2.")
+    assert token_generator.verify(token, "identity")
+
+    rotate_keyring(path, "k3", "third", keep=1)
+
+    assert not token_generator.verify(token, "identity")
+
+    with pytest.raises(TypeError):
+        SignedTokenGenerator()
+
+    storage = aiohttp_csrf.storage.SignedTokenStorage(
+        aiohttp_csrf.storage.cookie_identity("session"),
+        keyring=StaticKeyRing({"k1": "secret"}),
+    )
+    assert storage.token_generator.keyring is not None
@@ -0,0 +1,124 @@
+import time
+from unittest import mock
+
+from aiohttp import web
+
+import aiohttp_csrf
+from aiohttp_csrf.memory import ShardedTTLTable, decode_token, encode_token
+
+from .conftest import COOKIE_NAME, HEADER_NAME
+
+
+def test_token_encoding() -> None:
+    for token in ["00ff" * 16, "not-hex", "ABCD", "AAECAwQFBgcICQoLDA0ODw"]:
+        assert decode_token(encode_token(token)) == token
+
+    assert len(encode_token("00ff" * 16)) == 33
+    assert len(encode_token("AAECAwQFBgcICQoLDA0ODw")) == 17
+
+
+def test_table_expiry() -> None:
+    table = ShardedTTLTable(ttl=10, shards=1)
+    now = time.time()
+
+    with mock.patch("time.time", return_value=now):
+        table.set("a", b"1")
+        table.set("b", b"2")
+
+    with mock.patch("time.time", return_value=now + 5):
+        table.set("b", b"3")
+        assert table.get("a") == b"1"
+
+    with mock.patch("time.time", return_value=now + 12):
+        assert table.get("a") is None
+        assert table.get("b") == b"3"
+        assert len(table) == 1
+
+    with mock.patch("time.time", return_value=now + 17):
+        assert table.get("b") is None
+        assert len(table) == 0
+
+
+def test_table_bounded() -> None:
+    table = ShardedTTLTable(ttl=10, shards=1, max_entries=2)
+
+    table.set("a", b"1")
+    table.set("b", b"2")
+    table.set("c", b"3")
+
+    assert table.get("a") is None
+    assert len(table) == 2
+
+
+def test_table_snapshot(tmp_path) -> None:
+    path = str(tmp_path / "tokens")
+
+    table = ShardedTTLTable(ttl=10)
+    table.set("a", encode_token("00ff" * 16))
+    table.set("b", encode_token("text"))
+    # long tokens and keys, e.g. HashedTokenGenerator(token_size=128)
+    table.set("c" * 200, encode_token("ab" * 128))
+    table.set("d", encode_token("long text " * 100))
+    table.dump(path)
+
+    restored = ShardedTTLTable(ttl=10)
+    restored.load(path)
+
+    assert restored.get("a") == table.get("a")
+    assert restored.get("b") == table.get("b")
+    assert restored.get("c" * 200) == table.get("c" * 200)
+    assert restored.get("d") == table.get("d")
+    assert len(restored) == 4
+
+    with mock.patch("time.time", return_value=time.time() + 11):
+        expired = ShardedTTLTable(ttl=10)
+        expired.load(path)
+
+    assert len(expired) == 0
+
+
+async def test_memory_storage(test_client, tmp_path) -> None:
+    path = str(tmp_path / "tokens")
+
+    storage = aiohttp_csrf.storage.MemoryStorage(
+        COOKIE_NAME, snapshot_path=path, secret_phrase="test"
+    )
+
+    def create_app(loop):
+        async def handler_get(request):
+            token = await aiohttp_csrf.generate_token(request)
+
+            return web.Response(body=token.encode("utf-8"))
+
+        async def handler_post(request):
+            return web.Response(body=b"OK")
+
+        app = web.Application()
+        aiohttp_csrf.setup(
+            app,
+            policy=aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME),
+            storage=storage,
+        )
+        app.middlewares.append(aiohttp_csrf.csrf_middleware)
+        app.router.add_get("/", handler_get)
+        app.router.add_post("/", handler_post)
+
+        return app
+
+    client = await test_client(create_app)
+
+    resp = await client.get("/")
+    token = await resp.text()
+
+    storage.snapshot()
+    restored = aiohttp_csrf.storage.MemoryStorage(
+        COOKIE_NAME, snapshot_path=path, secret_phrase="test"
+    )
+    client_id = resp.cookies[COOKIE_NAME].value
+    assert await restored._load(client_id) == token
+
+    resp = await client.post("/", headers={HEADER_NAME: token})
+    assert resp.status == 200
+
+    resp = await client.post("/", headers={HEADER_NAME: token})
+    assert resp.status == 403
@@ -0,0 +1,85 @@
+from aiohttp import web
+
+import aiohttp_csrf
+from aiohttp_csrf.metrics import (
+    CHECK_FAILURES,
+    TOKEN_WRITES,
+    TOKENS_GENERATED,
+    InMemoryMetrics,
+)
+from aiohttp_csrf.policy import Reason, as_reason
+from aiohttp_csrf.tracing import POLICY_CHECK, STORAGE_GET, STORAGE_SAVE_TOKEN
+
+from .conftest import COOKIE_NAME, HEADER_NAME
+
+
+def create_app(loop, metrics) -> web.Application:
+    async def handler_get(request):
+        await aiohttp_csrf.generate_token(request)
+
+        return web.Response(body=b"OK")
+
+    async def handler_post(request):
+        return web.Response(body=b"OK")
+
+    app = web.Application(middlewares=[aiohttp_csrf.csrf_middleware])
+
+    aiohttp_csrf.setup(
+        app,
+        policy=aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME),
+        storage=aiohttp_csrf.storage.CookieStorage(COOKIE_NAME, secret_phrase="test"),
+        metrics=metrics,
+    )
+
+    app.router.add_get("/", handler_get)
+    app.router.add_post("/", handler_post)
+
+    return app
+
+
+def test_reason_truthiness() -> None:
+    assert Reason.OK
+    assert not any(reason for reason in Reason if reason is not Reason.OK)
+
+    assert as_reason(True) is Reason.OK
+    assert as_reason(False) is Reason.REJECTED
+    assert as_reason(Reason.MISMATCH) is Reason.MISMATCH
+
+
+async def test_metrics(test_client) -> None:
+    metrics = InMemoryMetrics()
+    client = await test_client(create_app, metrics=metrics)
+
+    resp = await client.get("/")
+    assert resp.status == 200
+    token = resp.cookies[COOKIE_NAME].value
+
+    resp = await client.post("/")
+    assert resp.status == 403
+
+    resp = await client.post("/", headers={HEADER_NAME: token + "x"})
+    assert resp.status == 403
+
+    resp = await client.post("/", headers={HEADER_NAME: token})
+    assert resp.status == 200
+
+    snapshot = metrics.snapshot()
+
+    # every request issues a token, but rejected ones never save it
+    assert snapshot["counters"][TOKENS_GENERATED] == 4
+    assert snapshot["counters"][TOKEN_WRITES] == 2
+    assert snapshot["counters"][CHECK_FAILURES] == 2
+    assert snapshot["failures"] == {"missing_header": 1, "mismatch": 1}
+
+    histograms = snapshot["histograms"]
+    assert histograms[STORAGE_GET]["count"] == 3
+    assert histograms[POLICY_CHECK]["count"] == 3
+    assert histograms[STORAGE_SAVE_TOKEN]["count"] == 2
+    assert histograms[POLICY_CHECK]["buckets"][float("inf")] == 3
+
+
+async def test_no_metrics(test_client) -> None:
+    client = await test_client(create_app, metrics=None)
+
+    resp = await client.get("/")
+    assert resp.status == 200
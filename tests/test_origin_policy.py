@@ -0,0 +1,92 @@
+import pytest
+from aiohttp import web
+
+import aiohttp_csrf
+
+
+class UnreadableStorage(aiohttp_csrf.storage.BaseStorage):
+    async def _get(self, request):
+        raise AssertionError("storage must not be read")
+
+    async def _save_token(self, request, response, token):
+        raise AssertionError("storage must not be written")
+
+
+@pytest.fixture
+def create_app(init_app):
+    def go(loop, combined=False, **kwargs):
+        async def handler_post(request):
+            return web.Response(body=b"OK")
+
+        policy = aiohttp_csrf.policy.OriginPolicy(**kwargs)
+        if combined:
+            policy = aiohttp_csrf.policy.AnyOf(
+                policy, aiohttp_csrf.policy.HeaderPolicy("X-CSRF-TOKEN")
+            )
+
+        app = init_app(
+            policy=policy,
+            storage=UnreadableStorage(secret_phrase="test"),
+            handlers=[("POST", "/", handler_post)],
+            loop=loop,
+        )
+
+        app.middlewares.append(aiohttp_csrf.csrf_middleware)
+
+        return app
+
+    yield go
+
+
+@pytest.mark.parametrize("combined", [False, True])
+async def test_sec_fetch_site(test_client, create_app, combined) -> None:
+    # in AnyOf, storage is only read once a policy needing the token is reached
+    client = await test_client(create_app, combined=combined)
+
+    resp = await client.post("/", headers={"Sec-Fetch-Site": "same-origin"})
+    assert resp.status == 200
+    assert "Set-Cookie" not in resp.headers
+
+    if combined:
+        return  # HeaderPolicy would go on to read the storage
+
+    resp = await client.post("/", headers={"Sec-Fetch-Site": "cross-site"})
+    assert resp.status == 403
+
+
+async def test_origin(test_client, create_app) -> None:
+    client = await test_client(create_app, trusted_origins=["https://trusted.com"])
+
+    own = str(client.make_url("/").origin())
+
+    for headers, status in [
+        ({"Origin": own}, 200),
+        ({"Origin": "https://trusted.com"}, 200),
+        ({"Origin": "https://evil.com"}, 403),
+        ({"Origin": "null"}, 403),
+        ({"Referer": own + "/form"}, 200),
+        ({"Referer": "https://evil.com/form"}, 403),
+        ({}, 403),
+    ]:
+        resp = await client.post("/", headers=headers)
+        assert resp.status == status, headers
+
+
+async def test_trusted_proxy(test_client, create_app) -> None:
+    client = await test_client(create_app, trusted_proxies=["127.0.0.1"])
+
+    headers = {"Origin": "https://public.example", "X-Forwarded-Host": "public.example"}
+    headers["X-Forwarded-Proto"] = "https"
+
+    resp = await client.post("/", headers=headers)
+    assert resp.status == 200
+
+
+async def test_untrusted_proxy(test_client, create_app) -> None:
+    client = await test_client(create_app)
+
+    headers = {"Origin": "https://public.example", "X-Forwarded-Host": "public.example"}
+    headers["X-Forwarded-Proto"] = "https"
+
+    resp = await client.post("/", headers=headers)
+    assert resp.status == 403
@@ -0,0 +1,121 @@
+from aiohttp.test_utils import make_mocked_request
+
+from aiohttp_csrf.policy import (
+    COST_BODY,
+    COST_HEADERS,
+    AllOf,
+    AnyOf,
+    FormPolicy,
+    HeaderPolicy,
+    LazyOriginalToken,
+    OriginPolicy,
+    Reason,
+)
+
+from .conftest import HEADER_NAME
+
+
+class RecordingPolicy:
+    def __init__(self, name, result, cost, calls):
+        self.name = name
+        self.result = result
+        self.cost = cost
+        self.calls = calls
+
+    async def check(self, request, original_value):
+        self.calls.append(self.name)
+        return self.result
+
+
+async def test_any_of_runs_cheapest_first() -> None:
+    calls: list[str] = []
+    policy = AnyOf(
+        RecordingPolicy("body", True, COST_BODY, calls),
+        RecordingPolicy("headers", True, COST_HEADERS, calls),
+    )
+
+    request = make_mocked_request("POST", "/")
+
+    assert await policy.check(request, "token")
+    assert calls == ["headers"]
+
+
+async def test_any_of_falls_through() -> None:
+    calls: list[str] = []
+    policy = AnyOf(
+        RecordingPolicy("body", True, COST_BODY, calls),
+        RecordingPolicy("headers", False, COST_HEADERS, calls),
+    )
+
+    request = make_mocked_request("POST", "/")
+
+    assert await policy.check(request, "token")
+    assert calls == ["headers", "body"]
+
+
+async def test_all_of_stops_at_first_rejection() -> None:
+    calls: list[str] = []
+    policy = AllOf(
+        RecordingPolicy("body", True, COST_BODY, calls),
+        RecordingPolicy("headers", False, COST_HEADERS, calls),
+    )
+
+    request = make_mocked_request("POST", "/")
+
+    assert not await policy.check(request, "token")
+    assert calls == ["headers"]
+
+
+async def test_requires_token() -> None:
+    assert not AnyOf(OriginPolicy()).requires_token
+    assert AnyOf(OriginPolicy(), HeaderPolicy(HEADER_NAME)).requires_token
+
+
+async def test_check_headers() -> None:
+    request = make_mocked_request("POST", "/", headers={HEADER_NAME: "token"})
+
+    any_of = AnyOf(HeaderPolicy(HEADER_NAME), FormPolicy("field"))
+    assert await any_of.check_headers(request, "token") is Reason.OK
+    assert await any_of.check_headers(request, "other") is None
+
+    all_of = AllOf(HeaderPolicy(HEADER_NAME), OriginPolicy())
+    assert await all_of.check_headers(request, "other") is Reason.MISSING_ORIGIN
+
+
+async def test_any_of_reads_token_lazily() -> None:
+    loads: list[int] = []
+
+    async def load():
+        loads.append(1)
+        return "token"
+
+    policy = AnyOf(OriginPolicy(), HeaderPolicy(HEADER_NAME))
+
+    request = make_mocked_request(
+        "POST", "/", headers={"Sec-Fetch-Site": "same-origin"}
+    )
+    token = LazyOriginalToken(load)
+    assert await policy.check_lazily(request, token)
+    assert not token.loaded
+
+    request = make_mocked_request(
+        "POST", "/", headers={"Sec-Fetch-Site": "cross-site", HEADER_NAME: "token"}
+    )
+    token = LazyOriginalToken(load)
+    assert await policy.check_lazily(request, token)
+    assert await policy.check_headers_lazily(request, token)
+    assert loads == [1]
+
+
+async def test_lazy_token_revoked() -> None:
+    async def load():
+        return None
+
+    policy = AnyOf(OriginPolicy(), HeaderPolicy(HEADER_NAME))
+    request = make_mocked_request(
+        "POST", "/", headers={"Sec-Fetch-Site": "cross-site", HEADER_NAME: "token"}
+    )
+
+    assert await policy.check_lazily(request, LazyOriginalToken(load)) is (
+        Reason.REVOKED
+    )
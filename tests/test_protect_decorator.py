@@ -129,3 +129,88 @@ async def test_handle_http_exceptions(test_client, init_app) -> None:
     resp = await client.post("/", headers=headers)
 
     assert resp.status == 400
+
+
+def create_view_app(loop):
+    class TestView(web.View):
+        async def get(self):
+            await aiohttp_csrf.generate_token(self.request)
+
+            return web.Response(body=b"OK")
+
+        @aiohttp_csrf.csrf_protect(
+            policy=aiohttp_csrf.policy.AllOf(
+                aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME),
+                aiohttp_csrf.policy.OriginPolicy(),
+            ),
+        )
+        async def post(self):
+            return web.Response(body=b"OK")
+
+        @aiohttp_csrf.csrf_exempt
+        async def put(self):
+            return web.Response(body=b"OK")
+
+    policy = aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME)
+    storage = aiohttp_csrf.storage.CookieStorage(COOKIE_NAME, secret_phrase="test")
+
+    app = web.Application(middlewares=[aiohttp_csrf.csrf_middleware])
+
+    aiohttp_csrf.setup(app, policy=policy, storage=storage)
+
+    app.router.add_view("/", TestView)
+
+    return app
+
+
+async def test_class_view_method_policy_with_middleware(test_client) -> None:
+    client = await test_client(create_view_app)
+
+    resp = await client.get("/")
+    token = resp.cookies[COOKIE_NAME].value
+
+    resp = await client.post(
+        "/", headers={HEADER_NAME: token, "Origin": "https://evil.example"}
+    )
+    assert resp.status == 403
+
+    resp = await client.post(
+        "/", headers={HEADER_NAME: token, "Origin": str(client.make_url("/").origin())}
+    )
+    assert resp.status == 200
+
+    resp = await client.put("/")
+    assert resp.status == 200
+
+
+async def test_nested_protect_checks_inner_policy(test_client, init_app) -> None:
+    strict = aiohttp_csrf.policy.AllOf(
+        aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME),
+        aiohttp_csrf.policy.OriginPolicy(),
+    )
+
+    @aiohttp_csrf.csrf_protect
+    async def handler_get(request):
+        await aiohttp_csrf.generate_token(request)
+
+        return web.Response(body=b"OK")
+
+    @aiohttp_csrf.csrf_protect
+    @aiohttp_csrf.csrf_protect(policy=strict)
+    async def handler_post(request):
+        return web.Response(body=b"OK")
+
+    client = await test_client(
+        init_app,
+        policy=aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME),
+        storage=aiohttp_csrf.storage.CookieStorage(COOKIE_NAME, secret_phrase="test"),
+        handlers=[("GET", "/", handler_get), ("POST", "/", handler_post)],
+    )
+
+    resp = await client.get("/")
+    token = resp.cookies[COOKIE_NAME].value
+
+    resp = await client.post(
+        "/", headers={HEADER_NAME: token, "Origin": "https://evil.example"}
+    )
+    assert resp.status == 403
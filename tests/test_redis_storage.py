@@ -0,0 +1,215 @@
+import asyncio
+from unittest import mock
+
+import pytest
+from aiohttp import web
+
+import aiohttp_csrf
+from aiohttp_csrf.resp import RedisClient, RedisError
+
+from .conftest import COOKIE_NAME, HEADER_NAME
+
+
+class FakeRedisServer:
+    """Just enough of the Redis protocol for the token storage."""
+
+    def __init__(self):
+        self.data = {}
+        self.connections = 0
+        self.disconnects = 0
+        self.server = None
+
+    async def start(self) -> RedisClient:
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        port = self.server.sockets[0].getsockname()[1]
+
+        return RedisClient("127.0.0.1", port, max_connections=1)
+
+    async def close(self) -> None:
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer) -> None:
+        self.connections += 1
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+
+            args = []
+            for _ in range(int(line[1:-2])):
+                size = int((await reader.readline())[1:-2])
+                args.append((await reader.readexactly(size + 2))[:-2])
+
+            writer.write(self.reply(args))
+
+        self.disconnects += 1
+        writer.close()
+
+    def reply(self, args) -> bytes:
+        command = args[0].upper()
+
+        if command == b"GET":
+            value = self.data.get(args[1])
+            if value is None:
+                return b"$-1\r\n"
+            return b"$%d\r\n%s\r\n" % (len(value), value)
+
+        if command == b"SET":
+            self.data[args[1]] = args[2]
+            return b"+OK\r\n"
+
+        if command == b"AUTH":
+            return b"-WRONGPASS invalid password\r\n"
+
+        return b"-ERR unknown command\r\n"
+
+
+def create_app(loop, client, write_behind=False):
+    async def handler_get(request):
+        token = await aiohttp_csrf.generate_token(request)
+
+        return web.Response(body=token.encode("utf-8"))
+
+    async def handler_post(request):
+        return web.Response(body=b"OK")
+
+    app = web.Application()
+
+    aiohttp_csrf.setup(
+        app,
+        policy=aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME),
+        storage=aiohttp_csrf.storage.RedisStorage(
+            COOKIE_NAME, client, write_behind=write_behind, secret_phrase="test"
+        ),
+    )
+
+    app.middlewares.append(aiohttp_csrf.csrf_middleware)
+
+    app.router.add_get("/", handler_get)
+    app.router.add_post("/", handler_post)
+
+    return app
+
+
+@pytest.mark.parametrize("write_behind", [False, True])
+async def test_redis_storage(test_client, write_behind) -> None:
+    server = FakeRedisServer()
+    redis = await server.start()
+
+    client = await test_client(create_app, client=redis, write_behind=write_behind)
+
+    resp = await client.get("/")
+    token = await resp.text()
+    client_id = resp.cookies[COOKIE_NAME].value
+
+    await asyncio.sleep(0.01)
+
+    assert server.data == {b"aiohttp_csrf:" + client_id.encode(): token.encode()}
+
+    resp = await client.post("/", headers={HEADER_NAME: token})
+    assert resp.status == 200
+    assert COOKIE_NAME not in resp.cookies
+
+    await asyncio.sleep(0.01)
+
+    resp = await client.post("/", headers={HEADER_NAME: token})
+    assert resp.status == 403
+
+    await redis.close()
+    await server.close()
+
+
+async def test_redis_client_pipelining(loop) -> None:
+    server = FakeRedisServer()
+    redis = await server.start()
+
+    await asyncio.gather(*(redis.execute("SET", f"k{i}", i) for i in range(20)))
+    values = await asyncio.gather(*(redis.execute("GET", f"k{i}") for i in range(20)))
+
+    assert values == [str(i).encode() for i in range(20)]
+    assert server.connections == 1
+
+    with pytest.raises(RedisError):
+        await redis.execute("NOPE")
+
+    assert await redis.execute("GET", "k1") == b"1"
+
+    await redis.close()
+    await server.close()
+
+
+async def test_redis_client_drains_writer(loop) -> None:
+    server = FakeRedisServer()
+    redis = await server.start()
+
+    await redis.execute("SET", "k", "v")
+    writer = redis._connections[0]._writer
+
+    value = b"x" * 256 * 1024
+    with mock.patch.object(writer, "drain", wraps=writer.drain) as drain:
+        await asyncio.gather(*(redis.execute("SET", f"k{i}", value) for i in range(8)))
+
+    assert drain.await_count == 8
+    assert all(server.data[f"k{i}".encode()] == value for i in range(8))
+
+    await redis.close()
+    await server.close()
+
+
+async def test_redis_client_write_failure(loop) -> None:
+    server = FakeRedisServer()
+    redis = await server.start()
+
+    await redis.execute("SET", "k", "v")
+    connection = redis._connections[0]
+
+    with mock.patch.object(
+        connection._writer, "drain", side_effect=ConnectionResetError("lost")
+    ):
+        with pytest.raises(ConnectionError):
+            await connection.execute("GET", "k")
+
+    # the abandoned reply does not shift the replies that follow
+    assert await connection.execute("GET", "k") == b"v"
+
+    await redis.close()
+    await server.close()
+
+
+async def test_redis_storage_flush(loop) -> None:
+    server = FakeRedisServer()
+    redis = await server.start()
+
+    storage = aiohttp_csrf.storage.RedisStorage(
+        COOKIE_NAME, redis, write_behind=True, secret_phrase="test"
+    )
+
+    for i in range(5):
+        await storage._store(f"client-{i}", f"token-{i}")
+    assert storage._writes
+
+    await storage.flush()
+
+    assert not storage._writes
+    assert len(server.data) == 5
+
+    await redis.close()
+    await server.close()
+
+
+async def test_redis_client_closes_connection_on_auth_failure(loop) -> None:
+    server = FakeRedisServer()
+    redis = await server.start()
+    redis.password = "wrong"
+
+    with pytest.raises(RedisError):
+        await redis.execute("GET", "k")
+
+    await asyncio.sleep(0.01)
+
+    assert server.connections == server.disconnects == 1
+    assert redis._connections == []
+
+    await server.close()
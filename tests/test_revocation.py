@@ -0,0 +1,159 @@
+import time
+from unittest import mock
+
+import pytest
+from aiohttp import web
+
+import aiohttp_csrf
+from aiohttp_csrf.metrics import InMemoryMetrics
+from aiohttp_csrf.revocation import RevocationTableFull, SharedRevocationFilter
+
+from .conftest import COOKIE_NAME, HEADER_NAME
+
+
+def test_revocation_filter(tmp_path) -> None:
+    path = str(tmp_path / "revoked")
+    revocation = SharedRevocationFilter(path, capacity=64)
+    # another worker's view of the same file
+    other = SharedRevocationFilter(path, capacity=64)
+
+    revocation.revoke("token-1")
+
+    assert revocation.is_revoked("token-1")
+    assert other.is_revoked("token-1")
+    assert not other.is_revoked("token-2")
+
+    with pytest.raises(ValueError):
+        SharedRevocationFilter(path, capacity=128)
+
+
+def test_revocation_filter_expiry(tmp_path) -> None:
+    revocation = SharedRevocationFilter(str(tmp_path / "revoked"), capacity=64)
+    now = time.time()
+
+    revocation.revoke("token-1", ttl=10)
+    revocation.revoke("token-2", ttl=100)
+
+    with mock.patch("time.time", return_value=now + 50):
+        assert not revocation.is_revoked("token-1")
+        assert revocation.is_revoked("token-2")
+
+        revocation.compact()
+        assert revocation.is_revoked("token-2")
+
+        # the expired slot is reused
+        revocation.revoke("token-1")
+        assert revocation.is_revoked("token-1")
+
+
+def test_revocation_filter_full(tmp_path) -> None:
+    revocation = SharedRevocationFilter(str(tmp_path / "revoked"), capacity=1)
+    revocation.max_probes = 2
+
+    revocation.revoke("token-1")
+    revocation.revoke("token-2")
+
+    with pytest.raises(RevocationTableFull):
+        revocation.revoke("token-3")
+
+    assert revocation.is_revoked("token-1") and revocation.is_revoked("token-2")
+    assert not revocation.is_revoked("token-3")
+
+
+@pytest.fixture
+def metrics():
+    return InMemoryMetrics()
+
+
+@pytest.fixture
+def create_app(tmp_path, metrics):
+    def go(loop) -> web.Application:
+        async def handler_get(request):
+            token = await aiohttp_csrf.generate_token(request)
+            return web.Response(text=token)
+
+        async def handler_post(request):
+            return web.Response(text="OK")
+
+        async def handler_logout(request):
+            await aiohttp_csrf.revoke_token(request)
+            return web.Response(text="bye")
+
+        app = web.Application(middlewares=[aiohttp_csrf.csrf_middleware])
+        aiohttp_csrf.setup(
+            app,
+            policy=aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME),
+            storage=aiohttp_csrf.storage.CookieStorage(
+                COOKIE_NAME,
+                secret_phrase="test",
+                rotation=aiohttp_csrf.rotation.PerSessionRotation(),
+            ),
+            metrics=metrics,
+            revocation=SharedRevocationFilter(str(tmp_path / "revoked"), 64),
+        )
+
+        app.router.add_get("/", handler_get)
+        app.router.add_post("/", handler_post)
+        app.router.add_post("/logout", handler_logout)
+
+        return app
+
+    yield go
+
+
+async def test_revoke_token(test_client, create_app, metrics) -> None:
+    client = await test_client(create_app)
+
+    resp = await client.get("/")
+    token = await resp.text()
+
+    resp = await client.post("/", headers={HEADER_NAME: token})
+    assert resp.status == 200
+
+    resp = await client.post("/logout", headers={HEADER_NAME: token})
+    assert resp.status == 200
+
+    resp = await client.post("/", headers={HEADER_NAME: token})
+    assert resp.status == 403
+
+    assert metrics.snapshot()["failures"] == {"revoked": 1}
+
+
+async def test_revoke_signed_token(test_client, tmp_path) -> None:
+    revocation = SharedRevocationFilter(str(tmp_path / "revoked"), 64)
+
+    def create_app(loop) -> web.Application:
+        async def handler_get(request):
+            token = await aiohttp_csrf.generate_token(request)
+            return web.Response(text=token)
+
+        async def handler_post(request):
+            return web.Response(text="OK")
+
+        app = web.Application(middlewares=[aiohttp_csrf.csrf_middleware])
+        aiohttp_csrf.setup(
+            app,
+            policy=aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME),
+            storage=aiohttp_csrf.storage.SignedTokenStorage(
+                lambda request: "identity", secret_phrase="test"
+            ),
+            revocation=revocation,
+        )
+
+        app.router.add_get("/", handler_get)
+        app.router.add_post("/", handler_post)
+
+        return app
+
+    client = await test_client(create_app)
+
+    resp = await client.get("/")
+    token = await resp.text()
+
+    resp = await client.post("/", headers={HEADER_NAME: token})
+    assert resp.status == 200
+
+    revocation.revoke(token)
+
+    resp = await client.post("/", headers={HEADER_NAME: token})
+    assert resp.status == 403
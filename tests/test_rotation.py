@@ -0,0 +1,130 @@
+import time
+from unittest import mock
+
+import pytest
+from aiohttp import web
+
+import aiohttp_csrf
+
+from .conftest import COOKIE_NAME, HEADER_NAME
+
+
+@pytest.fixture
+def create_app(init_app):
+    def go(loop, rotation):
+        async def handler_get(request):
+            await aiohttp_csrf.generate_token(request)
+
+            return web.Response(body=b"OK")
+
+        async def handler_post(request):
+            return web.Response(body=b"OK")
+
+        handlers = [("GET", "/", handler_get), ("POST", "/", handler_post)]
+
+        storage = aiohttp_csrf.storage.CookieStorage(
+            COOKIE_NAME, secret_phrase="test", rotation=rotation
+        )
+
+        app = init_app(
+            policy=aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME),
+            storage=storage,
+            handlers=handlers,
+            loop=loop,
+        )
+
+        app.middlewares.append(aiohttp_csrf.csrf_middleware)
+
+        return app
+
+    yield go
+
+
+async def test_per_session_rotation(test_client, create_app) -> None:
+    client = await test_client(
+        create_app, rotation=aiohttp_csrf.rotation.PerSessionRotation()
+    )
+
+    resp = await client.get("/")
+
+    token = resp.cookies[COOKIE_NAME].value
+
+    resp = await client.get("/")
+
+    assert COOKIE_NAME not in resp.cookies
+
+    headers = {HEADER_NAME: token}
+
+    for _ in range(3):
+        resp = await client.post("/", headers=headers)
+
+        assert resp.status == 200
+        assert COOKIE_NAME not in resp.cookies
+
+
+async def test_timed_rotation(test_client, create_app) -> None:
+    client = await test_client(
+        create_app, rotation=aiohttp_csrf.rotation.TimedRotation(60)
+    )
+
+    resp = await client.get("/")
+
+    headers = {HEADER_NAME: resp.cookies[COOKIE_NAME].value}
+
+    resp = await client.post("/", headers=headers)
+
+    assert resp.status == 200
+    assert COOKIE_NAME not in resp.cookies
+
+    with mock.patch("time.monotonic", return_value=time.monotonic() + 61):
+        resp = await client.post("/", headers=headers)
+
+    assert resp.status == 200
+    assert COOKIE_NAME in resp.cookies
+
+    resp = await client.post("/", headers=headers)
+
+    assert resp.status == 403
+
+
+async def test_usage_rotation(test_client, create_app) -> None:
+    client = await test_client(
+        create_app, rotation=aiohttp_csrf.rotation.UsageRotation(2)
+    )
+
+    resp = await client.get("/")
+
+    headers = {HEADER_NAME: resp.cookies[COOKIE_NAME].value}
+
+    resp = await client.post("/", headers=headers)
+
+    assert resp.status == 200
+    assert COOKIE_NAME not in resp.cookies
+
+    resp = await client.post("/", headers=headers)
+
+    assert resp.status == 200
+    assert COOKIE_NAME in resp.cookies
+
+    resp = await client.post("/", headers=headers)
+
+    assert resp.status == 403
+
+
+def test_tracking_rotation_is_lru_of_issued_tokens() -> None:
+    rotation = aiohttp_csrf.rotation.UsageRotation(5, max_tokens=2)
+
+    # tokens it did not issue are neither tracked nor kept
+    rotation.token_used("sent-by-client")
+    assert rotation.should_rotate("sent-by-client")
+    assert len(rotation._tokens) == 0
+
+    rotation.token_issued("a")
+    rotation.token_issued("b")
+    rotation.token_used("a")
+
+    # "a" was used last, so issuing "c" evicts "b"
+    rotation.token_issued("c")
+    assert not rotation.should_rotate("a")
+    assert rotation.should_rotate("b")
+    assert not rotation.should_rotate("c")
@@ -0,0 +1,141 @@
+from unittest import mock
+
+import pytest
+from aiohttp import web
+
+import aiohttp_csrf
+from aiohttp_csrf.rules import EXEMPT, PROTECT, Rule, RuleTable
+
+from .conftest import COOKIE_NAME, FORM_FIELD_NAME, HEADER_NAME
+
+
+def test_rule_table_lookup() -> None:
+    policy = aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME)
+    table = RuleTable(
+        [
+            Rule("/api/admin", PROTECT),
+            Rule("/api", policy),
+            Rule("/hooks/", EXEMPT),
+            Rule(r"/files/\d+/upload", EXEMPT, regex=True),
+        ]
+    )
+
+    assert table.lookup("/api") is policy
+    assert table.lookup("/api/users") is policy
+    assert table.lookup("/apis") is None
+    assert table.lookup("/api/admin/users") is PROTECT
+    assert table.lookup("/hooks/github") is EXEMPT
+    assert table.lookup("/hooks") is None
+    assert table.lookup("/files/12/upload") is EXEMPT
+    assert table.lookup("/files/12/upload/more") is None
+    assert table.lookup("/") is None
+
+    assert RuleTable([]).lookup("/") is None
+
+
+def test_rule_table_invalid() -> None:
+    with pytest.raises(ValueError):
+        RuleTable([Rule("api", EXEMPT)])
+
+    with pytest.raises(ValueError):
+        RuleTable([Rule("/files/(", EXEMPT, regex=True)])
+
+    # a global flag is only valid at the start of the combined pattern
+    with pytest.raises(ValueError):
+        RuleTable([Rule("/a", EXEMPT), Rule("(?i)/b", EXEMPT, regex=True)])
+
+    # group numbers shift once the rules are combined
+    for pattern in [r"/(\w+)/\1", r"/(a)?(?(1)b|c)"]:
+        with pytest.raises(ValueError):
+            RuleTable([Rule(pattern, EXEMPT, regex=True)])
+
+
+def test_rule_table_regex_groups() -> None:
+    table = RuleTable(
+        [
+            Rule(r"/(?i:Admin)/(?P<x>\w+)/(?P=x)", EXEMPT, regex=True),
+            Rule(r"/literal\\1", PROTECT, regex=True),
+        ]
+    )
+
+    assert table.lookup("/ADMIN/a/a") is EXEMPT
+    assert table.lookup("/admin/a/b") is None
+    assert table.lookup("/literal\\1") is PROTECT
+
+
+@pytest.fixture
+def create_app(tmp_path):
+    (tmp_path / "style.css").write_text("body {}")
+
+    def go(loop) -> web.Application:
+        async def handler(request):
+            if request.method == "GET":
+                await aiohttp_csrf.generate_token(request)
+
+            return web.Response(body=b"OK")
+
+        @aiohttp_csrf.csrf_protect(policy=aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME))
+        async def handler_protect(request):
+            return web.Response(body=b"OK")
+
+        app = web.Application(middlewares=[aiohttp_csrf.csrf_middleware])
+        aiohttp_csrf.setup(
+            app,
+            policy=aiohttp_csrf.policy.FormPolicy(FORM_FIELD_NAME),
+            storage=aiohttp_csrf.storage.CookieStorage(
+                COOKIE_NAME, secret_phrase="test"
+            ),
+            rules=[
+                Rule("/hooks", EXEMPT),
+                Rule("/api", aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME)),
+            ],
+        )
+
+        app.router.add_get("/", handler)
+        app.router.add_post("/", handler)
+        app.router.add_post("/hooks/github", handler)
+        app.router.add_post("/api/items", handler)
+        app.router.add_post("/protect", handler_protect)
+        app.router.add_static("/static", tmp_path)
+
+        return app
+
+    yield go
+
+
+async def test_rules(test_client, create_app) -> None:
+    client = await test_client(create_app)
+
+    resp = await client.post("/hooks/github")
+    assert resp.status == 200
+
+    resp = await client.post("/")
+    assert resp.status == 403
+
+    resp = await client.get("/")
+    token = resp.cookies[COOKIE_NAME].value
+
+    # the /api rule checks the header instead of the form field
+    resp = await client.post("/api/items", data={FORM_FIELD_NAME: token})
+    assert resp.status == 403
+
+    resp = await client.post("/api/items", headers={HEADER_NAME: token})
+    assert resp.status == 200
+    token = resp.cookies[COOKIE_NAME].value
+
+    resp = await client.post("/protect", headers={HEADER_NAME: token})
+    assert resp.status == 200
+
+
+async def test_static_bypass(test_client, create_app) -> None:
+    client = await test_client(create_app)
+    storage = client.server.app[aiohttp_csrf.APP_CONFIG_KEY].storage
+
+    with mock.patch.object(storage, "save_token") as save_token:
+        resp = await client.get("/static/style.css")
+        assert resp.status == 200
+        save_token.assert_not_called()
+
+        resp = await client.get("/")
+        assert resp.status == 200
+        save_token.assert_called_once()
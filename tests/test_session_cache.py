@@ -0,0 +1,153 @@
+import base64
+import pickle
+from unittest import mock
+
+import pytest
+from aiohttp import web
+from aiohttp_session import SimpleCookieStorage, get_session
+from aiohttp_session import setup as setup_session
+
+import aiohttp_csrf
+from aiohttp_csrf.memory import LRUTokenCache
+
+from .conftest import HEADER_NAME, SESSION_NAME
+
+
+def test_lru_token_cache() -> None:
+    cache = LRUTokenCache(maxsize=2, ttl=10)
+
+    cache.set(b"a", "1")
+    cache.set(b"b", "2")
+    assert cache.get(b"a") == "1"
+
+    cache.set(b"c", "3")
+    assert cache.get(b"b") is None
+    assert cache.get(b"a") == "1"
+
+    cache.invalidate(b"a")
+    assert cache.get(b"a") is None
+
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_session_storage_cache_requires_per_session_rotation() -> None:
+    with pytest.raises(TypeError):
+        aiohttp_csrf.storage.SessionStorage(
+            SESSION_NAME, secret_phrase="test", cache=LRUTokenCache()
+        )
+
+    with pytest.raises(TypeError):
+        aiohttp_csrf.storage.SessionStorage(
+            SESSION_NAME,
+            secret_phrase="test",
+            rotation=aiohttp_csrf.rotation.UsageRotation(10),
+            cache=LRUTokenCache(),
+        )
+
+
+async def test_session_storage_cache(test_client) -> None:
+    cache = LRUTokenCache()
+    storage = aiohttp_csrf.storage.SessionStorage(
+        SESSION_NAME,
+        secret_phrase="test",
+        rotation=aiohttp_csrf.rotation.PerSessionRotation(),
+        cache=cache,
+    )
+
+    def create_app(loop):
+        async def handler_get(request):
+            token = await aiohttp_csrf.generate_token(request)
+
+            return web.Response(body=token.encode("utf-8"))
+
+        async def handler_post(request):
+            return web.Response(body=b"OK")
+
+        app = web.Application()
+        setup_session(app, SimpleCookieStorage())
+        aiohttp_csrf.setup(
+            app,
+            policy=aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME),
+            storage=storage,
+        )
+        app.middlewares.append(aiohttp_csrf.csrf_middleware)
+        app.router.add_get("/", handler_get)
+        app.router.add_post("/", handler_post)
+
+        return app
+
+    client = await test_client(create_app)
+
+    resp = await client.get("/")
+    token = await resp.text()
+
+    # the first check loads the session and fills the cache
+    resp = await client.post("/", headers={HEADER_NAME: token})
+    assert resp.status == 200
+    assert cache.misses == 1
+
+    with mock.patch(
+        "aiohttp_csrf.storage.get_session", side_effect=AssertionError
+    ) as get_session:
+        for _ in range(3):
+            resp = await client.post("/", headers={HEADER_NAME: token})
+            assert resp.status == 200
+
+    assert get_session.call_count == 0
+    assert cache.hits == 3
+
+
+async def test_session_storage_store_raw(test_client) -> None:
+    storage = aiohttp_csrf.storage.SessionStorage(
+        SESSION_NAME,
+        token_generator=aiohttp_csrf.token_generator.SimpleTokenGenerator(
+            token_format="base64url"
+        ),
+        store_raw=True,
+    )
+
+    def create_app(loop):
+        async def handler_get(request):
+            token = await aiohttp_csrf.generate_token(request)
+
+            return web.Response(body=token.encode("utf-8"))
+
+        async def handler_post(request):
+            session = await get_session(request)
+            assert isinstance(session[SESSION_NAME], bytes)
+            assert len(session[SESSION_NAME]) == 16
+
+            return web.Response(body=b"OK")
+
+        app = web.Application()
+        setup_session(
+            app,
+            # an encoder that can serialize bytes, unlike the default JSON one
+            SimpleCookieStorage(
+                encoder=lambda data: base64.b64encode(pickle.dumps(data)).decode(),
+                decoder=lambda data: pickle.loads(base64.b64decode(data)),
+            ),
+        )
+        aiohttp_csrf.setup(
+            app,
+            policy=aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME),
+            storage=storage,
+        )
+        app.middlewares.append(aiohttp_csrf.csrf_middleware)
+        app.router.add_get("/", handler_get)
+        app.router.add_post("/", handler_post)
+
+        return app
+
+    client = await test_client(create_app)
+
+    resp = await client.get("/")
+    token = await resp.text()
+    assert len(token) == 22
+
+    other = ("B" if token[0] == "A" else "A") + token[1:]
+    resp = await client.post("/", headers={HEADER_NAME: other})
+    assert resp.status == 403
+
+    resp = await client.post("/", headers={HEADER_NAME: token})
+    assert resp.status == 200
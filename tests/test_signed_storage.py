@@ -0,0 +1,109 @@
+import time
+from unittest import mock
+
+import pytest
+from aiohttp import web
+
+import aiohttp_csrf
+
+from .conftest import HEADER_NAME
+
+SESSION_COOKIE_NAME = "AIOHTTP_SESSION"
+
+
+@pytest.fixture
+def create_app(init_app):
+    def go(loop):
+        async def handler_get(request):
+            token = await aiohttp_csrf.generate_token(request)
+
+            return web.Response(body=token.encode("utf-8"))
+
+        async def handler_post(request):
+            return web.Response(body=b"OK")
+
+        handlers = [("GET", "/", handler_get), ("POST", "/", handler_post)]
+
+        storage = aiohttp_csrf.storage.SignedTokenStorage(
+            aiohttp_csrf.storage.cookie_identity(SESSION_COOKIE_NAME),
+            secret_phrase="test",
+            max_age=60,
+        )
+
+        app = init_app(
+            policy=aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME),
+            storage=storage,
+            handlers=handlers,
+            loop=loop,
+        )
+
+        app.middlewares.append(aiohttp_csrf.csrf_middleware)
+
+        return app
+
+    yield go
+
+
+async def test_signed_token_success(test_client, create_app) -> None:
+    client = await test_client(create_app)
+    client.session.cookie_jar.update_cookies({SESSION_COOKIE_NAME: "session-1"})
+
+    resp = await client.get("/")
+
+    assert resp.status == 200
+    assert "Set-Cookie" not in resp.headers
+
+    headers = {HEADER_NAME: await resp.text()}
+
+    resp = await client.post("/", headers=headers)
+
+    assert resp.status == 200
+    assert "Set-Cookie" not in resp.headers
+
+
+async def test_signed_token_other_identity(test_client, create_app) -> None:
+    client = await test_client(create_app)
+    client.session.cookie_jar.update_cookies({SESSION_COOKIE_NAME: "session-1"})
+
+    resp = await client.get("/")
+
+    headers = {HEADER_NAME: await resp.text()}
+
+    client.session.cookie_jar.update_cookies({SESSION_COOKIE_NAME: "session-2"})
+
+    resp = await client.post("/", headers=headers)
+
+    assert resp.status == 403
+
+
+async def test_signed_token_without_identity(test_client, create_app) -> None:
+    client = await test_client(create_app)
+
+    resp = await client.get("/")
+
+    assert await resp.text() == ""
+
+    storage = aiohttp_csrf.storage.SignedTokenStorage(
+        aiohttp_csrf.storage.cookie_identity(SESSION_COOKIE_NAME),
+        secret_phrase="test",
+    )
+    # a token signed over no identity, as it was issued before
+    headers = {HEADER_NAME: storage.token_generator.generate("")}
+
+    resp = await client.post("/", headers=headers)
+
+    assert resp.status == 403
+
+
+async def test_signed_token_expired(test_client, create_app) -> None:
+    client = await test_client(create_app)
+    client.session.cookie_jar.update_cookies({SESSION_COOKIE_NAME: "session-1"})
+
+    resp = await client.get("/")
+
+    headers = {HEADER_NAME: await resp.text()}
+
+    with mock.patch("time.time", return_value=time.time() + 61):
+        resp = await client.post("/", headers=headers)
+
+    assert resp.status == 403
@@ -1,4 +1,4 @@
-from unittest.mock import MagicMock
+from unittest.mock import AsyncMock, MagicMock
 
 from aiohttp.test_utils import make_mocked_request
 from aiohttp.web import StreamResponse
@@ -64,3 +64,36 @@ async def test_2() -> None:
 #
 #     with pytest.raises(TypeError):
 #         FakeStorage(token_generator=token_generator)
+
+
+async def test_save_token_unchanged() -> None:
+    storage = FakeStorage(
+        secret_phrase="test",
+        rotation=aiohttp_csrf.rotation.PerSessionRotation(),
+    )
+    storage._save_token = AsyncMock()  # type: ignore[method-assign]
+
+    request = make_mocked_request("POST", "/")
+    request["my_field"] = "1"
+
+    assert await storage.get(request) == "1"
+
+    await storage.save_token(request, StreamResponse())
+
+    assert storage._save_token.call_count == 0
+
+
+async def test_storage_read_once_per_request() -> None:
+    storage = FakeStorage(
+        secret_phrase="test",
+        rotation=aiohttp_csrf.rotation.PerSessionRotation(),
+    )
+    storage._get = AsyncMock(return_value="1")  # type: ignore[method-assign]
+
+    request = make_mocked_request("POST", "/")
+
+    assert await storage.get(request) == "1"
+    assert await storage.generate_new_token(request) == "1"
+    await storage.save_token(request, StreamResponse())
+
+    assert storage._get.call_count == 1
@@ -0,0 +1,94 @@
+import aiohttp
+import pytest
+from aiohttp import web
+
+import aiohttp_csrf
+
+from .conftest import COOKIE_NAME, FORM_FIELD_NAME
+
+
+@pytest.fixture
+def create_app(init_app):
+    def go(loop, max_parts=1):
+        async def handler_get(request):
+            token = await aiohttp_csrf.generate_token(request)
+
+            return web.Response(body=token.encode("utf-8"))
+
+        async def handler_post(request):
+            reader = await aiohttp_csrf.policy.get_multipart_reader(request)
+            scanned = aiohttp_csrf.policy.get_scanned_fields(request)
+
+            names = list(scanned)
+            async for part in reader:
+                assert isinstance(part, aiohttp.BodyPartReader)
+                names.append(part.name)
+                await part.read()
+
+            return web.Response(text=",".join(names))
+
+        handlers = [("GET", "/", handler_get), ("POST", "/", handler_post)]
+
+        app = init_app(
+            policy=aiohttp_csrf.policy.FormPolicy(
+                FORM_FIELD_NAME, streaming=True, max_parts=max_parts
+            ),
+            storage=aiohttp_csrf.storage.CookieStorage(
+                COOKIE_NAME, secret_phrase="test"
+            ),
+            handlers=handlers,
+            loop=loop,
+        )
+
+        app.middlewares.append(aiohttp_csrf.csrf_middleware)
+
+        return app
+
+    yield go
+
+
+def make_form(*fields):
+    form = aiohttp.FormData()
+
+    for name, value in fields:
+        form.add_field(name, value, filename="upload" if name == "file" else None)
+
+    return form
+
+
+async def test_streaming_token_first(test_client, create_app) -> None:
+    client = await test_client(create_app)
+
+    resp = await client.get("/")
+    token = await resp.text()
+
+    form = make_form((FORM_FIELD_NAME, token), ("file", b"x" * 100_000))
+    resp = await client.post("/", data=form)
+
+    assert resp.status == 200
+    assert await resp.text() == "file"
+
+
+async def test_streaming_token_within_max_parts(test_client, create_app) -> None:
+    client = await test_client(create_app, max_parts=2)
+
+    resp = await client.get("/")
+    token = await resp.text()
+
+    form = make_form(("name", "value"), (FORM_FIELD_NAME, token), ("file", b"x"))
+    resp = await client.post("/", data=form)
+
+    assert resp.status == 200
+    assert await resp.text() == "name,file"
+
+
+async def test_streaming_token_too_late(test_client, create_app) -> None:
+    client = await test_client(create_app)
+
+    resp = await client.get("/")
+    token = await resp.text()
+
+    form = make_form(("file", b"x" * 100_000), (FORM_FIELD_NAME, token))
+    resp = await client.post("/", data=form)
+
+    assert resp.status == 403
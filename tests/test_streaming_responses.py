@@ -0,0 +1,149 @@
+import logging
+
+import pytest
+from aiohttp import web
+from aiohttp_session import SimpleCookieStorage
+from aiohttp_session import setup as setup_session
+
+import aiohttp_csrf
+
+from .conftest import COOKIE_NAME, HEADER_NAME, SESSION_NAME
+
+
+@pytest.fixture(
+    params=[
+        lambda: aiohttp_csrf.storage.CookieStorage(COOKIE_NAME, secret_phrase="test"),
+        # sets its client id cookie with response.set_cookie()
+        lambda: aiohttp_csrf.storage.MemoryStorage(COOKIE_NAME, secret_phrase="test"),
+    ],
+    ids=["cookie", "memory"],
+)
+def create_app(request, tmp_path):
+    storage_factory = request.param
+    (tmp_path / "page.txt").write_text("file body")
+
+    def go(loop) -> web.Application:
+        async def handler_stream(request):
+            token = await aiohttp_csrf.generate_token(request)
+
+            response = web.StreamResponse()
+            await response.prepare(request)
+            await response.write(token.encode("utf-8"))
+            await response.write_eof()
+
+            return response
+
+        async def handler_events(request):
+            token = await aiohttp_csrf.generate_token(request)
+
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            for _ in range(3):
+                await response.write(f"data: {token}\n\n".encode())
+
+            return response
+
+        async def handler_file(request):
+            await aiohttp_csrf.generate_token(request)
+
+            return web.FileResponse(tmp_path / "page.txt")
+
+        async def handler_post(request):
+            return web.Response(text="OK")
+
+        app = web.Application(middlewares=[aiohttp_csrf.csrf_middleware])
+        aiohttp_csrf.setup(
+            app,
+            policy=aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME),
+            storage=storage_factory(),
+        )
+
+        app.router.add_get("/stream", handler_stream)
+        app.router.add_get("/events", handler_events)
+        app.router.add_get("/file", handler_file)
+        app.router.add_post("/", handler_post)
+
+        return app
+
+    yield go
+
+
+async def test_stream_response(test_client, create_app) -> None:
+    client = await test_client(create_app)
+
+    resp = await client.get("/stream")
+    assert resp.status == 200
+    assert COOKIE_NAME in resp.cookies
+    assert len(resp.headers.getall("Set-Cookie")) == 1
+
+    resp = await client.post("/", headers={HEADER_NAME: await resp.text()})
+    assert resp.status == 200
+
+
+async def test_event_stream(test_client, create_app) -> None:
+    client = await test_client(create_app)
+
+    resp = await client.get("/events")
+    assert resp.status == 200
+    assert COOKIE_NAME in resp.cookies
+
+    token = (await resp.text()).split("\n\n")[0].removeprefix("data: ")
+    resp = await client.post("/", headers={HEADER_NAME: token})
+    assert resp.status == 200
+
+
+async def test_file_response(test_client, create_app) -> None:
+    client = await test_client(create_app)
+
+    resp = await client.get("/file")
+    assert resp.status == 200
+    assert await resp.text() == "file body"
+    assert COOKIE_NAME in resp.cookies
+
+
+def test_setup_registers_signal_once() -> None:
+    app = web.Application()
+
+    for _ in range(2):
+        aiohttp_csrf.setup(
+            app,
+            policy=aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME),
+            storage=aiohttp_csrf.storage.CookieStorage(COOKIE_NAME, secret_phrase="x"),
+        )
+
+    assert len(app.on_response_prepare) == 1
+
+
+async def test_session_storage_stream_warns(test_client, caplog) -> None:
+    def create_app(loop) -> web.Application:
+        async def handler_stream(request):
+            await aiohttp_csrf.generate_token(request)
+
+            response = web.StreamResponse()
+            await response.prepare(request)
+            await response.write_eof()
+
+            return response
+
+        app = web.Application()
+        setup_session(app, SimpleCookieStorage())
+        aiohttp_csrf.setup(
+            app,
+            policy=aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME),
+            storage=aiohttp_csrf.storage.SessionStorage(
+                SESSION_NAME, secret_phrase="test"
+            ),
+        )
+        app.middlewares.append(aiohttp_csrf.csrf_middleware)
+        app.router.add_get("/stream", handler_stream)
+
+        return app
+
+    client = await test_client(create_app)
+
+    with caplog.at_level(logging.WARNING):
+        resp = await client.get("/stream")
+
+    assert resp.status == 200
+    assert "AIOHTTP_SESSION" not in resp.cookies
+    assert "token issued for a StreamResponse is lost" in caplog.text
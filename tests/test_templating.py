@@ -0,0 +1,101 @@
+import pytest
+from aiohttp import web
+
+import aiohttp_csrf
+from aiohttp_csrf.templating import LazyHiddenInput, LazyToken, csrf_processor
+
+from .conftest import COOKIE_NAME, FORM_FIELD_NAME
+
+
+@pytest.fixture
+def create_app():
+    def go(loop, policy=None, rotation=None) -> web.Application:
+        async def handler_render(request):
+            context = await csrf_processor(request)
+            return web.Response(text=str(context["csrf_input"]))
+
+        async def handler_unused(request):
+            context = await csrf_processor(request)
+            assert isinstance(context["csrf_token"], LazyToken)
+            return web.Response(text="no token here")
+
+        async def handler_post(request):
+            return web.Response(text="OK")
+
+        app = web.Application(middlewares=[aiohttp_csrf.csrf_middleware])
+        aiohttp_csrf.setup(
+            app,
+            policy=policy or aiohttp_csrf.policy.FormPolicy(FORM_FIELD_NAME),
+            storage=aiohttp_csrf.storage.CookieStorage(
+                COOKIE_NAME, secret_phrase="test", rotation=rotation
+            ),
+        )
+
+        app.router.add_get("/render", handler_render)
+        app.router.add_get("/unused", handler_unused)
+        app.router.add_post("/", handler_post)
+
+        return app
+
+    yield go
+
+
+async def test_lazy_token_rendered(test_client, create_app) -> None:
+    client = await test_client(create_app)
+
+    resp = await client.get("/render")
+    assert resp.status == 200
+
+    token = resp.cookies[COOKIE_NAME].value
+    assert await resp.text() == (
+        f'<input type="hidden" name="{FORM_FIELD_NAME}" value="{token}">'
+    )
+
+    resp = await client.post("/", data={FORM_FIELD_NAME: token})
+    assert resp.status == 200
+
+
+async def test_lazy_token_unused(test_client, create_app) -> None:
+    client = await test_client(create_app)
+
+    resp = await client.get("/unused")
+    assert resp.status == 200
+    assert COOKIE_NAME not in resp.cookies
+
+
+async def test_lazy_token_reuses_stored_token(test_client, create_app) -> None:
+    client = await test_client(
+        create_app, rotation=aiohttp_csrf.rotation.PerSessionRotation()
+    )
+
+    resp = await client.get("/render")
+    first = await resp.text()
+
+    # a second tab must not invalidate the form rendered in the first
+    resp = await client.get("/render")
+    assert await resp.text() == first
+
+    token = client.session.cookie_jar.filter_cookies(client.make_url("/"))
+    assert token[COOKIE_NAME].value in first
+
+
+async def test_lazy_input_combined_policy(test_client, create_app) -> None:
+    policy = aiohttp_csrf.policy.AnyOf(
+        aiohttp_csrf.policy.OriginPolicy(),
+        aiohttp_csrf.policy.FormPolicy(FORM_FIELD_NAME),
+    )
+    client = await test_client(create_app, policy=policy)
+
+    resp = await client.get("/render")
+    assert resp.status == 200
+    assert f'name="{FORM_FIELD_NAME}"' in await resp.text()
+
+
+def test_lazy_hidden_input_escapes() -> None:
+    token = LazyToken(None)  # type: ignore[arg-type]
+    token._value = '"><script>'
+
+    assert str(token) == '"><script>'
+    assert str(LazyHiddenInput("a&b", token)) == (
+        '<input type="hidden" name="a&amp;b" value="&quot;&gt;&lt;script&gt;">'
+    )
@@ -1,9 +1,13 @@
+import gc
+import re
 import uuid
 from unittest import mock
 
+import pytest
 from blake3 import blake3
 
 import aiohttp_csrf
+from aiohttp_csrf.token_generator import TOKEN_FORMATS, decode_bytes, encode_bytes
 
 COOKIE_NAME = "csrf_token"
 HEADER_NAME = "X-CSRF-TOKEN"
@@ -35,3 +39,132 @@ def test_hashed_token_generator() -> None:
     with mock.patch("uuid.uuid4", return_value=u):
         token = token_generator.generate()
         assert token == hasher.hexdigest()
+
+
+def test_signed_token_generator() -> None:
+    token_generator = aiohttp_csrf.token_generator.SignedTokenGenerator(
+        "secret",
+        max_age=60,
+    )
+
+    token = token_generator.generate("identity")
+
+    assert token_generator.verify(token, "identity")
+    assert not token_generator.verify(token, "other")
+    tampered = token[:-1] + ("1" if token[-1] == "0" else "0")
+    assert not token_generator.verify(tampered, "identity")
+    assert not token_generator.verify("garbage", "identity")
+
+    other_generator = aiohttp_csrf.token_generator.SignedTokenGenerator("other")
+
+    assert not other_generator.verify(token, "identity")
+
+
+def test_pooled_token_generator() -> None:
+    token_generator = aiohttp_csrf.token_generator.PooledTokenGenerator(
+        token_size=16,
+        pool_size=4,
+    )
+
+    tokens = {token_generator.generate() for _ in range(10)}
+
+    assert len(tokens) == 10
+    assert all(len(token) == 32 for token in tokens)
+
+
+def test_pooled_hashed_token_generator() -> None:
+    token_generator = aiohttp_csrf.token_generator.PooledTokenGenerator("secret")
+
+    with mock.patch("os.urandom", return_value=bytes(range(32))):
+        token_generator._reset()
+        first = token_generator.generate()
+        second = token_generator.generate()
+
+    assert first != second
+    assert len(first) == 32
+    assert first != bytes(range(16)).hex()
+
+
+def test_pooled_token_generator_reset_after_fork() -> None:
+    from aiohttp_csrf.token_generator import _pooled_generators, _reset_after_fork
+
+    token_generator = aiohttp_csrf.token_generator.PooledTokenGenerator()
+    token_generator.generate()
+    assert token_generator._offset
+
+    _reset_after_fork()
+    assert token_generator._offset == 0
+    assert len(token_generator._pool) == 0
+
+    # generators are tracked weakly, so dropping them shrinks the set
+    count = len(_pooled_generators)
+    del token_generator
+    gc.collect()
+    assert len(_pooled_generators) == count - 1
+
+
+@pytest.mark.parametrize("secret_phrase", [None, "secret"])
+def test_pooled_token_size(secret_phrase) -> None:
+    token_generator = aiohttp_csrf.token_generator.PooledTokenGenerator(
+        secret_phrase, token_size=8
+    )
+
+    assert len(token_generator.generate()) == 16
+
+
+@pytest.mark.parametrize(
+    "token_generator",
+    [
+        aiohttp_csrf.token_generator.SimpleTokenGenerator(token_format="base64url"),
+        aiohttp_csrf.token_generator.HashedTokenGenerator(
+            "secret", token_size=16, token_format="base64url"
+        ),
+        aiohttp_csrf.token_generator.PooledTokenGenerator(token_format="base64url"),
+    ],
+)
+def test_base64url_token_format(token_generator) -> None:
+    token = token_generator.generate()
+
+    assert len(token) == 22
+    assert re.fullmatch(r"[A-Za-z0-9_-]+", token)
+    assert len(decode_bytes(token, "base64url")) == 16
+
+
+def test_token_size() -> None:
+    token_generator = aiohttp_csrf.token_generator.SimpleTokenGenerator(token_size=24)
+
+    assert len(token_generator.generate()) == 48
+
+
+def test_decode_bytes() -> None:
+    raw = bytes(range(16))
+
+    for token_format in TOKEN_FORMATS:
+        assert decode_bytes(encode_bytes(raw, token_format), token_format) == raw
+
+    for token, token_format in [
+        ("ABCD", "hex"),
+        ("0 1", "hex"),
+        ("AAAAAAAAAAAAAAAAAAAAAB", "base64url"),
+        ("a+b/", "base64url"),
+        ("é", "base64url"),
+    ]:
+        with pytest.raises(ValueError):
+            decode_bytes(token, token_format)
+
+    with pytest.raises(ValueError):
+        aiohttp_csrf.token_generator.SimpleTokenGenerator(token_format="base32")
+
+
+def test_signed_token_generator_base64url() -> None:
+    token_generator = aiohttp_csrf.token_generator.SignedTokenGenerator(
+        "secret", token_format="base64url"
+    )
+
+    token = token_generator.generate("identity")
+
+    assert len(token) < len(
+        aiohttp_csrf.token_generator.SignedTokenGenerator("secret").generate()
+    )
+    assert token_generator.verify(token, "identity")
+    assert not token_generator.verify(token, "other")
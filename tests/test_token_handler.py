@@ -0,0 +1,80 @@
+import pytest
+from aiohttp import web
+
+import aiohttp_csrf
+
+from .conftest import COOKIE_NAME, HEADER_NAME
+
+
+@pytest.fixture(
+    params=[
+        aiohttp_csrf.rotation.PerSessionRotation,
+        aiohttp_csrf.rotation.PerRequestRotation,
+    ]
+)
+def rotation(request):
+    return request.param
+
+
+@pytest.fixture
+def create_app(rotation):
+    def go(loop) -> web.Application:
+        async def handler_post(request):
+            return web.Response(text="OK")
+
+        async def handler_not_modified(request):
+            await aiohttp_csrf.generate_token(request)
+            raise web.HTTPNotModified()
+
+        app = web.Application(middlewares=[aiohttp_csrf.csrf_middleware])
+        aiohttp_csrf.setup(
+            app,
+            policy=aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME),
+            storage=aiohttp_csrf.storage.CookieStorage(
+                COOKIE_NAME, secret_phrase="test", rotation=rotation()
+            ),
+        )
+
+        app.router.add_get("/token", aiohttp_csrf.csrf_token_handler)
+        app.router.add_get("/not-modified", handler_not_modified)
+        app.router.add_post("/", handler_post)
+
+        return app
+
+    yield go
+
+
+async def test_token_handler(test_client, create_app, rotation) -> None:
+    client = await test_client(create_app)
+
+    resp = await client.get("/token")
+    assert resp.status == 200
+    assert resp.headers["Cache-Control"] == "private, no-cache"
+
+    token = await resp.text()
+    etag = resp.headers["ETag"]
+    assert token not in etag
+    assert resp.cookies[COOKIE_NAME].value == token
+
+    resp = await client.get("/token", headers={"If-None-Match": etag})
+
+    if rotation is aiohttp_csrf.rotation.PerSessionRotation:
+        # the stored token is kept, so the client's copy is still current
+        assert resp.status == 304
+        assert resp.headers["ETag"] == etag
+        assert "Set-Cookie" not in resp.headers
+    else:
+        assert resp.status == 200
+        assert resp.headers["ETag"] != etag
+        token = await resp.text()
+
+    resp = await client.post("/", headers={HEADER_NAME: token})
+    assert resp.status == 200
+
+
+async def test_not_modified_sets_no_cookie(test_client, create_app) -> None:
+    client = await test_client(create_app)
+
+    resp = await client.get("/not-modified")
+    assert resp.status == 304
+    assert "Set-Cookie" not in resp.headers
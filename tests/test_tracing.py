@@ -0,0 +1,108 @@
+from aiohttp import web
+
+import aiohttp_csrf
+from aiohttp_csrf.metrics import InMemoryMetrics
+from aiohttp_csrf.tracing import (
+    POLICY_CHECK,
+    STORAGE_GET,
+    STORAGE_SAVE_TOKEN,
+    TOKEN_GENERATE,
+)
+
+from .conftest import COOKIE_NAME, HEADER_NAME
+
+
+class RecordingTracer:
+    def __init__(self):
+        self.events = []
+
+    def start(self, request, stage):
+        self.events.append(("start", stage))
+        return stage
+
+    def end(self, request, stage, span, exc):
+        assert span == stage
+        self.events.append(("end", stage, type(exc).__name__ if exc else None))
+
+
+class FailingPolicy:
+    async def check(self, request, original_value):
+        raise RuntimeError("backend down")
+
+
+def create_app(loop, policy, tracer, metrics=None) -> web.Application:
+    async def handler_get(request):
+        await aiohttp_csrf.generate_token(request)
+
+        return web.Response(body=b"OK")
+
+    async def handler_post(request):
+        return web.Response(body=b"OK")
+
+    app = web.Application(middlewares=[aiohttp_csrf.csrf_middleware])
+
+    aiohttp_csrf.setup(
+        app,
+        policy=policy,
+        storage=aiohttp_csrf.storage.CookieStorage(COOKIE_NAME, secret_phrase="test"),
+        metrics=metrics,
+        tracer=tracer,
+    )
+
+    app.router.add_get("/", handler_get)
+    app.router.add_post("/", handler_post)
+
+    return app
+
+
+async def test_tracer_stages(test_client) -> None:
+    tracer = RecordingTracer()
+    metrics = InMemoryMetrics()
+    client = await test_client(
+        create_app,
+        policy=aiohttp_csrf.policy.HeaderPolicy(HEADER_NAME),
+        tracer=tracer,
+        metrics=metrics,
+    )
+
+    resp = await client.get("/")
+    assert resp.status == 200
+    token = resp.cookies[COOKIE_NAME].value
+
+    assert tracer.events == [
+        ("start", TOKEN_GENERATE),
+        ("end", TOKEN_GENERATE, None),
+        ("start", STORAGE_SAVE_TOKEN),
+        ("end", STORAGE_SAVE_TOKEN, None),
+    ]
+    tracer.events.clear()
+
+    resp = await client.post("/", headers={HEADER_NAME: token})
+    assert resp.status == 200
+
+    # reading the token also issues the next one
+    assert tracer.events == [
+        ("start", STORAGE_GET),
+        ("start", TOKEN_GENERATE),
+        ("end", TOKEN_GENERATE, None),
+        ("end", STORAGE_GET, None),
+        ("start", POLICY_CHECK),
+        ("end", POLICY_CHECK, None),
+        ("start", STORAGE_SAVE_TOKEN),
+        ("end", STORAGE_SAVE_TOKEN, None),
+    ]
+
+    # the metrics collector sees the same stages alongside the tracer
+    histograms = metrics.snapshot()["histograms"]
+    assert histograms[TOKEN_GENERATE]["count"] == 2
+    assert histograms[POLICY_CHECK]["count"] == 1
+
+
+async def test_tracer_records_exception(test_client) -> None:
+    tracer = RecordingTracer()
+    client = await test_client(create_app, policy=FailingPolicy(), tracer=tracer)
+
+    resp = await client.post("/")
+    assert resp.status == 500
+
+    assert ("end", POLICY_CHECK, "RuntimeError") in tracer.events